@@ -23,19 +23,39 @@ help_str = (
 'Commands: \n' +
 'queue: Display the current queue\n\n' +
 'queue_songs: Display the current queue in pageviewer\n\n' +
+'watch_queue (on|off): Check the queue in the background, adding new songs ' +
+'in it to the database, so that queue and queue_songs show it straight ' +
+'away.\n\n' +
 '(exit|quit|q): quit\n\n' +
 'rate (id) (rating): sets the user rating for a song\n\n' +
 'remake_all: Build entire database.  Run this once when you ' +
 'use the program for the first time.\n\n' +
+'remake_all --resume: Carry on with a remake_all that was interrupted.\n\n' +
+'refresh: Update the database with only the parts of the song list that ' +
+'have changed since it was last scraped.  Much quicker than remake_all.\n\n' +
+'reparse: Remake the database from the copies of the site\'s pages kept by ' +
+'the other commands, without scraping the site again.\n\n' +
 'update_favorites: Scrape your favorite list.  Only run this once the ' +
 'database has already been made\n\n' +
 'query (query_string): Make a query.  See README.txt for ' +
 'complete details on how to query.\n\n' +
+'search (words): Find the songs with all of the words in their title, ' +
+'artist, album or tags, best match first.\n\n' +
 'update (id): Updates the information for the song with the given id\n\n' +
+'crawl_details (on|off): Slowly fetch the year and other details of every ' +
+'song in the background, starting with the songs you look at.  Without on ' +
+'or off, shows how far it has got.\n\n' +
 'delete (id): Deletes the song with the given id from the database.\n\n'  +
 'info (id): Shows all information for the song with the given id.\n\n'  +
 'req: Puts the current time into a list of request times.\n\n' +
-'req_times: Display waiting times for various numbers of request limits.\n\n'
+'req_times: Display waiting times for various numbers of request limits.\n\n' +
+'http_stats: Show how many requests and connections have been made to the ' +
+'site.\n\n' +
+'index_advice: Show which of the queries made so far have to read every ' +
+'song, and which indexes would speed them up.\n\n' +
+'index_advice --create: Also create the suggested indexes.\n\n' +
+'cache_stats: Show how many pages have come from the local cache of pages ' +
+'from the site.\n\n' +
 'extract_duplicates: Find duplicate songs according to some criterion and ' +
 'export the list of duplicates to a text file.\n\n'
 )
@@ -68,6 +88,10 @@ if __name__ == '__main__':
                     pageviewer.pageviewer(songs, db)
                 except sqlite3.Error, e:
                     print e
+            elif command.startswith('crawl_details'):
+                commands.crawl_details(command[13:], db)
+            elif command.startswith('watch_queue'):
+                commands.watch_queue(command[11:])
             elif command.startswith('query'):
                 # sqlite3 might give an error on a bad query
                 try:
@@ -75,18 +99,35 @@ if __name__ == '__main__':
                     pageviewer.pageviewer(songs, db)
                 except sqlite3.Error, e:
                     print e
+            elif command.startswith('search'):
+                # sqlite3 might give an error on a bad search
+                try:
+                    songs = commands.search(command[6:], db)
+                    pageviewer.pageviewer(songs, db)
+                except sqlite3.Error, e:
+                    print e
             elif command.startswith('rate'):
                 commands.rate_song(command[4:], db)
             elif command.startswith('update '):
                 commands.update_song(command[6:], db)
-            elif command == 'remake_all':
-                commands.remake_all(db)
+            elif command.startswith('remake_all'):
+                commands.remake_all(command[10:], db)
+            elif command == 'refresh':
+                commands.refresh(db)
+            elif command == 'reparse':
+                commands.reparse(db)
             elif command == 'update_favorites':
                 commands.update_favorites(db)
             elif command == 'req':
                 commands.request()
             elif command == 'req_times':
                 commands.print_request_time_info()
+            elif command == 'http_stats':
+                commands.print_http_stats()
+            elif command == 'cache_stats':
+                commands.print_cache_stats()
+            elif command.startswith('index_advice'):
+                commands.index_advice(command[12:], db)
             elif command == 'export_duplicates':
                 commands.find_duplicates(db)
             else:
@@ -0,0 +1,851 @@
+'''
+Benchmarks for the parts of the program that have to deal with the whole song
+catalog at once.  None of them touch the website or your own database.
+
+To run: python benchmark.py (name)
+Running it without a name lists the available benchmarks.
+'''
+
+import commands
+import database
+import fakesite
+import httpcache
+import httpsession
+import multiprocessing
+import os
+import pagearchive
+import random
+import resultset
+import re
+import scraping
+import shutil
+import songinfo
+import sys
+import tempfile
+import time
+import urllib2
+
+# resource is only on Unix, and is only needed for peak memory use
+try:
+    import resource
+except ImportError, e:
+    resource = None
+
+# Catalog sizes to benchmark: roughly the current site, and a much bigger one
+catalog_sizes = [18000, 500000]
+
+# Number of songs on each made up songlist page
+songs_per_page = 50
+
+
+def synthetic_songs(num_songs):
+    '''
+    Returns a list of num_songs made up SongInfo, with ids 1 to num_songs.
+    The same songs are generated every time.
+    '''
+    rand = random.Random(num_songs)
+    genres = ['Vocal', 'Instrumental', 'J-Pop', 'Rock', 'Ballad', 'Techno']
+    tags = ['K-On!', 'Opening', 'Ending', 'Insert Song', 'Character Song']
+    songs = []
+    for id in xrange(1, num_songs + 1):
+        songs.append(songinfo.SongInfo(id, 'Artist %d' % rand.randint(1, 5000),
+            'Title %d' % id, 'Album %d' % rand.randint(1, 8000),
+            rand.randint(1980, 2012), rand.sample(genres, rand.randint(1, 2)),
+            round(rand.uniform(5, 10), 2), rand.randint(0, 500),
+            rand.randint(60, 400), rand.sample(tags, rand.randint(0, 2)),
+            rand.randint(0, 10), rand.random() < 0.05))
+    return songs
+
+
+def temp_database():
+    '''
+    Returns a (Database, directory) pair, where the Database lives in a new
+    temporary directory.  The directory should be removed when done.
+    '''
+    directory = tempfile.mkdtemp(prefix='anfo_bench')
+    old_location = database.location
+    database.location = os.path.join(directory, 'data')
+    try:
+        db = database.Database()
+    finally:
+        database.location = old_location
+    return (db, directory)
+
+
+def legacy_insert_song(db, song):
+    '''
+    The original per-row insert, which formats every value into its own
+    statement.  Kept here as the baseline for bench_inserts.
+    '''
+    genres = database.delimiter_char.join(song.genres).replace("'", "''")
+    tags = database.delimiter_char.join(song.tags).replace("'", "''")
+    sql = '''insert or replace into ''' + database.table_name +\
+    ''' (id, artist, title, album, year, genres, rating, total_rates,
+    duration, tags, user_rating, user_favorite) values (%d, '%s', '%s',
+    '%s', %d, '%s', %f, %d, %d, '%s', %d, %d)''' \
+    % (song.id, song.artist.replace("'", "''"),
+    song.title.replace("'", "''"), song.album.replace("'", "''"), song.year,
+    genres, song.rating, song.total_rates, song.duration, tags,
+    song.user_rating, song.user_favorite)
+    db.c.execute(sql)
+
+
+class LegacySongInfo:
+    '''
+    The original SongInfo, an old-style class with an attribute dictionary
+    and genres and tags always split up.  Kept here as the baseline for
+    bench_songs.
+    '''
+
+    def __init__(self, id, artist, title, album, year, genres, rating,
+        total_rates, duration, tags, user_rating=0, user_favorite=False,
+        times_requested=0, total_favorites=0):
+        self.id = id
+        self.artist = artist
+        self.title = title
+        self.album = album
+        self.year = year
+        self.genres = genres
+        self.rating = rating
+        self.total_rates = total_rates
+        self.duration = duration
+        self.tags = tags
+        self.user_rating = user_rating
+        self.user_favorite = user_favorite
+        self.times_requested = times_requested
+        self.total_favorites = total_favorites
+
+
+def legacy_row_to_song(result):
+    '''
+    The original conversion of a sqlite3.Row of the songs table into a
+    SongInfo.  Kept here as the baseline for bench_songs.
+    '''
+    return LegacySongInfo(result['id'], result['artist'], result['title'],
+        result['album'], result['year'],
+        result['genres'].split(database.delimiter_char), result['rating'],
+        result['total_rates'], result['duration'],
+        result['tags'].split(database.delimiter_char), result['user_rating'],
+        result['user_favorite'], result['times_requested'] or 0,
+        result['total_favorites'] or 0)
+
+
+def legacy_parse_playlist_page(html):
+    '''
+    The original songlist page parser, which copies out what's left of the
+    page every time it moves on to the next field.  Kept here (without its
+    debug output) as the baseline for bench_parser.
+    '''
+    songs = []
+    # Pretty hacky -- hope nothing changes in the format of these pages!
+    chunks = html.split('playlist.php')
+    chunks.pop(0)
+    # These chunks come in pairs (since instances of playlist.php come in
+    # pairs).  With the first element of each pair we can get the artist and
+    # song name.  The second pair gives us everything else
+    for i in range(0, len(chunks), 2):
+        # Unlike individual song info pages, it's hard to parse these entries
+        # because there are no labels - you just have to rely on everything
+        # being in the right location.
+        # Get the artist and song title from the first chunk
+        chunk1 = chunks[i]
+        [artist, title] = re.findall('>.*?<', chunk1)
+        artist = artist[1:-1]
+
+        # Skip everything that doesn't have an artist, since there are some
+        # empty songs in the database (why?)
+        if artist == '':
+            continue
+
+        title = title[4:-1] # Get rid of '> - ' and '<'
+        # Get everything else from the second chunk
+        # Still need id, album, year, genres, rating, total rates,
+        # duration (in seconds), tags, user rating, and user favorite
+        chunk2 = chunks[i + 1]
+        # Album
+        cutoff_str = '>'
+        cutoff_index = chunk2.index(cutoff_str)
+        chunk2 = chunk2[cutoff_index + len(cutoff_str):]
+        album = chunk2.split('<')[0]
+        # Duration
+        cutoff_str = '<br/>' # Cut this off twice
+        cutoff_index = chunk2.index(cutoff_str)
+        chunk2 = chunk2[cutoff_index + len(cutoff_str):]
+        cutoff_index = chunk2.index(cutoff_str)
+        chunk2 = chunk2[cutoff_index + len(cutoff_str):]
+        colon_index = chunk2.index(':')
+        duration_str = chunk2[:colon_index + 3]
+        duration_str = duration_str.strip()
+        [minutes, seconds] = duration_str.split(':')
+        duration = 60 * int(minutes) + int(seconds)
+        # User Rating
+        cutoff_str = 'My rating: '
+        cutoff_index = chunk2.index(cutoff_str)
+        chunk2 = chunk2[cutoff_index + len(cutoff_str):]
+        user_rating = chunk2[:2].strip()
+        # Store rating of - as 0
+        user_rating = 0 if user_rating == '-' else int(user_rating)
+        # Rating
+        cutoff_str = 'Song rating: '
+        cutoff_index = chunk2.index(cutoff_str)
+        chunk2 = chunk2[cutoff_index + len(cutoff_str):]
+        rating = 0
+        if chunk2[0] != '-':
+            space_index = chunk2.index(' ')
+            rating = chunk2[0:space_index]
+            rating = float(rating)
+        # Total rates
+        cutoff_str = '('
+        cutoff_index = chunk2.index(cutoff_str)
+        chunk2 = chunk2[cutoff_index + len(cutoff_str):]
+        space_index = chunk2.index(' ')
+        total_rates_str = chunk2[0:space_index]
+        total_rates = 0 if total_rates_str == '' else int(total_rates_str)
+        # Genres
+        # Store as a list of strings
+        cutoff_str = 'Genre(s): '
+        cutoff_index = chunk2.index(cutoff_str)
+        chunk2 = chunk2[cutoff_index + len(cutoff_str):]
+        end_index = chunk2.index('<br/>')
+        genres = chunk2[:end_index] # Comma-delimited
+        genres = genres.split(',')
+        # Tags
+        # Store as a list of strings
+        cutoff_str = 'Tag(s):'
+        cutoff_index = chunk2.index(cutoff_str)
+        chunk2 = chunk2[cutoff_index + len(cutoff_str):]
+        tag_end_str = '</td>'
+        tag_str = chunk2[:chunk2.index(tag_end_str)]
+        matches = re.findall('>.*?<', tag_str)
+        tags = []
+        for match in matches:
+            if match != '><':
+                match = match[1:-1]
+                match = match.strip()
+                if match != '' and match != ',':
+                    tags.append(match)
+        # Id
+        cutoff_str = 'songinfo.php?id='
+        cutoff_index = chunk2.index(cutoff_str)
+        chunk2 = chunk2[cutoff_index + len(cutoff_str):]
+        id_str = chunk2[:chunk2.index('"')]
+        id = int(id_str)
+        song = songinfo.SongInfo(id, artist, title, album, 0,
+            genres, rating, total_rates, duration,
+            tags, user_rating, False)
+        songs.append(song)
+    return songs
+
+
+def time_insert(songs, insert, fast_load=False):
+    '''
+    Times inserting the songs into a fresh database, returning rows/second.
+    Arguments:
+        songs - List of SongInfo to insert.
+        insert - Function taking (db, songs) that inserts and commits them.
+        fast_load - Whether to use the remake_all PRAGMA settings.
+    '''
+    (db, directory) = temp_database()
+    try:
+        if fast_load:
+            old_settings = db.begin_fast_load()
+        start_time = time.time()
+        insert(db, songs)
+        elapsed = time.time() - start_time
+        if fast_load:
+            db.end_fast_load(old_settings)
+        db.conn.close()
+    finally:
+        shutil.rmtree(directory)
+    return len(songs) / elapsed
+
+
+def bench_inserts():
+    '''
+    Compares rows/second for the old per-row inserts and insert_songs.
+    '''
+    def per_row(db, songs):
+        for song in songs:
+            legacy_insert_song(db, song)
+        db.conn.commit()
+
+    def bulk(db, songs):
+        db.insert_songs(songs)
+
+    for num_songs in catalog_sizes:
+        songs = synthetic_songs(num_songs)
+        print '%d songs:' % num_songs
+        for (name, insert, fast_load) in [('per-row', per_row, False),
+            ('insert_songs', bulk, False),
+            ('insert_songs + fast load', bulk, True)]:
+            rate = time_insert(songs, insert, fast_load)
+            print '  %-26s %10.0f rows/sec' % (name, rate)
+
+
+def bench_favorites(num_favorites='5000'):
+    '''
+    Compares applying a list of favorites to a full database by clearing
+    every favorite and updating one song at a time (as populate_favorites
+    used to) and with set_favorites.
+    Arguments:
+        num_favorites - Number of favorites in the list.
+    '''
+    num_favorites = int(num_favorites)
+    for num_songs in catalog_sizes:
+        songs = synthetic_songs(num_songs)
+        ids = random.Random(num_favorites).sample(xrange(1, num_songs + 1),
+            min(num_favorites, num_songs))
+        (db, directory) = temp_database()
+        try:
+            db.insert_songs(songs)
+            print '%d songs, %d favorites:' % (num_songs, len(ids))
+            start_time = time.time()
+            db.set_no_favorites()
+            for id in ids:
+                db.set_favorite(id, True)
+            db.conn.commit()
+            print '  %-14s %8.3f sec' % ('per-song', time.time() - start_time)
+            # Start from the synthetic favorites again
+            db.insert_songs(songs)
+            start_time = time.time()
+            changed = db.set_favorites(ids)
+            print '  %-14s %8.3f sec, %d songs changed' % ('set_favorites',
+                time.time() - start_time, changed)
+            # Applying the same list again, as a refresh would
+            start_time = time.time()
+            changed = db.set_favorites(ids)
+            print '  %-14s %8.3f sec, %d songs changed' % ('  again',
+                time.time() - start_time, changed)
+            db.conn.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+def bench_memberships(num_queries='20'):
+    '''
+    Compares finding the songs with a given tag by matching a pattern against
+    every song's tags (tags like '%...%') and through the tag table
+    (tag:'...').  Each song gets a tag for its series as well, so that most
+    tags are rare, as on the site.
+    Arguments:
+        num_queries - Number of different tags to look up.
+    '''
+    num_queries = int(num_queries)
+    for num_songs in catalog_sizes:
+        songs = synthetic_songs(num_songs)
+        num_series = num_songs // 20
+        rand = random.Random(num_songs)
+        for song in songs:
+            song.tags.append('Series %d' % rand.randint(1, num_series))
+        (db, directory) = temp_database()
+        try:
+            start_time = time.time()
+            db.insert_songs(songs)
+            db.create_indexes()
+            print '%d songs (inserted in %.1f sec):' % (num_songs,
+                time.time() - start_time)
+            tags = ['Series %d' % rand.randint(1, num_series)
+                for _ in xrange(num_queries)]
+            for (name, query) in [('like', "tags like '%%%s%%'"),
+                ('tag table', "tag:'%s'")]:
+                start_time = time.time()
+                num_found = 0
+                for tag in tags:
+                    sql = commands.clean_query(query % tag)
+                    num_found += len(db.make_query(sql))
+                elapsed = (time.time() - start_time) / len(tags)
+                print '  %-10s %9.2f ms/query, %d songs found' % (name,
+                    1000 * elapsed, num_found)
+            db.conn.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+def bench_search(num_queries='20'):
+    '''
+    Compares searching for words in the title, artist, album and tags of
+    every song with 'like' (one pattern per word and column) and with the
+    full-text search index.
+    Arguments:
+        num_queries - Number of different searches to make.
+    '''
+    num_queries = int(num_queries)
+    for num_songs in catalog_sizes:
+        songs = synthetic_songs(num_songs)
+        rand = random.Random(num_songs)
+        searches = ['%s %d' % (rand.choice(['Artist', 'Album']),
+            rand.randint(1, 5000)) for _ in xrange(num_queries)]
+        (db, directory) = temp_database()
+        try:
+            start_time = time.time()
+            db.insert_songs(songs)
+            print '%d songs (inserted in %.1f sec):' % (num_songs,
+                time.time() - start_time)
+            # Writing every song again, as a refresh does when every page has
+            # changed, with the search index's triggers and without them
+            # (see Database.populate)
+            start_time = time.time()
+            db.update_songs(songs)
+            triggered = time.time() - start_time
+            start_time = time.time()
+            last_rowid = db.drop_search_triggers()
+            db.update_songs(songs)
+            db.refill_search_index([song.id for song in songs], last_rowid)
+            print '  rewriting every song: %.1f sec with triggers, %.1f sec ' \
+                'refilling the index afterwards' % (triggered,
+                time.time() - start_time)
+
+            def like(text):
+                conditions = ['(%s)' % ' or '.join(["%s like '%%%s%%'" %
+                    (column, word) for column in database.search_columns])
+                    for word in text.split()]
+                return db.make_query('select * from %s where %s' % (
+                    database.table_name, ' and '.join(conditions)))
+
+            for (name, search) in [('like', like), ('search', db.search)]:
+                start_time = time.time()
+                num_found = 0
+                for text in searches:
+                    num_found += len(search(text))
+                elapsed = (time.time() - start_time) / len(searches)
+                print '  %-8s %9.2f ms/search, %d songs found' % (name,
+                    1000 * elapsed, num_found)
+            db.conn.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+def song_size(song):
+    '''
+    Returns the number of bytes of memory a song takes up: the object, its
+    attribute dictionary if it has one, and each of its values (including
+    each genre and tag).
+    '''
+    size = sys.getsizeof(song)
+    if hasattr(song, '__dict__'):
+        size += sys.getsizeof(song.__dict__)
+        values = song.__dict__.values()
+    else:
+        values = [getattr(song, name) for name in song.__slots__]
+    for value in values:
+        size += sys.getsizeof(value)
+        if isinstance(value, list):
+            size += sum([sys.getsizeof(item) for item in value])
+    return size
+
+
+def bench_songs():
+    '''
+    Compares reading every song in the database the way make_query used to
+    (sqlite3.Row objects, each turned into a SongInfo with an attribute
+    dictionary and its genres and tags split up) and the way it does now
+    (straight from the row into a slotted SongInfo, leaving genres and tags
+    to be split up when used), in rows/second and bytes per song.
+    '''
+    for num_songs in catalog_sizes:
+        (db, directory) = temp_database()
+        try:
+            db.insert_songs(synthetic_songs(num_songs))
+            sql = 'select * from ' + database.table_name
+            print '%d songs:' % num_songs
+
+            def legacy():
+                db.c.execute(sql)
+                return [legacy_row_to_song(result)
+                    for result in db.c.fetchall()]
+
+            for (name, query) in [('sqlite3.Row', legacy),
+                ('row factory', lambda: db.make_query(sql))]:
+                start_time = time.time()
+                songs = query()
+                read_time = time.time() - start_time
+                read_size = sum([song_size(song) for song in songs])
+                # Then split up the genres and tags of every song, as the
+                # stats commands do
+                start_time = time.time()
+                for song in songs:
+                    song.genres
+                    song.tags
+                split_time = time.time() - start_time
+                split_size = sum([song_size(song) for song in songs])
+                print '  %-12s read %8.0f rows/sec, %4d bytes/song; with ' \
+                    'genres and tags used %8.0f rows/sec, %4d bytes/song' % (
+                    name, len(songs) / read_time, read_size / len(songs),
+                    len(songs) / (read_time + split_time),
+                    split_size / len(songs))
+                del songs
+            db.conn.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+def bench_connections(num_requests='500'):
+    '''
+    Compares fetching pages from a local FakeSite with a new urllib2 opener
+    for each page (as the scraper used to) and with a shared Session.
+    Arguments:
+        num_requests - Number of pages to fetch each way.
+    '''
+    num_requests = int(num_requests)
+    site = fakesite.FakeSite()
+    site.start()
+    try:
+        start_time = time.time()
+        for _ in xrange(num_requests):
+            urllib2.build_opener().open(site.url).read()
+        urllib2_time = time.time() - start_time
+
+        session = httpsession.Session()
+        start_time = time.time()
+        for _ in xrange(num_requests):
+            session.open(site.url).read()
+        session_time = time.time() - start_time
+        session.close()
+    finally:
+        site.stop()
+    print '%d requests:' % num_requests
+    print '  urllib2: %7.3f ms/request, %d connections' % (
+        1000 * urllib2_time / num_requests, num_requests)
+    stats = session.stats()
+    print '  Session: %7.3f ms/request, %d connections, %.1f%% reused' % (
+        1000 * session_time / num_requests, stats['connections'],
+        100 * stats['reuse_ratio'])
+
+
+def legacy_response_to_html(response):
+    '''
+    The original response reader, which adds each line onto the page read
+    so far (and doubles every newline).  Kept here as the baseline for
+    bench_reader.
+    '''
+    text = ''
+    for line in response.readlines():
+        text += line + '\n'
+    return text
+
+
+def bench_reader(page_songs='20000', num_requests='20'):
+    '''
+    Compares reading a large songlist page from a local FakeSite with the
+    original response_to_html and the current one.
+    Arguments:
+        page_songs - Number of songs on the page.
+        num_requests - Number of times to read the page each way.
+    '''
+    (page_songs, num_requests) = (int(page_songs), int(num_requests))
+    body = fakesite.playlist_page(synthetic_songs(page_songs))
+    site = fakesite.FakeSite(body=body)
+    site.start()
+    session = httpsession.Session()
+    try:
+        print '%d byte page, %d requests:' % (len(body), num_requests)
+        for (name, read) in [('original', legacy_response_to_html),
+            ('response_to_html', scraping.response_to_html)]:
+            start_time = time.time()
+            for _ in xrange(num_requests):
+                html = read(session.open(site.url))
+            elapsed = time.time() - start_time
+            print '  %-18s %8.2f ms/page, %5.1f MB/sec, %d bytes read' % (
+                name, 1000 * elapsed / num_requests,
+                len(body) * num_requests / elapsed / 1e6, len(html))
+    finally:
+        session.close()
+        site.stop()
+
+
+def song_fields(song):
+    '''
+    Returns a tuple of everything in a SongInfo, for comparing songs.
+    '''
+    return (song.id, song.artist, song.title, song.album, song.year,
+        song.genres, song.rating, song.total_rates, song.duration, song.tags,
+        song.user_rating, song.user_favorite)
+
+
+def bench_parser(num_pages='200'):
+    '''
+    Checks that parse_playlist_page gives the same songs as the original
+    parser on made up songlist pages, then compares how long each takes.
+    Arguments:
+        num_pages - Number of pages to parse each way.
+    '''
+    num_pages = int(num_pages)
+    songs = synthetic_songs(num_pages * songs_per_page)
+    # Fields the site leaves out of the songlist
+    for song in songs:
+        song.year = 0
+        song.user_favorite = False
+    # Every so often, a blank entry and a song nobody has rated
+    for song in songs[::37]:
+        song.artist = ''
+    for song in songs[5::41]:
+        song.rating = 0
+        song.user_rating = 0
+    pages = [fakesite.playlist_page(songs[i:i + songs_per_page], num_pages)
+        for i in xrange(0, len(songs), songs_per_page)]
+    expected = [song_fields(song) for song in songs if song.artist != '']
+
+    for (name, parse) in [('original', legacy_parse_playlist_page),
+        ('parse_playlist_page', scraping.parse_playlist_page)]:
+        parsed = []
+        start_time = time.time()
+        for page in pages:
+            parsed.extend(parse(page))
+        elapsed = time.time() - start_time
+        if [song_fields(song) for song in parsed] != expected:
+            print '  %-20s gave different songs!' % name
+        print '  %-20s %8.1f us/page, %8.2f us/song' % (name,
+            1e6 * elapsed / num_pages, 1e6 * elapsed / len(parsed))
+
+
+def bench_parse_processes(num_pages='400', page_songs='200'):
+    '''
+    Scrapes songlist pages from a local FakeSite, parsing them in the
+    scraping threads and then in pools of 1, 2, 4 and 8 processes, and
+    compares pages/second.
+    Arguments:
+        num_pages - Number of pages to scrape each way.
+        page_songs - Number of songs on each page.
+    '''
+    (num_pages, page_songs) = (int(num_pages), int(page_songs))
+    body = fakesite.playlist_page(synthetic_songs(page_songs), num_pages)
+    site = fakesite.FakeSite(body=body)
+    site.start()
+    settings = (scraping.playlist_url, scraping.requests_per_second,
+        scraping.parse_processes, sys.stdout)
+    scraping.playlist_url = site.url + 'playlist.php?page=%d'
+    # Only the site's limits should hold the scraper back
+    scraping.requests_per_second = 1e6
+    print '%d pages of %d songs:' % (num_pages, page_songs)
+    try:
+        for processes in [0, 1, 2, 4, 8]:
+            scraping.parse_processes = processes
+            # Keep the scraper's progress messages out of the results
+            sys.stdout = open(os.devnull, 'w')
+            start_time = time.time()
+            num_songs = 0
+            for (_, _, page_songs) in scraping.scrape_pages(
+                range(1, num_pages + 1), {}, 'Fetching page %d'):
+                num_songs += len(page_songs)
+            elapsed = time.time() - start_time
+            sys.stdout = settings[-1]
+            print '  parse_processes = %d: %8.1f pages/sec, %d songs' % (
+                processes, num_pages / elapsed, num_songs)
+    finally:
+        (scraping.playlist_url, scraping.requests_per_second,
+            scraping.parse_processes, sys.stdout) = settings
+        scraping.session.close()
+        site.stop()
+
+
+class TimedSession(httpsession.Session):
+    '''
+    Session that records how long each successful request takes to be
+    answered.
+    '''
+
+    def __init__(self):
+        httpsession.Session.__init__(self)
+        self.latencies = []
+
+    def open(self, url, data=None, headers=None):
+        start_time = time.time()
+        response = httpsession.Session.open(self, url, data, headers)
+        self.latencies.append(time.time() - start_time)
+        return response
+
+
+def percentile(values, fraction):
+    '''
+    Returns the value that the given fraction of the values are at or below.
+    '''
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def peak_rss():
+    '''
+    Returns the most memory this process has used so far, in MB, or None if
+    that can't be found out on this system.
+    '''
+    if resource is None:
+        return None
+    # Given in KB on Linux (and bytes on Mac OS X)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak / 1024.0
+
+
+def fill_database(location, num_songs):
+    '''
+    Fills a new database at the given location with num_songs made up songs,
+    and gathers the statistics sqlite uses to plan queries, as remake_all
+    does.  bench_resultset runs this in a separate process, so that making
+    the songs doesn't count towards the memory it measures.
+    '''
+    database.location = location
+    db = database.Database()
+    db.insert_songs(synthetic_songs(num_songs))
+    db.c.execute('analyze')
+    db.conn.commit()
+    db.conn.close()
+
+
+def bench_resultset(num_pages='50'):
+    '''
+    Compares showing query results by reading them all in with make_query
+    (as query used to) and with a ResultSet: the time until the first page
+    can be shown (including counting the songs), the time to go through some
+    pages one after another (with the next page fetched in the background
+    while each is looked at), and the peak memory use.  The ResultSets go
+    first, since peak memory use can only go up.
+    Arguments:
+        num_pages - Number of pages to go through.
+    '''
+    num_pages = int(num_pages)
+    page_size = resultset.page_size
+    queries = ['', 'order by rating desc', 'unrated order by duration asc']
+    for num_songs in catalog_sizes:
+        directory = tempfile.mkdtemp(prefix='anfo_bench')
+        old_location = database.location
+        try:
+            location = os.path.join(directory, 'data')
+            process = multiprocessing.Process(target=fill_database,
+                args=(location, num_songs))
+            process.start()
+            process.join()
+            # ResultSets open their own connections to the database
+            database.location = location
+            db = database.Database()
+            print '%d songs:' % num_songs
+            for name in ['ResultSet', 'make_query']:
+                for query in queries:
+                    sql = commands.clean_query(query)
+                    start_time = time.time()
+                    if name == 'ResultSet':
+                        songs = resultset.ResultSet(sql)
+                    else:
+                        songs = db.make_query(sql)
+                    songs[:page_size]
+                    num_found = len(songs)
+                    first_time = time.time() - start_time
+                    start_time = time.time()
+                    for page in xrange(1, num_pages):
+                        songs[page * page_size:(page + 1) * page_size]
+                        # Looking at the page
+                        time.sleep(0.005)
+                    paging_time = (time.time() - start_time) / \
+                        (num_pages - 1) - 0.005
+                    if name == 'ResultSet':
+                        songs.close()
+                    del songs
+                    rss = peak_rss()
+                    print '  %-10s %-32r first page %7.1f ms, next pages ' \
+                        '%5.2f ms, %6d songs, peak memory %s MB' % (name,
+                        query, 1000 * first_time, 1000 * paging_time,
+                        num_found, '?' if rss is None else '%.0f' % rss)
+            db.conn.close()
+        finally:
+            database.location = old_location
+            shutil.rmtree(directory)
+
+
+def bench_scrape(num_songs='18000', latency='0.02', jitter='0.01',
+    error_rate='0.01'):
+    '''
+    Runs scrape_all, scrape_favorites and queue_songs from start to finish
+    against a local FakeSite, reporting pages/second, page latency and peak
+    memory use for each.  The FakeSite runs in the same process, so the
+    memory use includes it.
+    Arguments:
+        num_songs - Number of songs in the site's catalog.
+        latency - Average number of seconds the site takes to answer.
+        jitter - Most number of seconds each answer's latency is off by.
+        error_rate - Fraction of requests the site fails.
+    '''
+    num_songs = int(num_songs)
+    songs = synthetic_songs(num_songs)
+    rand = random.Random(num_songs)
+    ids = [song.id for song in songs]
+    site = fakesite.FakeSite(songs=songs,
+        favorite_ids=sorted(rand.sample(ids, num_songs // 20)),
+        queued_ids=rand.sample(ids, min(20, num_songs)),
+        latency=float(latency), jitter=float(jitter),
+        error_rate=float(error_rate))
+    site.start()
+    directory = tempfile.mkdtemp(prefix='anfo_bench')
+    settings = (scraping.site_url, scraping.session, scraping.archive,
+        scraping.cache, scraping.cookies_loaded, scraping.requests_per_second,
+        scraping.retry_delay, database.location, sys.stdout)
+    try:
+        scraping.set_site_url(site.url)
+        # Only the site's limits should hold the scraper back
+        scraping.requests_per_second = 1e6
+        scraping.retry_delay = 0.1
+        # Keep everything the scraper saves out of the way
+        scraping.archive = pagearchive.Archive(os.path.join(directory,
+            'page_archive'))
+        scraping.cache = httpcache.Cache(os.path.join(directory, 'http_cache'),
+            scraping.cache_max_size)
+        scraping.cookies_loaded = True
+        database.location = os.path.join(directory, 'data')
+        db = database.Database()
+        print '%d songs, latency %ss +/- %ss, %s%% errors:' % (num_songs,
+            latency, jitter, 100 * float(error_rate))
+        for (name, run) in [
+            ('scrape_all', lambda: sum([len(page_songs) for
+                (_, _, page_songs) in scraping.scrape_all()])),
+            ('scrape_favorites', lambda: len(scraping.scrape_favorites())),
+            ('queue_songs', lambda: len(db.queue_songs()))]:
+            scraping.session = TimedSession()
+            # Log in to the site, so that login doesn't ask for a password
+            scraping.session.open(scraping.login_url, 'username=bench').read()
+            scraping.session.latencies = []
+            errors_before = site.num_errors
+            # Keep the scraper's progress messages out of the results
+            sys.stdout = open(os.devnull, 'w')
+            start_time = time.time()
+            num_found = run()
+            elapsed = time.time() - start_time
+            sys.stdout = settings[-1]
+            latencies = scraping.session.latencies
+            scraping.session.close()
+            rss = peak_rss()
+            print '  %-16s %5d pages (%d failed), %7.1f pages/sec, ' \
+                'p50 %6.1f ms, p99 %6.1f ms, peak RSS %s, %d songs' % (name,
+                len(latencies), site.num_errors - errors_before,
+                len(latencies) / elapsed, 1000 * percentile(latencies, 0.5),
+                1000 * percentile(latencies, 0.99),
+                'unknown' if rss is None else '%.1f MB' % rss, num_found)
+        db.conn.close()
+    finally:
+        (site_url, scraping.session, scraping.archive, scraping.cache,
+            scraping.cookies_loaded, scraping.requests_per_second,
+            scraping.retry_delay, database.location, sys.stdout) = settings
+        scraping.set_site_url(site_url)
+        site.stop()
+        shutil.rmtree(directory)
+
+
+# Benchmark name -> function running it
+benchmarks = {
+    'connections': bench_connections,
+    'favorites': bench_favorites,
+    'inserts': bench_inserts,
+    'memberships': bench_memberships,
+    'parse_processes': bench_parse_processes,
+    'parser': bench_parser,
+    'reader': bench_reader,
+    'resultset': bench_resultset,
+    'scrape': bench_scrape,
+    'search': bench_search,
+    'songs': bench_songs,
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print 'Benchmarks: %s' % ', '.join(sorted(benchmarks))
+    else:
+        benchmarks[sys.argv[1]](*sys.argv[2:])
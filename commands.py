@@ -6,13 +6,23 @@ This module is meant to be purely functional.
 
 import database
 import datetime
+import detailcrawler
 import math
+import queuewatcher
+import re
+import resultset
+import scraping
 import stats
 import time
 import urllib2
 
 # Special escape character in queries (this is a single backslash)
 escape_char = '\\'
+# Genre and tag membership syntax for queries, e.g. tag:'K-On!'.  String
+# literals are matched too, as a whole, so that the syntax is left alone
+# inside them (e.g. title like '%tag:''x''%').
+membership_pattern = re.compile(
+    r"(?<![\w.])(genre|tag):\s*('(?:[^']|'')*')|'(?:[^']|'')*'", re.IGNORECASE)
 
 # Daily request limit
 daily_request_limit = 18
@@ -20,6 +30,16 @@ daily_request_limit = 18
 # Number of minutes each request block lasts for
 block_minutes = 150
 
+# QueueWatcher checking the queue in the background, if watch_queue is on
+queue_watcher = None
+
+# DetailCrawler fetching song details in the background, if crawl_details is
+# on
+detail_crawler = None
+
+# Printed when remake_all stops partway through
+resume_msg = 'Use \'remake_all --resume\' to carry on from where it stopped.'
+
 
 # Some error classes
 class InvalidArgumentError(Exception):
@@ -83,6 +103,26 @@ def print_song_info(song):
         print 'This is not one of your favorite songs.'
 
 
+def current_queue(db):
+    '''
+    Returns the songs in the queue, from the background queue watcher's
+    snapshot if it's running, and otherwise from the site.
+    Arguments:
+        db - Database object
+    '''
+    songs = None
+    if queue_watcher is not None:
+        ids = queue_watcher.snapshot()
+        if ids is not None:
+            songs = db.get_song_infos(ids, fetch_missing=True)
+            # Leave out the songs that couldn't be scraped
+            songs = [song for song in songs if song is not None]
+    if songs is None:
+        songs = db.queue_songs()
+    prioritize_details(songs)
+    return songs
+
+
 def queue(db):
     '''
     Views the queue.
@@ -90,7 +130,7 @@ def queue(db):
         db - Database object
     '''
     try:
-        print_queue_results(db.queue_songs())
+        print_queue_results(current_queue(db))
     except urllib2.URLError, e:
         print 'Failed to connect to site.'
         print e
@@ -103,12 +143,92 @@ def queue_songs(db):
         db - Database object
     '''
     try:
-        return db.queue_songs()
+        return current_queue(db)
     except urllib2.URLError, e:
         print 'Failed to connect to site.'
         print e
 
 
+def watch_queue(command):
+    '''
+    Starts or stops checking the queue in the background, or says whether it
+    is being checked.
+    Arguments:
+        command - A string: 'on', 'off', or '' to show the status.
+    '''
+    global queue_watcher
+    command = command.strip()
+    if command == 'on':
+        if queue_watcher is None:
+            queue_watcher = queuewatcher.QueueWatcher()
+            queue_watcher.start()
+        print 'Watching the queue.'
+    elif command == 'off':
+        if queue_watcher is not None:
+            queue_watcher.stop()
+            queue_watcher = None
+        print 'Stopped watching the queue.'
+    elif command == '':
+        if queue_watcher is None:
+            print 'Not watching the queue.'
+        elif queue_watcher.error is not None:
+            print 'Last check of the queue failed: %s' % queue_watcher.error
+        else:
+            print 'Watching the queue, checking every %d seconds.' % \
+                queue_watcher.interval
+    else:
+        raise InvalidArgumentError('Invalid argument for command ' +
+            '\'watch_queue\': arguments should be \'on\' or \'off\'')
+
+
+def crawl_details(command, db):
+    '''
+    Starts or stops fetching the details of every song (year, times
+    requested and total favorites) in the background, or shows how far it
+    has got.
+    Arguments:
+        command - A string: 'on', 'off', or '' to show the progress.
+        db - Database object
+    '''
+    global detail_crawler
+    command = command.strip()
+    if command == 'on':
+        if detail_crawler is None:
+            detail_crawler = detailcrawler.DetailCrawler()
+            detail_crawler.start()
+        print 'Fetching song details in the background.'
+    elif command == 'off':
+        if detail_crawler is not None:
+            detail_crawler.stop()
+            detail_crawler = None
+        print 'Stopped fetching song details.'
+    elif command == '':
+        (num_done, num_songs) = db.details_progress()
+        print 'Songs with details: %d of %d.' % (num_done, num_songs)
+        if detail_crawler is None:
+            print 'Not fetching song details.'
+        else:
+            print 'Fetched %d songs since starting.' % \
+                detail_crawler.num_fetched
+            if detail_crawler.error is not None:
+                print 'Last error: %s' % detail_crawler.error
+    else:
+        raise InvalidArgumentError('Invalid argument for command ' +
+            '\'crawl_details\': arguments should be \'on\' or \'off\'')
+
+
+def prioritize_details(songs):
+    '''
+    Has the background detail crawler, if it's running, fetch the details of
+    the given songs next, since they're the ones being looked at.
+    Arguments:
+        songs - List of SongInfo.
+    '''
+    if detail_crawler is not None:
+        detail_crawler.prioritize([song.id for song in songs
+            if song is not None])
+
+
 def print_queue_results(songs):
     '''
     Prints the songs in the queue in a nice format.
@@ -158,20 +278,40 @@ def print_queue_results(songs):
 
 def query(command, db):
     '''
-    Makes a query, returning a list of songs
+    Makes a query, returning a ResultSet of songs, which fetches them from
+    the database as they're looked at
     Arguments:
         command - String of the form '(query)'
         db - Database object
     '''
     command = clean_query(command)
     print 'Making query: ', command
-    return db.make_query(command)
+    songs = resultset.ResultSet(command)
+    db.log_query(command)
+    return songs
+
+
+def search(command, db):
+    '''
+    Searches the titles, artists, albums and tags of every song for some
+    words, returning a list of the songs with all of them, best match first.
+    Arguments:
+        command - String of the form '(words)'
+        db - Database object
+    '''
+    if command.strip() == '':
+        raise InvalidArgumentError('Invalid argument for command ' +
+            '\'search\': give the words to search for')
+    songs = db.search(command)
+    prioritize_details(songs)
+    return songs
 
 
 def clean_query(command):
     '''
     Cleans a command used for selecting from the database.
     Has keywords 'rated', 'unrated', 'fav', 'nofav'
+    and special syntax genre:'(genre)' and tag:'(tag)'
     Arguments:
         command - String of the form '(query)'
     '''
@@ -195,6 +335,9 @@ def clean_query(command):
     for keyword in ['unrated', 'rated', 'fav', 'nofav', escape_char]:
         command = command.replace(escape_char + keyword, keyword)
 
+    # Genre and tag special syntax, looked up in the genre and tag tables
+    command = membership_pattern.sub(membership_sql, command)
+
     # If we aren't searching for anything in particular, we currently have a
     # string that looks like 'select * from songs where (order by ...)
     # so just get rid of where
@@ -203,6 +346,22 @@ def clean_query(command):
     return command
 
 
+def membership_sql(match):
+    '''
+    Turns a genre or tag special syntax match (see membership_pattern), e.g.
+    tag:'K-On!', into SQL selecting the songs with that genre or tag.  String
+    literals are given back unchanged.
+    '''
+    (column, value) = match.groups()
+    if column is None:
+        return match.group(0)
+    column = column.lower()
+    for (attribute, membership_column, table) in database.memberships():
+        if membership_column == column:
+            return 'id in (select id from %s where %s=%s)' % (table, column,
+                value)
+
+
 def print_stats(songs):
     '''
     Prints some basic statistics about the given songs, based on user
@@ -358,31 +517,86 @@ def delete_song(command, db):
     db.remove_song(id)
 
 
-def remake_all(db):
+def remake_all(command, db):
     '''
     Remakes the entire database.
+    Arguments:
+        command - Either '' or '--resume', to carry on with a remake that
+                  was interrupted.
+        db - Database object
+    '''
+    command = command.split()
+    if command not in [[], ['--resume']]:
+        raise InvalidArgumentError('Invalid argument for command ' +
+            '\'remake_all\': the only argument allowed is \'--resume\'')
+    resume = command == ['--resume']
+    if not resume:
+        print 'Scraping the entire song database will take a while ' +\
+        'and use a lot of animenfo\'s bandwidth.  Don\'t do this ' +\
+        'frequently, please. Proceed? (Y/N)'
+        proceed = raw_input()
+        if proceed != 'Y':
+            return
+    try:
+        start_time = time.time()
+        db.remake_all(resume)
+        end_time = time.time()
+        print 'Time taken: %g seconds' % (end_time - start_time)
+    except urllib2.URLError, e:
+        print 'Failed to connect to site.'
+        print e
+        print resume_msg
+    except KeyboardInterrupt:
+        print
+        print 'Interrupted.'
+        print resume_msg
+    # TODO: Bad style to catch any exception
+    except Exception, e:
+        print e
+        print 'Error in scraping.  Do you have an internet ' +\
+            'connection right now?  If so, try again, and if it ' +\
+            'doesn\'t work you may have found a bug ^^'
+        print resume_msg
+
+
+def refresh(db):
+    '''
+    Updates the database with the songlist pages that have changed since they
+    were last scraped.
+    Arguments:
+        db - Database object
+    '''
+    try:
+        start_time = time.time()
+        db.refresh()
+        end_time = time.time()
+        print 'Time taken: %g seconds' % (end_time - start_time)
+    except urllib2.URLError, e:
+        print 'Failed to connect to site.'
+        print e
+    # TODO: Bad style to catch any exception
+    except Exception, e:
+        print e
+        print 'Error in refreshing the database.  Make sure you have an ' +\
+            'internet connection, or report error for bug-fixing :).'
+
+
+def reparse(db):
+    '''
+    Remakes the database from the archived pages of the site.
     Arguments:
         db - Database object
     '''
-    print 'Scraping the entire song database will take a while ' +\
-    'and use a lot of animenfo\'s bandwidth.  Don\'t do this ' +\
-    'frequently, please. Proceed? (Y/N)'
-    proceed = raw_input()
-    if proceed == 'Y':
-        try:
-            start_time = time.time()
-            db.remake_all()
-            end_time = time.time()
-            print 'Time taken: %g seconds' % (end_time - start_time)
-        except urllib2.URLError, e:
-            print 'Failed to connect to site.'
-            print e
-        # TODO: Bad style to catch any exception
-        except Exception, e:
-            print e
-            print 'Error in scraping.  Do you have an internet ' +\
-                'connection right now?  If so, try again, and if it ' +\
-                'doesn\'t work you may have found a bug ^^'
+    try:
+        start_time = time.time()
+        db.reparse()
+        end_time = time.time()
+        print 'Time taken: %g seconds' % (end_time - start_time)
+    # TODO: Bad style to catch any exception
+    except Exception, e:
+        print e
+        print 'Error in reparsing the archived pages.  The database has ' +\
+            'been left as it was.'
 
 
 def update_favorites(db):
@@ -437,6 +651,68 @@ def update_song(command, db):
         db.set_favorite(song.id, song.user_favorite)
 
 
+def print_http_stats():
+    '''
+    Prints statistics on the connections used to fetch pages from the site.
+    '''
+    session_stats = scraping.session.stats()
+    print 'Requests made: %d' % session_stats['requests']
+    print 'Connections opened: %d' % session_stats['connections']
+    print 'Requests reusing a connection: %.1f%%' % \
+        (100 * session_stats['reuse_ratio'])
+
+
+def print_cache_stats():
+    '''
+    Prints statistics on the local cache of pages from the site.
+    '''
+    cache_stats = scraping.cache.stats()
+    fetches = cache_stats['hits'] + cache_stats['revalidations'] + \
+        cache_stats['misses']
+    print 'Pages fetched: %d' % fetches
+    print 'Cache hits: %d' % cache_stats['hits']
+    print 'Unchanged since cached: %d' % cache_stats['revalidations']
+    print 'Cache misses: %d' % cache_stats['misses']
+    print 'Pages cached: %d (%.1f MB)' % (cache_stats['pages'],
+        cache_stats['size'] / 1e6)
+
+
+def index_advice(command, db):
+    '''
+    Shows which of the queries made so far read the whole songs table, and
+    which indexes would let them avoid it, creating those indexes if asked.
+    Arguments:
+        command - Either '' or '--create', to create the suggested indexes.
+        db - Database object
+    '''
+    command = command.split()
+    if command not in [[], ['--create']]:
+        raise InvalidArgumentError('Invalid argument for command ' +
+            '\'index_advice\': the only argument allowed is \'--create\'')
+    advice = db.index_advice()
+    if not advice:
+        print 'None of the queries made so far read the whole table.'
+        return
+    suggestions = []
+    for (sql, times_run, scans, definitions) in advice:
+        print sql
+        print '    Run %d times, reads the whole table (%s)' % (times_run,
+            ', '.join(scans))
+        if definitions:
+            print '    Would use an index on: ' + '; '.join(definitions)
+        else:
+            print '    No index would help'
+        suggestions.extend([definition for definition in definitions
+            if definition not in suggestions])
+    if not suggestions:
+        return
+    if command == ['--create']:
+        for definition in suggestions:
+            print 'Created index %s' % db.create_index(definition)
+    else:
+        print 'Run \'index_advice --create\' to create the suggested indexes.'
+
+
 def request():
     '''
     Adds a request (and the current time) to the list of requests made.
@@ -3,14 +3,350 @@ Contains the Database class, which handles everything dealing with the sqlite
 database.
 '''
 
+import array
+import operator
+import re
 import scraping
 import songinfo
 import sqlite3
+import time
 
 # Location the database will be stored
 location = './data'
 table_name = 'songs'
-delimiter_char = '@'
+# Table that remake_all scrapes into before it replaces the songs table
+rebuild_table_name = 'songs_rebuild'
+# Table giving the fingerprint of each songlist page when it was last scraped,
+# so that refresh can tell which pages have changed (see scraping.fetch_page),
+# and the ids of the songs that were on it
+fingerprint_table_name = 'page_fingerprints'
+rebuild_fingerprint_table_name = 'page_fingerprints_rebuild'
+# Character separating the song ids of a page in the fingerprint table
+page_ids_delimiter = ','
+# Temporary table that set_favorites loads the favorite ids into
+favorites_table_name = 'favorite_ids'
+# Tables listing the genres and tags of each song, one row per song and genre
+# (or tag), so that the songs with a given genre or tag can be looked up by
+# index instead of matching a pattern against every song's delimited string.
+# Given as (SongInfo attribute, column, table kept alongside the songs table,
+# table kept alongside the rebuild table).
+membership_tables = [
+    ('genres', 'genre', 'song_genres', 'song_genres_rebuild'),
+    ('tags', 'tag', 'song_tags', 'song_tags_rebuild')]
+# Table of the queries made with 'query', for index_advice to look through
+query_log_table_name = 'query_log'
+# Most queries kept in the query log; the least recently run are thrown out
+max_logged_queries = 200
+delimiter_char = songinfo.delimiter_char
+# Most parameters sqlite allows in a single statement
+max_variables = 999
+# Number of scraped pages to write between commits when populating
+pages_per_commit = 10
+# PRAGMA settings used while remaking the whole database.  Write-ahead logging,
+# fewer fsyncs and a cache of around 64MB make bulk loading much faster.
+fast_load_pragmas = [('journal_mode', 'wal'), ('synchronous', 'normal'),
+    ('cache_size', -64000)]
+
+# Columns of the songs table, in the order song_to_row gives them
+columns = ['id', 'artist', 'title', 'album', 'year', 'genres', 'rating',
+    'total_rates', 'duration', 'tags', 'user_rating', 'user_favorite',
+    'times_requested', 'total_favorites']
+# Columns only found on individual song pages, not the songlist, along with
+# when the song's page was last scraped for them (null if it never has been)
+detail_columns = ['year', 'times_requested', 'total_favorites',
+    'details_fetched']
+# Column definitions, for creating the songs table and adding any columns
+# missing from older databases
+column_types = [('id', 'integer not null unique'), ('artist', 'varchar(255)'),
+    ('title', 'varchar(255)'), ('album', 'varchar(255)'), ('year', 'int'),
+    ('genres', 'varchar(255)'), ('rating', 'real'),
+    ('total_rates', 'integer'), ('duration', 'integer'),
+    ('tags', 'varchar(255)'), ('user_rating', 'integer'),
+    ('user_favorite', 'boolean'), ('times_requested', 'integer'),
+    ('total_favorites', 'integer'), ('details_fetched', 'real')]
+# Indexes on the songs table, given by the columns they're on, covering the
+# columns the usual queries (see README.txt) filter and sort on.  The artist
+# index with nocase collation is the one 'like' can use for prefix searches
+# (e.g. artist like 'Hi%'), and the details_fetched one is for
+# songs_without_details.
+indexes = ['artist', 'artist collate nocase', 'album', 'rating',
+    'total_rates', 'duration', 'user_rating', 'user_favorite',
+    'details_fetched, id']
+# Full-text search index of the songs table, used by search, and the columns
+# it covers.  It's kept up to date by triggers on the songs table, except
+# while refresh writes to it (see drop_search_triggers).
+search_table_name = 'songs_fts'
+search_columns = ['title', 'artist', 'album', 'tags']
+search_trigger_names = [search_table_name + '_' + event
+    for event in ['insert', 'delete', 'update']]
+# Temporary table of the ids of the songs whose search index entries are
+# being filled in again (see refill_search_index)
+refill_table_name = 'search_refill'
+# Name of the index index_advice creates to try out an index
+trial_index_name = 'index_advice_trial'
+# Insert statement, still needing the name of the table to insert into
+insert_sql = 'insert or replace into %%s (%s) values (%s)' % (
+    ', '.join(columns), ', '.join(['?'] * len(columns)))
+# Columns that the songlist pages give, and so get updated by update_songs
+songlist_columns = [column for column in columns if column not in
+    detail_columns + ['id', 'user_favorite']]
+# Statements used by update_songs, still needing the name of the table: one
+# updating the songlist columns of a song, taking their values then the id,
+# and one adding a song only if it isn't there yet, taking the same values as
+# insert_sql
+update_sql = 'update %%s set %s where id=?' % ', '.join(['%s=?' % column
+    for column in songlist_columns])
+insert_new_sql = insert_sql.replace('insert or replace', 'insert or ignore')
+# Statement used by store_details, taking the values of detail_columns then
+# the id
+details_sql = 'update %%s set %s where id=?' % ', '.join(['%s=?' % column
+    for column in detail_columns])
+
+
+def to_unicode(text):
+    '''
+    Decodes scraped (utf-8) byte strings, since sqlite3 refuses to bind
+    non-ascii byte strings as parameters.  Anything else is returned as is.
+    '''
+    if isinstance(text, str):
+        return text.decode('utf-8', 'replace')
+    return text
+
+
+def index_name(definition):
+    '''
+    Returns the name of the songs table index on the given columns, e.g.
+    songs_artist_collate_nocase for 'artist collate nocase'.
+    '''
+    return table_name + '_' + re.sub(r'\W+', '_', definition)
+
+
+def index_sql(definition):
+    '''
+    Returns the statement creating the songs table index on the given
+    columns, if it doesn't exist.
+    '''
+    return 'create index if not exists %s on %s (%s)' % (
+        index_name(definition), table_name, definition)
+
+
+def memberships(table=table_name):
+    '''
+    Returns (SongInfo attribute, column, table name) for each of the genre
+    and tag tables kept alongside the given songs table (see
+    membership_tables).
+    '''
+    if table == rebuild_table_name:
+        return [(attribute, column, rebuild_name) for (attribute, column,
+            name, rebuild_name) in membership_tables]
+    return [(attribute, column, name) for (attribute, column, name,
+        rebuild_name) in membership_tables]
+
+
+def membership_index_sql(membership_table, column):
+    '''
+    Returns the statement creating the index used to look up the songs with
+    a given genre or tag, if it doesn't exist.
+    '''
+    return 'create index if not exists %s_%s on %s (%s, id)' % (
+        membership_table, column, membership_table, column)
+
+
+def page_ids_to_string(ids):
+    '''
+    Returns the ids of the songs on a songlist page as kept in the
+    fingerprint table, or None if they aren't known.
+    '''
+    if ids is None:
+        return None
+    return page_ids_delimiter.join([str(id) for id in ids])
+
+
+def page_ids_from_string(ids_str):
+    '''
+    Returns the list of song ids kept in the fingerprint table for a page.
+    '''
+    return [int(id) for id in ids_str.split(page_ids_delimiter) if id]
+
+
+def search_index_sql(module):
+    '''
+    Returns the statements creating the full-text search index (see
+    search_table_name), filling it in from the songs table, and creating the
+    triggers that keep it up to date as songs are added, changed and
+    removed.
+    Arguments:
+        module - sqlite module to make the index with: 'fts5', or 'fts4' if
+                 sqlite doesn't have fts5.
+    '''
+    names = {'fts': search_table_name, 'songs': table_name,
+        'columns': ', '.join(search_columns)}
+    return [sql % names for sql in [
+        'create virtual table %(fts)s using ' + module + ' (%(columns)s)',
+        'insert into %(fts)s (rowid, %(columns)s) select id, %(columns)s from '
+        '%(songs)s']] + search_trigger_sql()
+
+
+def search_trigger_sql():
+    '''
+    Returns the statements creating the triggers that keep the full-text
+    search index up to date as songs are added, changed and removed (see
+    search_trigger_names).
+    '''
+    names = {'fts': search_table_name, 'songs': table_name,
+        'columns': ', '.join(search_columns),
+        'new_values': ', '.join(['new.' + column
+            for column in search_columns])}
+    # The songs table is changed with 'insert or replace', which doesn't fire
+    # the delete trigger, so the index replaces any entry the song had too
+    insert = 'insert or replace into %(fts)s (rowid, %(columns)s) values ' + \
+        '(new.id, %(new_values)s);'
+    delete = 'delete from %(fts)s where rowid=old.id;'
+    (insert_name, delete_name, update_name) = search_trigger_names
+    return [sql % names for sql in [
+        'create trigger if not exists ' + insert_name + ' after insert on '
+        '%(songs)s begin ' + insert + ' end',
+        'create trigger if not exists ' + delete_name + ' after delete on '
+        '%(songs)s begin ' + delete + ' end',
+        'create trigger if not exists ' + update_name + ' after update of id, '
+        '%(columns)s on %(songs)s begin ' + delete + ' ' + insert + ' end']]
+
+
+def search_query(text, module):
+    '''
+    Turns the words to search for into a full-text search query matching
+    the songs that have all of them, where each word also matches the words
+    starting with it (e.g. 'sakamo' matches 'Sakamoto').
+    Arguments:
+        text - Words to search for, separated by spaces.
+        module - sqlite module the search index uses (see search_index_sql).
+    '''
+    if module == 'fts5':
+        prefix = '"%s" *'
+    else:
+        prefix = '"%s*"'
+    return ' '.join([prefix % word.replace('"', '""')
+        for word in text.split()])
+
+
+def fts4_rank(matchinfo):
+    '''
+    Ranks a search result when the search index uses fts4, which has no
+    ranking of its own: for each word searched for, in each column, adds the
+    fraction of all of the word's occurrences that are in this song.
+    Arguments:
+        matchinfo - fts4 matchinfo blob, in 'pcx' format.
+    '''
+    info = array.array('I', str(matchinfo))
+    (num_phrases, num_columns) = (info[0], info[1])
+    score = 0.0
+    for i in xrange(num_phrases * num_columns):
+        (hits, total_hits) = (info[2 + 3 * i], info[3 + 3 * i])
+        if hits > 0:
+            score += float(hits) / total_hits
+    return score
+
+
+def full_scans(plan):
+    '''
+    Returns the steps of a query plan (as given by Database.query_plan) that
+    read the whole songs table without using an index.
+    '''
+    return [detail for detail in plan if re.match(r'SCAN (TABLE )?%s\b' %
+        table_name, detail) and 'USING' not in detail]
+
+
+def index_candidates(sql):
+    '''
+    Returns the columns of the songs table that an index might help the
+    given query with, as index definitions (see indexes), in the order they
+    appear: those compared with =, <, >, between, in or is, those matched
+    against a pattern that doesn't start with a wildcard (which need nocase
+    collation, as 'like' ignores case), and the column sorted on.
+    '''
+    names = '|'.join([column for (column, column_type) in column_types])
+    candidates = []
+    for match in re.finditer(r'\b(%s)\s*(?:[=<>]|between\b|in\b|is\b)|'
+        r"\b(%s)\s+like\s+'[^%%_]|order by\s+(%s)\b" % (names, names, names),
+        sql, re.IGNORECASE):
+        (compared, matched, sorted_on) = match.groups()
+        if matched is not None:
+            definition = matched.lower() + ' collate nocase'
+        else:
+            definition = (compared or sorted_on).lower()
+        if definition not in candidates:
+            candidates.append(definition)
+    return candidates
+
+
+def connect(check_same_thread=True):
+    '''
+    Opens a new connection to the database, set up the way the rest of the
+    program expects: rows come back as sqlite3.Row objects, and the extra
+    functions queries can use are defined.
+    Arguments:
+        check_same_thread - Whether sqlite3 should refuse to let threads
+                            other than the one opening the connection use it.
+                            Connections shared between threads need a lock.
+    '''
+    conn = sqlite3.connect(location, check_same_thread=check_same_thread)
+    # Return Row objects rather than tuples in response to queries
+    conn.row_factory = sqlite3.Row
+    conn.create_function('reverse', 1, lambda s: str(s)[::-1])
+    conn.create_function('fts4_rank', 1, fts4_rank)
+    return conn
+
+
+def song_row_factory(description):
+    '''
+    Returns a row factory (see sqlite3's Connection.row_factory) that makes
+    a SongInfo straight out of each row of a query on the songs table,
+    without making a sqlite3.Row first.  Genres and tags are only split up
+    once they're used (see SongInfo.from_stored).
+    Arguments:
+        description - Description of the query's columns, as given by the
+                      cursor it was run on.  The columns can be in any order,
+                      and can include others besides those of the songs
+                      table.
+    '''
+    names = [column[0] for column in description]
+    get_values = operator.itemgetter(*[names.index(column)
+        for column in columns])
+    from_stored = songinfo.SongInfo.from_stored
+
+    def make_song(cursor, row):
+        values = get_values(row)
+        # Songs whose details haven't been fetched have nulls for them
+        if values[-2] is None or values[-1] is None:
+            values = values[:-2] + (values[-2] or 0, values[-1] or 0)
+        return from_stored(values)
+    return make_song
+
+
+def fetch_songs(cursor):
+    '''
+    Returns a list of SongInfo for the rest of the rows given by a query on
+    the songs table.
+    Arguments:
+        cursor - Cursor the query was run on.  Only gives SongInfo from
+                 then on.
+    '''
+    cursor.row_factory = song_row_factory(cursor.description)
+    return cursor.fetchall()
+
+
+def song_to_row(song):
+    '''
+    Converts a SongInfo into a tuple of values, in the order of 'columns'.
+    '''
+    # Convert genres and tags back into a delimited string
+    genres = delimiter_char.join(song.genres)
+    tags = delimiter_char.join(song.tags)
+    return (song.id, to_unicode(song.artist), to_unicode(song.title),
+        to_unicode(song.album), song.year, to_unicode(genres), song.rating,
+        song.total_rates, song.duration, to_unicode(tags), song.user_rating,
+        int(song.user_favorite), song.times_requested, song.total_favorites)
+
 
 class Database:
     '''
@@ -32,45 +368,267 @@ class Database:
     tags: varchar, tags of song separated by bars (|)
     user_rating: integer, rating for this user (you) (0-10), 0 for not-rated
     user_favorite: boolean, represented as 0 or 1
+    times_requested: integer, number of times the song has been requested
+    total_favorites: integer, number of people with the song as a favorite
+    details_fetched: real, time the song's own page was last scraped for the
+        year, times_requested and total_favorites (which the songlist doesn't
+        give), or null if it hasn't been yet
+
+    Genre and tag tables:
+    song_genres, song_tags
+
+    Columns:
+    id: integer, id of the song
+    genre (or tag): varchar, one of the song's genres (or tags)
     '''
-    ### TODO: Add requested info
-    ### TODO: Year isn't accurate (have to scrape individual song pages)
-    ### TODO: Add total user favs
-    ### TODO: Add total fav block
 
     def __init__(self):
         '''
         Establishes the database connection.  If it doesn't exist, then the
         database is created.
         '''
-        self.conn = sqlite3.connect(location)
-        # Return Row objects rather than tuples in response to queries
-        self.conn.row_factory = sqlite3.Row
+        self.conn = connect()
         self.c = self.conn.cursor()
         self.create_database()
+        self.create_fingerprint_table()
+        self.create_query_log()
+        self.create_membership_tables()
+        self.create_indexes()
+        self.create_search_index()
         self.conn.commit() # Should commit after everything a user can call
 
-        self.conn.create_function('reverse', 1, lambda s: str(s)[::-1])
 
 
-
-    def create_database(self):
+    def create_database(self, table=table_name):
         '''
         Creates the database.
+        Arguments:
+            table - Name of the table to create, if not the songs table.
         '''
-        sql = '''create table if not exists ''' + table_name +\
-        ''' (id integer not null unique, artist
-        varchar(255), title varchar(255), album varchar(255), year int,
-        genres varchar(255), rating real, total_rates integer, duration integer,
-        tags varchar(255), user_rating integer, user_favorite boolean)'''
+        sql = '''create table if not exists ''' + table + ''' (%s)''' % \
+            ', '.join(['%s %s' % column for column in column_types])
         self.c.execute(sql)
+        # Databases made by older versions are missing some of the columns
+        self.c.execute('pragma table_info(%s)' % table)
+        existing = set([result['name'] for result in self.c.fetchall()])
+        for (column, column_type) in column_types:
+            if column not in existing:
+                self.c.execute('alter table %s add column %s %s' % (table,
+                    column, column_type))
         self.conn.commit() # Kind of important that it exists
         # Need to reconnect after creating a table
-        self.conn = sqlite3.connect(location)
-        # Return Row objects rather than tuples in response to queries
-        self.conn.row_factory = sqlite3.Row
+        self.conn = connect()
         self.c = self.conn.cursor()
 
+    def create_fingerprint_table(self, table=fingerprint_table_name):
+        '''
+        Creates the table of songlist page fingerprints.
+        Arguments:
+            table - Name of the table to create, if not the usual one.
+        '''
+        sql = 'create table if not exists ' + table + ''' (url varchar(255)
+        primary key, digest varchar(32), etag varchar(255), last_modified
+        varchar(255), song_ids text)'''
+        self.c.execute(sql)
+        # Tables made before the song ids were kept don't have them
+        self.c.execute('pragma table_info(' + table + ')')
+        if 'song_ids' not in [result['name'] for result in self.c.fetchall()]:
+            self.c.execute('alter table ' + table + ' add column song_ids text')
+        self.conn.commit()
+
+
+    def create_membership_tables(self, table=table_name):
+        '''
+        Creates the tables of the genres and tags of each song (see
+        membership_tables).  If they're new, they're filled in from the songs
+        already in the songs table.
+        Arguments:
+            table - Name of the songs table they're kept alongside, either
+                    the songs table or the rebuild table.
+        '''
+        filled = True
+        for (attribute, column, name) in memberships(table):
+            if not self.table_exists(name):
+                filled = False
+            # Case doesn't matter when looking up genres and tags, as with
+            # 'like'
+            self.c.execute('create table if not exists %s (id integer not ' %
+                name + 'null, %s varchar(255) not null collate nocase, ' %
+                column + 'primary key (id, %s))' % column)
+        self.conn.commit()
+        if not filled and table == table_name:
+            songs = fetch_songs(self.conn.execute('select * from ' + table))
+            self.write_memberships(songs, table)
+            self.conn.commit()
+
+
+    def write_memberships(self, songs, table=table_name):
+        '''
+        Replaces the genres and tags of the given songs in the genre and tag
+        tables (see membership_tables).  Doesn't commit.
+        Arguments:
+            songs - List of SongInfo.
+            table - Name of the songs table the songs are in.
+        '''
+        ids = [(song.id,) for song in songs]
+        for (attribute, column, name) in memberships(table):
+            self.c.executemany('delete from %s where id=?' % name, ids)
+            self.c.executemany('insert or ignore into %s (id, %s) values ' %
+                (name, column) + '(?, ?)', [(song.id, to_unicode(value))
+                for song in songs for value in getattr(song, attribute)
+                if value])
+
+
+    def create_search_index(self):
+        '''
+        Creates the full-text search index of the songs table (see
+        search_index_sql), if it doesn't exist yet.  It's made again if its
+        triggers are missing, since then it can't be trusted (e.g. refresh
+        was killed before it could put them back).
+        '''
+        if not self.table_exists(search_table_name):
+            self.execute_atomically(search_index_sql(self.search_module()))
+            return
+        sql = 'select count(*) from sqlite_master where type=? and name in ' + \
+            '(%s)' % ', '.join(['?'] * len(search_trigger_names))
+        self.c.execute(sql, ['trigger'] + search_trigger_names)
+        if self.c.fetchone()[0] == len(search_trigger_names):
+            return
+        module = self.search_module()
+        self.execute_atomically(['drop table ' + search_table_name] +
+            ['drop trigger if exists ' + name for name in
+            search_trigger_names] + search_index_sql(module))
+
+
+    def drop_search_triggers(self):
+        '''
+        Drops the triggers keeping the search index up to date, before writing
+        many songs at once: filling in the index for all of them afterwards
+        with refill_search_index, which puts the triggers back, is much
+        quicker than the triggers doing it one song at a time.
+        Returns the highest rowid in the songs table, which refill_search_index
+        needs to find the songs that other connections (e.g. the queue
+        watcher's) add while the triggers are gone.
+        '''
+        self.execute_atomically(['drop trigger if exists ' + name
+            for name in search_trigger_names])
+        self.c.execute('select max(rowid) from ' + table_name)
+        return self.c.fetchone()[0] or 0
+
+
+    def refill_search_index(self, ids, last_rowid):
+        '''
+        Fills in the search index entries of the given songs again, from the
+        songs table, and puts back the triggers dropped by
+        drop_search_triggers, in a single transaction.  The triggers are left
+        alone if another connection has put them back already.
+        Arguments:
+            ids - Collection of the ids of the songs written since the
+                  triggers were dropped.
+            last_rowid - Highest rowid in the songs table when the triggers
+                         were dropped, as returned by drop_search_triggers.
+                         Songs added since then have higher rowids ('insert
+                         or replace' gives a replaced song a new one too), so
+                         they're filled in as well.
+        '''
+        self.c.execute('create temp table if not exists ' + refill_table_name +
+            ' (id integer primary key)')
+        self.c.execute('delete from ' + refill_table_name)
+        self.c.executemany('insert or ignore into ' + refill_table_name +
+            ' (id) values (?)', [(id,) for id in ids])
+        self.c.execute('insert or ignore into ' + refill_table_name +
+            ' (id) select id from ' + table_name + ' where rowid>?',
+            (last_rowid,))
+        names = {'fts': search_table_name, 'songs': table_name,
+            'refill': refill_table_name,
+            'columns': ', '.join(search_columns)}
+        self.execute_atomically([sql % names for sql in [
+            'delete from %(fts)s where rowid in (select id from %(refill)s)',
+            'insert into %(fts)s (rowid, %(columns)s) select id, %(columns)s '
+            'from %(songs)s where id in (select id from %(refill)s)',
+            'delete from %(refill)s']] + search_trigger_sql())
+
+
+    def search_module(self):
+        '''
+        Returns the sqlite module the search index uses, or should use if it
+        doesn't exist yet: 'fts5', or 'fts4' if sqlite doesn't have fts5.
+        '''
+        self.c.execute('select sql from sqlite_master where name=?',
+            (search_table_name,))
+        result = self.c.fetchone()
+        if result is not None:
+            if 'fts4' in result['sql'].lower():
+                return 'fts4'
+            return 'fts5'
+        try:
+            self.c.execute('create virtual table temp.search_module_check ' +
+                'using fts5 (text)')
+        except sqlite3.OperationalError:
+            return 'fts4'
+        self.c.execute('drop table temp.search_module_check')
+        return 'fts5'
+
+
+    def create_query_log(self):
+        '''
+        Creates the table of queries made (see log_query).
+        '''
+        sql = 'create table if not exists ' + query_log_table_name + \
+            ' (sql text primary key, times_run integer, last_run real)'
+        self.c.execute(sql)
+        self.conn.commit()
+
+
+    def create_indexes(self):
+        '''
+        Creates any of the default indexes (see indexes) that the songs table
+        doesn't have yet, and has sqlite gather the statistics it uses to
+        choose between them.
+        '''
+        self.c.execute('select name from sqlite_master where type=? and ' +
+            'tbl_name=?', ('index', table_name))
+        existing = set([result['name'] for result in self.c.fetchall()])
+        missing = [definition for definition in indexes
+            if index_name(definition) not in existing]
+        for (attribute, column, name) in memberships():
+            self.c.execute(membership_index_sql(name, column))
+        if not missing:
+            self.conn.commit()
+            return
+        for definition in missing:
+            self.c.execute(index_sql(definition))
+        self.c.execute('analyze ' + table_name)
+        self.conn.commit()
+
+
+    def get_fingerprints(self):
+        '''
+        Returns a dictionary mapping songlist page urls to the fingerprint
+        (see scraping.fetch_page) each page had when it was last scraped.
+        '''
+        sql = 'select * from ' + fingerprint_table_name
+        self.c.execute(sql)
+        fingerprints = {}
+        for result in self.c.fetchall():
+            fingerprints[result['url']] = (result['digest'], result['etag'],
+                result['last_modified'])
+        return fingerprints
+
+
+    def get_page_song_ids(self):
+        '''
+        Returns a dictionary mapping songlist page urls to the list of ids of
+        the songs that were on each page when it was last scraped.  Pages
+        scraped before the ids were kept are left out.
+        '''
+        sql = 'select url, song_ids from ' + fingerprint_table_name + \
+            ' where song_ids is not null'
+        self.c.execute(sql)
+        return dict([(result['url'], page_ids_from_string(result['song_ids']))
+            for result in self.c.fetchall()])
+
+
     def clear_database(self):
         '''
         Clears the database.
@@ -78,6 +636,9 @@ class Database:
         print 'Clearing database...'
         sql = 'drop table ' + table_name
         self.c.execute(sql)
+        for (attribute, column, name) in memberships():
+            self.c.execute('drop table ' + name)
+        self.c.execute('drop table ' + search_table_name)
         self.conn.commit() # Important that it's gone
 
 
@@ -87,21 +648,47 @@ class Database:
         Returns None if no such song with that id exists.
         Input 'id' should be an integer.
         '''
-        # Fetch the result of the query
-        sql = '''select * from songs where id=%d''' % id
-        self.c.execute(sql)
-        result = self.c.fetchone()
-        if result is None:
-            return None
-        # Convert into a SongInfo -_-
-        # Need to convert genres and tags into lists of strings
-        song = songinfo.SongInfo(result['id'], result['artist'],
-            result['title'], result['album'], result['year'],
-            result['genres'].split(delimiter_char), result['rating'],
-            result['total_rates'], result['duration'],
-            result['tags'].split(delimiter_char), result['user_rating'],
-            result['user_favorite'])
-        return song
+        return self.get_song_infos([id])[0]
+
+
+    def get_song_infos(self, ids, fetch_missing=False, quiet=False):
+        '''
+        Gets the SongInfo for many songs in the database at once, returning
+        a list in the same order as the ids.  Songs that aren't in the
+        database are given as None, unless fetch_missing is True, in which
+        case only the songs that couldn't be scraped are.
+        Arguments:
+            ids - List of integer ids of the songs to get.
+            fetch_missing - Whether to scrape the songs that aren't in the
+                            database (all at once), and add them to it.
+            quiet - Whether to scrape without printing anything.
+        '''
+        found = {}
+        # Look up as many ids at a time as sqlite allows
+        for i in xrange(0, len(ids), max_variables):
+            batch = ids[i:i + max_variables]
+            sql = 'select * from ' + table_name + ' where id in (%s)' % \
+                ', '.join(['?'] * len(batch))
+            for song in fetch_songs(self.conn.execute(sql, batch)):
+                found[song.id] = song
+        missing = [id for id in set(ids) if id not in found]
+        if fetch_missing and missing:
+            message = None
+            if not quiet:
+                print 'Adding %d new songs...' % len(missing)
+                message = 'Fetching song %d'
+            # One song that can't be scraped shouldn't lose the others
+            failures = []
+            new_songs = [song for (id, song) in
+                scraping.get_songs(missing, message, failures)]
+            if not quiet:
+                for error in failures:
+                    print error
+            self.insert_songs(new_songs)
+            self.store_details(new_songs)
+            for song in new_songs:
+                found[song.id] = song
+        return [found.get(id) for id in ids]
 
 
     def insert_song(self, song):
@@ -109,39 +696,140 @@ class Database:
         Inserts a new song into the database, given a SongInfo object.
         If a song with the same id already exists in the database, that song
         is replaced by the song being inserted.
+        Doesn't commit; use insert_songs to add many songs at once.
+        '''
+        self.c.execute(insert_sql % table_name, song_to_row(song))
+        self.write_memberships([song])
+
+
+    def insert_songs(self, songs, table=table_name):
+        '''
+        Inserts many songs into the database at once, given an iterable of
+        SongInfo objects, and commits them as a single transaction.
+        As with insert_song, existing songs with the same ids are replaced.
+        Arguments:
+            songs - Iterable of SongInfo to insert.
+            table - Name of the table to insert into, if not the songs table.
+        '''
+        songs = list(songs)
+        self.c.executemany(insert_sql % table,
+            (song_to_row(song) for song in songs))
+        self.write_memberships(songs, table)
+        self.conn.commit()
+
+
+    def update_songs(self, songs, table=table_name):
+        '''
+        The same as insert_songs, except that songs already in the database
+        only have the values given by the songlist pages updated, keeping
+        their user_favorite value and the details from their own pages (see
+        store_details).
+        '''
+        indexes = [columns.index(column) for column in songlist_columns]
+        rows = [song_to_row(song) for song in songs]
+        self.c.executemany(update_sql % table, [[row[i] for i in indexes] +
+            [row[0]] for row in rows])
+        self.c.executemany(insert_new_sql % table, rows)
+        self.write_memberships(songs, table)
+        self.conn.commit()
+
+
+    def store_details(self, songs, table=table_name):
+        '''
+        Stores the details of songs that are only found on their own pages
+        (see detail_columns), marking them as fetched now, and commits.
+        Songs that aren't in the database are ignored.
+        Arguments:
+            songs - Iterable of SongInfo scraped from song pages.
+        '''
+        now = time.time()
+        self.c.executemany(details_sql % table, [(song.year,
+            song.times_requested, song.total_favorites, now, song.id)
+            for song in songs])
+        self.conn.commit()
+
+
+    def songs_without_details(self, limit, ids=None):
         '''
-        # Convert genres and tags back into a delimited string
-        genres = delimiter_char.join(song.genres)
-        tags = delimiter_char.join(song.tags)
-
-        # Need to escape quotation marks -_-
-        artist = song.artist.replace("'", "''")
-        title = song.title.replace("'", "''")
-        album = song.album.replace("'", "''")
-        genres = genres.replace("'", "''")
-        tags = tags.replace("'", "''")
-
-        # For simplicity, also just copy everything else into local variables
-        id = song.id
-        year = song.year
-        total_rates = song.total_rates
-        duration = song.duration
-        rating = song.rating
-        user_rating = song.user_rating
-        user_favorite = song.user_favorite
-        
-        sql = '''insert or replace into ''' + table_name +\
-        ''' (id, artist, title, album, year, genres, rating, total_rates,
-        duration, tags, user_rating, user_favorite) values (%d, '%s', '%s',
-        '%s', %d, '%s', %f, %d, %d, '%s', %d, %d)''' \
-        % (id, artist, title, album, year,
-        genres, rating, total_rates, duration, tags, user_rating, user_favorite)
+        Returns the ids of up to limit songs whose own pages haven't been
+        scraped yet (see store_details), lowest id first.
+        Arguments:
+            limit - Most ids to return.
+            ids - List of ids to choose from, if not all songs.  The ids
+                  returned are then in the same order as these.
+        '''
+        sql = 'select id from ' + table_name + ' where details_fetched is null'
+        if ids is None:
+            self.c.execute(sql + ' order by id limit ?', (limit,))
+            return [result['id'] for result in self.c.fetchall()]
+        missing = set()
+        for i in xrange(0, len(ids), max_variables):
+            batch = ids[i:i + max_variables]
+            self.c.execute(sql + ' and id in (%s)' %
+                ', '.join(['?'] * len(batch)), batch)
+            missing.update([result['id'] for result in self.c.fetchall()])
+        return [id for id in ids if id in missing][:limit]
+
+
+    def details_progress(self):
+        '''
+        Returns (songs with details fetched, total songs).
+        '''
+        sql = 'select count(details_fetched), count(*) from ' + table_name
+        self.c.execute(sql)
+        return tuple(self.c.fetchone())
+
+
+    def begin_fast_load(self):
+        '''
+        Switches the connection to settings suited to loading lots of songs
+        (see fast_load_pragmas), trading durability for speed.
+        Returns the previous settings, to be given to end_fast_load.
+        '''
+        self.conn.commit() # Can't change the journal mode mid-transaction
+        old_settings = []
+        for (pragma, value) in fast_load_pragmas:
+            self.c.execute('pragma %s' % pragma)
+            old_settings.append((pragma, self.c.fetchone()[0]))
+            self.c.execute('pragma %s=%s' % (pragma, value))
+        return old_settings
+
+
+    def end_fast_load(self, old_settings):
+        '''
+        Restores the settings that were in place before begin_fast_load.
+        Arguments:
+            old_settings - List of (pragma, value) returned by begin_fast_load.
+        '''
+        self.conn.commit()
+        for (pragma, value) in old_settings:
+            self.c.execute('pragma %s=%s' % (pragma, value))
+
+
+    def execute_atomically(self, statements):
+        '''
+        Executes the given SQL statements as a single transaction: either all
+        of them take effect or, if one fails, none do.  Unlike a normal
+        commit, this also covers statements that change tables (e.g. drop
+        table), which sqlite3 would otherwise commit as soon as they run.
+        Arguments:
+            statements - List of SQL strings to execute, in order.
+        '''
+        self.conn.commit()
+        isolation_level = self.conn.isolation_level
+        # Take over transaction handling from sqlite3 while this runs
+        self.conn.isolation_level = None
         try:
-            self.c.execute(sql)
-        except Exception, e:
-            # Also print insert statement when an error ooccurs
-            print 'sql string: '
-            raise e
+            self.c.execute('begin')
+            try:
+                for sql in statements:
+                    self.c.execute(sql)
+            except:
+                self.c.execute('rollback')
+                raise
+            self.c.execute('commit')
+        finally:
+            self.conn.isolation_level = isolation_level
 
 
     def make_query(self, query):
@@ -149,30 +837,233 @@ class Database:
         Gets the SongInfo for all song in the database that match the query.
         Returns a list of SongInfo
         '''
-        # Fetch the result of the query
-        self.c.execute(query)
-        results = self.c.fetchall()
-        songs = []
-        for result in results:
-            # Convert into a SongInfo -_-
-            # Need to convert genres and tags into lists of strings
-            song = songinfo.SongInfo(result['id'], result['artist'],
-                result['title'], result['album'], result['year'],
-                result['genres'].split(delimiter_char), result['rating'],
-                result['total_rates'], result['duration'],
-                result['tags'].split(delimiter_char), result['user_rating'],
-                result['user_favorite'])
-            songs.append(song)
-        return songs
-
-
-    def populate(self):
+        return fetch_songs(self.conn.execute(query))
+
+
+    def log_query(self, sql):
+        '''
+        Records that a query was made, for index_advice.  Commits.
+        '''
+        now = time.time()
+        self.c.execute('insert or ignore into ' + query_log_table_name +
+            ' (sql, times_run, last_run) values (?, 0, ?)',
+            (to_unicode(sql), now))
+        self.c.execute('update ' + query_log_table_name + ' set times_run=' +
+            'times_run+1, last_run=? where sql=?', (now, to_unicode(sql)))
+        self.c.execute('delete from ' + query_log_table_name + ' where sql ' +
+            'not in (select sql from ' + query_log_table_name +
+            ' order by last_run desc limit ?)', (max_logged_queries,))
+        self.conn.commit()
+
+
+    def query_plan(self, sql):
+        '''
+        Returns the steps sqlite would take to run a query, as given by
+        EXPLAIN QUERY PLAN (e.g. 'SCAN songs',
+        'SEARCH songs USING INDEX songs_artist (artist=?)').
+        '''
+        self.c.execute('explain query plan ' + sql)
+        return [result['detail'] for result in self.c.fetchall()]
+
+
+    def index_advice(self):
+        '''
+        Goes through the logged queries (see log_query), finding the ones
+        that read the whole songs table, and the indexes that would let them
+        avoid it.  Each index is tried out by creating it in a transaction
+        that is then rolled back, and suggested only if sqlite would use it.
+        Returns a list of (sql, times run, full scans, suggested index
+        definitions) for each query that scans the whole table, most run
+        first.  The definitions can be given to create_index.
+        '''
+        self.c.execute('select sql, times_run from ' + query_log_table_name +
+            ' order by times_run desc, last_run desc')
+        advice = []
+        for (sql, times_run) in self.c.fetchall():
+            try:
+                scans = full_scans(self.query_plan(sql))
+            except sqlite3.Error:
+                # Columns may have changed since the query was made
+                continue
+            if not scans:
+                continue
+            suggestions = [definition for definition in index_candidates(sql)
+                if self.would_use_index(sql, definition)]
+            advice.append((sql, times_run, scans, suggestions))
+        return advice
+
+
+    def would_use_index(self, sql, definition):
+        '''
+        Returns whether sqlite would use an index on the given columns of the
+        songs table to run a query, without keeping the index.
+        '''
+        self.conn.commit()
+        isolation_level = self.conn.isolation_level
+        # Take over transaction handling, so that the index can be rolled back
+        self.conn.isolation_level = None
+        try:
+            self.c.execute('begin')
+            try:
+                self.c.execute('create index %s on %s (%s)' %
+                    (trial_index_name, table_name, definition))
+                plan = self.query_plan(sql)
+            finally:
+                self.c.execute('rollback')
+        finally:
+            self.conn.isolation_level = isolation_level
+        return any([trial_index_name in detail for detail in plan])
+
+
+    def create_index(self, definition):
+        '''
+        Creates an index on the songs table, e.g. one suggested by
+        index_advice, and commits.  Like the default indexes, it's kept when
+        the table is remade.
+        Arguments:
+            definition - Columns to index, e.g. 'year' or
+                         'artist collate nocase'.
+        Returns the name of the index.
+        '''
+        self.c.execute(index_sql(definition))
+        self.c.execute('analyze ' + table_name)
+        self.conn.commit()
+        return index_name(definition)
+
+
+    def search(self, text):
+        '''
+        Finds the songs with all of the given words in their title, artist,
+        album or tags (see search_columns), using the full-text search index.
+        Returns a list of SongInfo, best match first.
+        Arguments:
+            text - Words to search for, separated by spaces.  Each also
+                   matches the words starting with it.
+        '''
+        module = self.search_module()
+        if module == 'fts5':
+            order = search_table_name + '.rank'
+        else:
+            order = 'fts4_rank(matchinfo(%s, \'pcx\')) desc' % \
+                search_table_name
+        sql = 'select %s.* from %s join %s on %s.id=%s.rowid where %s ' % (
+            table_name, search_table_name, table_name, table_name,
+            search_table_name, search_table_name) + 'match ? order by ' + order
+        return fetch_songs(self.conn.execute(sql,
+            (to_unicode(search_query(text, module)),)))
+
+
+    def populate(self, table=table_name,
+        fingerprint_table=fingerprint_table_name, fingerprints=None,
+        skip_urls=()):
         '''
         Scrapes the website and adds everything to the database.
+        Pages are written in batches as soon as they have been scraped, so
+        inserting overlaps with the scraping still going on.
+        Arguments:
+            table - Name of the table to add songs to.
+            fingerprint_table - Name of the table to record the fingerprint of
+                                each scraped page in.
+            fingerprints - Page fingerprints from an earlier scrape, as given
+                           by get_fingerprints.  If given, only pages that have
+                           changed since then are written, and songs already
+                           in the table keep their user_favorite value.
+                           Songs that have gone from the changed pages are
+                           removed, as are the pages past the new last one,
+                           along with their songs.
+            skip_urls - Collection of urls of pages not to scrape.
+        '''
+        # Writing to the songs table itself (e.g. refresh) would fire the
+        # search index's triggers for every song, so the index is filled in
+        # for all of them at the end instead
+        searched = table == table_name
+        written_ids = []
+        if searched:
+            last_rowid = self.drop_search_triggers()
+        # Ids of the songs on each page when it was last scraped, the ids
+        # that were on the pages that have changed, and the urls and ids
+        # found this time
+        old_page_ids = {}
+        if fingerprints is not None:
+            old_page_ids = self.get_page_song_ids()
+        changed_ids = set()
+        scraped_urls = set()
+        found_ids = set()
+        try:
+            songs = []
+            page_fingerprints = []
+            pages = scraping.scrape_all(fingerprints, skip_urls)
+            for i, (page_num, fingerprint, page_songs) in enumerate(pages):
+                url = scraping.playlist_url % page_num
+                if page_songs is None:
+                    # The page hasn't changed, so neither have its songs
+                    ids = old_page_ids.get(url)
+                else:
+                    ids = [song.id for song in page_songs]
+                    songs.extend(page_songs)
+                    changed_ids.update(old_page_ids.get(url, []))
+                scraped_urls.add(url)
+                found_ids.update(ids or [])
+                page_fingerprints.append((url,) + fingerprint +
+                    (page_ids_to_string(ids),))
+                if (i + 1) % pages_per_commit == 0:
+                    self.write_pages(songs, page_fingerprints, table,
+                        fingerprint_table, fingerprints is not None)
+                    written_ids.extend([song.id for song in songs])
+                    songs = []
+                    page_fingerprints = []
+            self.write_pages(songs, page_fingerprints, table,
+                fingerprint_table, fingerprints is not None)
+            written_ids.extend([song.id for song in songs])
+            if fingerprints is not None:
+                # Pages that weren't scraped or skipped this time are past
+                # the last page now
+                gone_urls = [url for url in fingerprints
+                    if url not in scraped_urls and url not in skip_urls]
+                for url in gone_urls:
+                    changed_ids.update(old_page_ids.get(url, []))
+                removed_ids = changed_ids - found_ids
+                self.c.executemany('delete from ' + fingerprint_table +
+                    ' where url=?', [(url,) for url in gone_urls])
+                self.remove_songs(removed_ids)
+                self.conn.commit()
+                written_ids.extend(removed_ids)
+                if removed_ids or gone_urls:
+                    print 'Removed %d songs no longer on the site, and %d ' \
+                        'pages past the last one.' % (len(removed_ids),
+                        len(gone_urls))
+        except:
+            # Throw away the batch that was being written
+            self.conn.rollback()
+            raise
+        finally:
+            if searched:
+                self.refill_search_index(written_ids, last_rowid)
+
+
+    def write_pages(self, songs, page_fingerprints, table, fingerprint_table,
+        keep_favorites):
+        '''
+        Writes a batch of scraped songlist pages and commits them.
+        Arguments:
+            songs - List of SongInfo found on the pages.
+            page_fingerprints - List of (url, digest, etag, last_modified,
+                                song ids) giving the fingerprint of each page
+                                and the ids of the songs on it (see
+                                page_ids_to_string).
+            table - Name of the table to write the songs to.
+            fingerprint_table - Name of the table to write fingerprints to.
+            keep_favorites - Whether songs already in the table should keep
+                             their user_favorite value.
         '''
-        songs = scraping.scrape_all()
-        for song in songs:
-            self.insert_song(song)
+        sql = 'insert or replace into ' + fingerprint_table +\
+            ' (url, digest, etag, last_modified, song_ids) values ' +\
+            '(?, ?, ?, ?, ?)'
+        self.c.executemany(sql, page_fingerprints)
+        if keep_favorites:
+            self.update_songs(songs, table)
+        else:
+            self.insert_songs(songs, table)
 
 
     def populate_favorites(self):
@@ -180,10 +1071,36 @@ class Database:
         Scrapes favorites and sets the favorite values in the database.
         '''
         favorite_ids = scraping.scrape_favorites()
-        self.set_no_favorites() # Get rid of existing favorite values
-        for id in favorite_ids:
-            self.set_favorite(id, True)
+        # Add any favorites that aren't in the database yet, so that they get
+        # marked too
+        self.get_song_infos(favorite_ids, fetch_missing=True)
+        changed = self.set_favorites(favorite_ids)
+        print 'Found %d favorites, %d songs changed.' % (len(favorite_ids),
+            changed)
+
+
+    def set_favorites(self, ids):
+        '''
+        Marks the songs with the given ids as favorites and every other song
+        as not a favorite, in one statement that only writes the songs whose
+        favorite value changes.  Commits, and returns the number of songs
+        changed.
+        Arguments:
+            ids - Collection of integer ids of the favorite songs.
+        '''
+        self.c.execute('create temp table if not exists ' +
+            favorites_table_name + ' (id integer primary key)')
+        self.c.execute('delete from ' + favorites_table_name)
+        self.c.executemany('insert or ignore into ' + favorites_table_name +
+            ' (id) values (?)', [(id,) for id in ids])
+        is_favorite = '(id in (select id from %s))' % favorites_table_name
+        self.c.execute('update ' + table_name + ' set user_favorite=' +
+            is_favorite + ' where coalesce(user_favorite, 0) != ' +
+            is_favorite)
+        changed = self.c.rowcount
+        self.c.execute('delete from ' + favorites_table_name)
         self.conn.commit()
+        return changed
 
 
     def populate_song(self, id):
@@ -194,27 +1111,20 @@ class Database:
         self.insert_song(song)
         # Commit the database, which shouldn't happen too frequently as this
         # method uses the network, which is slow
-        self.conn.commit()
+        self.store_details([song])
 
 
     def queue_songs(self):
         '''
         Checks the queue, returning a list of SongInfo, in order from first in
-        the queue (soonest to play) to last.
+        the queue (soonest to play) to last.  Songs that couldn't be scraped
+        are left out.
         '''
         ids = scraping.queue_ids()
-
-        # Query each of the songs
-        songs = []
-        for id in ids:
-            info = self.get_song_info(id)
-            # Add the song to the database if it isn't in there yet
-            if info is None:
-                print 'Found new song in queue, adding...'
-                self.populate_song(id)
-                info = self.get_song_info(id)
-            songs.append(info)
-        return songs
+        # Look up all of the songs at once, adding any that aren't in the
+        # database yet
+        songs = self.get_song_infos(ids, fetch_missing=True)
+        return [song for song in songs if song is not None]
 
 
     def rate_song(self, id, rating):
@@ -227,15 +1137,165 @@ class Database:
         self.conn.commit()
 
 
-    def remake_all(self):
+    def remake_all(self, resume=False):
         '''
         Remakes the whole database, scraping everything.
+        Everything is scraped into a separate table first, which replaces the
+        songs table only once scraping has finished.  Until then the existing
+        songs can still be used as normal, and they're left untouched if
+        scraping fails.
+        The pages written so far are recorded in the rebuild's fingerprint
+        table, in the same transactions as their songs, so that table doubles
+        as a journal of how far a remake got.
+        Arguments:
+            resume - Whether to carry on from where an unfinished remake left
+                     off, rather than starting again from scratch.
         '''
-        self.clear_database()
-        self.create_database()
-        self.conn.commit()
-        self.populate()
+        if resume and self.table_exists(rebuild_fingerprint_table_name):
+            sql = 'select url from ' + rebuild_fingerprint_table_name
+            self.c.execute(sql)
+            done_urls = set([result['url'] for result in self.c.fetchall()])
+            print 'Resuming, %d pages were already scraped.' % len(done_urls)
+        else:
+            # Get rid of anything left behind by a rebuild that failed
+            self.c.execute('drop table if exists ' + rebuild_table_name)
+            self.c.execute('drop table if exists ' +
+                rebuild_fingerprint_table_name)
+            for (attribute, column, name) in memberships(rebuild_table_name):
+                self.c.execute('drop table if exists ' + name)
+            done_urls = set()
+        self.create_database(rebuild_table_name)
+        self.create_fingerprint_table(rebuild_fingerprint_table_name)
+        self.create_membership_tables(rebuild_table_name)
+        old_settings = self.begin_fast_load()
+        try:
+            self.populate(rebuild_table_name, rebuild_fingerprint_table_name,
+                skip_urls=done_urls)
+        except:
+            # Throw away the batch that was being written, so that the pages
+            # recorded as done are exactly the ones whose songs were stored
+            self.conn.rollback()
+            raise
+        finally:
+            self.end_fast_load(old_settings)
+        self.swap_in_rebuild()
+
+
+    def reparse(self):
+        '''
+        Remakes the whole database from the pages in the scraping archive,
+        without going to the site (e.g. after fixing the parsers).  Like
+        remake_all, the songs are put in a separate table that replaces the
+        songs table once they're all there.  Favorites come from the archived
+        favorites list if there is one, and are carried over otherwise.
+        '''
+        self.c.execute('drop table if exists ' + rebuild_table_name)
+        self.c.execute('drop table if exists ' + rebuild_fingerprint_table_name)
+        for (attribute, column, name) in memberships(rebuild_table_name):
+            self.c.execute('drop table if exists ' + name)
+        self.create_database(rebuild_table_name)
+        self.create_membership_tables(rebuild_table_name)
+        # The pages haven't been fetched again, so their fingerprints stay
+        self.create_fingerprint_table(rebuild_fingerprint_table_name)
+        self.c.execute('insert into ' + rebuild_fingerprint_table_name +
+            ' select * from ' + fingerprint_table_name)
         self.conn.commit()
+        old_settings = self.begin_fast_load()
+        try:
+            songs = []
+            num_pages = 0
+            for (url, page_songs) in scraping.reparse_playlist():
+                songs.extend(page_songs)
+                num_pages += 1
+                self.c.execute('update ' + rebuild_fingerprint_table_name +
+                    ' set song_ids=? where url=?', (page_ids_to_string(
+                    [song.id for song in page_songs]), url))
+                if num_pages % pages_per_commit == 0:
+                    self.insert_songs(songs, rebuild_table_name)
+                    songs = []
+            self.insert_songs(songs, rebuild_table_name)
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            self.end_fast_load(old_settings)
+        if num_pages == 0:
+            print 'No songlist pages have been archived; nothing to reparse.'
+            return
+        self.swap_in_rebuild()
+        favorite_ids = scraping.reparse_favorites()
+        if favorite_ids is not None:
+            self.set_favorites(favorite_ids)
+
+
+    def table_exists(self, table):
+        '''
+        Returns whether a table with the given name exists.
+        '''
+        sql = 'select count(*) from sqlite_master where type=? and name=?'
+        self.c.execute(sql, ('table', table))
+        return self.c.fetchone()[0] > 0
+
+
+    def swap_in_rebuild(self):
+        '''
+        Replaces the songs table with the table built by remake_all, in a
+        single transaction, along with the page fingerprints.  Favorites are
+        carried over by id, as are the details from song pages, and user
+        ratings for songs that the scrape found no rating for.
+        The genre and tag tables built alongside it replace the old ones too,
+        and the search index is made again from the new songs.
+        The indexes are only made once the songs are all in the new table,
+        since keeping them up to date while loading would slow it down; any
+        the old table had beyond the defaults (see create_index) are made
+        again too.
+        Raises scraping.ScrapingError, leaving the songs table alone, if no
+        songs were found, since then the rebuild must have gone wrong.
+        '''
+        self.c.execute('select count(*) from ' + rebuild_table_name)
+        if self.c.fetchone()[0] == 0:
+            raise scraping.ScrapingError('No songs were found, so the ' +
+                'songs already in the database have been kept.')
+        print 'Replacing old songs with the new ones...'
+        # Dropping the old table drops its indexes, so remember how they were
+        # made
+        self.c.execute('select sql from sqlite_master where type=? and ' +
+            'tbl_name=? and sql is not null', ('index', table_name))
+        old_indexes = [result['sql'] for result in self.c.fetchall()]
+        module = self.search_module()
+        names = {'new': rebuild_table_name, 'old': table_name,
+            'new_fingerprints': rebuild_fingerprint_table_name,
+            'old_fingerprints': fingerprint_table_name}
+        self.execute_atomically([sql % names for sql in [
+            'update %(new)s set user_favorite=coalesce((select '
+            '%(old)s.user_favorite from %(old)s where %(old)s.id=%(new)s.id), '
+            '0)',
+            'update %(new)s set user_rating=(select %(old)s.user_rating from '
+            '%(old)s where %(old)s.id=%(new)s.id) where user_rating=0 and id in '
+            '(select id from %(old)s where user_rating!=0)',
+            'update %(new)s set ' + ', '.join(['%s=(select %%(old)s.%s from '
+            '%%(old)s where %%(old)s.id=%%(new)s.id)' % (column, column)
+            for column in detail_columns]) + ' where id in (select id from '
+            '%(old)s where details_fetched is not null)',
+            'drop table %(old)s',
+            'alter table %(new)s rename to %(old)s',
+            'drop table %(old_fingerprints)s',
+            'alter table %(new_fingerprints)s rename to %(old_fingerprints)s']]
+            + [sql % {'new': rebuild_name, 'old': name} for (attribute,
+            column, name, rebuild_name) in membership_tables for sql in [
+            'drop table %(old)s', 'alter table %(new)s rename to %(old)s']]
+            + old_indexes + [index_sql(definition) for definition in indexes] +
+            [membership_index_sql(name, column) for (attribute, column, name)
+            in memberships()] + ['drop table if exists ' + search_table_name] +
+            search_index_sql(module) + ['analyze'])
+
+
+    def refresh(self):
+        '''
+        Rescrapes only the songlist pages that have changed since they were
+        last scraped, updating the songs on them.  Favorites are kept.
+        '''
+        self.populate(fingerprints=self.get_fingerprints())
 
     def remove_song(self, id):
         '''
@@ -243,9 +1303,22 @@ class Database:
         '''
         sql = 'delete from ' + table_name + ' where id=%d' % (id)
         self.c.execute(sql)
+        for (attribute, column, name) in memberships():
+            self.c.execute('delete from ' + name + ' where id=?', (id,))
         self.conn.commit()
 
 
+    def remove_songs(self, ids):
+        '''
+        Removes the songs with the given ids from the database, along with
+        their genres and tags.  Doesn't commit.
+        '''
+        ids = [(id,) for id in ids]
+        self.c.executemany('delete from ' + table_name + ' where id=?', ids)
+        for (attribute, column, name) in memberships():
+            self.c.executemany('delete from ' + name + ' where id=?', ids)
+
+
     def set_favorite(self, id, fav):
         '''
         Sets the favorite value of a song to the given value.
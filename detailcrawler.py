@@ -0,0 +1,159 @@
+'''
+Contains the DetailCrawler class, which slowly scrapes the page of every song
+in the background, filling in the details that the songlist doesn't give
+(year, times requested and total favorites).
+'''
+
+import collections
+import database
+import scraping
+import sqlite3
+import threading
+import throttle
+import urllib2
+
+# Average number of song pages fetched per second.  Kept low so that the
+# crawler hardly adds to the load on the site: at this rate, a catalog of
+# 18000 songs takes about two days.
+requests_per_second = 0.1
+
+# Number of songs fetched between writes to the database
+batch_size = 10
+
+# Number of seconds to wait after the site can't be reached, and between
+# checks for new songs once every song has its details
+retry_delay = 300
+idle_delay = 600
+
+
+class DetailCrawler(threading.Thread):
+    '''
+    Background thread that scrapes song pages one at a time, at no more than
+    requests_per_second, and stores their details in the database in small
+    batches.  Which songs have their details is kept in the database (see
+    Database.store_details), so the crawl carries on where it left off
+    whenever it's started again.
+    Songs asked for with prioritize (e.g. ones you've just queried, or that
+    are in the queue) are fetched before the rest, which go lowest id first.
+    '''
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        # Ids to fetch first, oldest first, and the same as a set
+        self.priority = collections.deque()
+        self.priority_set = set()
+        # Statistics
+        self.num_fetched = 0
+        self.error = None
+
+    def prioritize(self, ids):
+        '''
+        Asks for the songs with the given ids to have their details fetched
+        before any others.  Songs that already have them are skipped.
+        '''
+        self.lock.acquire()
+        try:
+            for id in ids:
+                if id not in self.priority_set:
+                    self.priority.append(id)
+                    self.priority_set.add(id)
+        finally:
+            self.lock.release()
+
+    def next_batch(self, db):
+        '''
+        Returns the ids of the next batch of songs to fetch, prioritized ones
+        first.
+        '''
+        self.lock.acquire()
+        try:
+            ids = list(self.priority)
+            self.priority.clear()
+            self.priority_set.clear()
+        finally:
+            self.lock.release()
+        pending = db.songs_without_details(len(ids), ids)
+        batch = pending[:batch_size]
+        # Put back the prioritized songs that didn't fit in this batch
+        self.prioritize(pending[batch_size:])
+        # Fill up the rest of the batch with whatever's next
+        for id in db.songs_without_details(batch_size):
+            if len(batch) == batch_size:
+                break
+            if id not in batch:
+                batch.append(id)
+        return batch
+
+    def crawl_batch(self, db, bucket):
+        '''
+        Fetches the next batch of songs and stores their details, or waits a
+        while if every song has its details.  Returns False if the batch was
+        cut short by the site, so that the crawler should wait before going
+        on.
+        '''
+        batch = self.next_batch(db)
+        if not batch:
+            self.stop_event.wait(idle_delay)
+            return True
+        songs = []
+        for id in batch:
+            bucket.acquire()
+            if self.stop_event.isSet():
+                break
+            try:
+                songs.append(scraping.get_song(id, use_cache=True))
+            except urllib2.HTTPError, e:
+                if e.code != 404:
+                    self.error = e
+                    break
+                # The song has gone from the site, so keep what's known about
+                # it and don't try it again
+                songs.append(db.get_song_info(id))
+            except urllib2.URLError, e:
+                self.error = e
+                break
+            except (IndexError, KeyError, ValueError), e:
+                # A page the parser can't make sense of.  Move on, rather than
+                # getting stuck on it.
+                self.error = e
+                songs.append(db.get_song_info(id))
+        # Songs removed from the database while being fetched are None
+        db.store_details([song for song in songs if song is not None])
+        self.num_fetched += len(songs)
+        return len(songs) == len(batch) or self.stop_event.isSet()
+
+    def run(self):
+        '''
+        Fetches song pages until stopped.
+        '''
+        # sqlite connections can't be shared between threads
+        db = database.Database()
+        bucket = throttle.TokenBucket(requests_per_second)
+        while not self.stop_event.isSet():
+            try:
+                fetched = self.crawl_batch(db, bucket)
+            except sqlite3.Error, e:
+                # e.g. the database is locked while remake_all writes to it.
+                # The batch's songs weren't marked as fetched, so they'll be
+                # fetched again.
+                db.conn.rollback()
+                self.error = e
+                fetched = False
+            except Exception, e:
+                # e.g. a connection that times out or is cut off part way
+                # through a page.  Keep going after a wait, rather than
+                # letting the thread die.
+                self.error = e
+                fetched = False
+            if not fetched and not self.stop_event.isSet():
+                self.stop_event.wait(retry_delay)
+        db.conn.close()
+
+    def stop(self):
+        '''
+        Stops crawling, once the song being fetched is done.
+        '''
+        self.stop_event.set()
@@ -0,0 +1,291 @@
+'''
+Contains FakeSite, a local web server standing in for the animenfo website,
+so that scraping can be measured without putting any load on the real site.
+It can serve the songlist, favorites, song, queue and login pages for a made
+up catalog of songs, in the same markup as the site, and can be made slow or
+unreliable on purpose.
+'''
+
+import BaseHTTPServer
+import random
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+
+
+def playlist_page(songs, num_pages=1):
+    '''
+    Returns the html of a songlist page listing the given songs, laid out the
+    way the site lays them out, so that it can be parsed by
+    scraping.parse_playlist_page.
+    Arguments:
+        songs - List of SongInfo to list.  A song with an empty artist gives
+                one of the blank entries that the site sometimes has.
+        num_pages - Number of pages to link to at the bottom of the page.
+    '''
+    rows = []
+    for song in songs:
+        user_rating = '-' if song.user_rating == 0 else str(song.user_rating)
+        rating = '-' if song.rating == 0 else '%.2f' % song.rating
+        tags = ', '.join(['<a href="tags.php?tag=%s">%s</a>' %
+            (urllib.quote(tag), tag) for tag in song.tags])
+        rows.append('<tr>\n'
+            '<td><a href="playlist.php?artist=%s">%s</a> - %s<br/>\n'
+            '<a href="playlist.php?album=%s">%s</a><br/>\n'
+            'Requests: 0<br/> %d:%02d<br/>\n'
+            'My rating: %s | Song rating: %s (%d votes)<br/>\n'
+            'Genre(s): %s<br/>\n'
+            'Tag(s): %s</td>\n'
+            '<td><a href="songinfo.php?id=%d">Info</a></td>\n'
+            '</tr>' % (urllib.quote(song.artist), song.artist, song.title,
+            urllib.quote(song.album), song.album, song.duration // 60,
+            song.duration % 60, user_rating, rating, song.total_rates,
+            ','.join(song.genres), tags, song.id))
+    links = ' '.join(['<a href="javascript:goToPage(%d)">%d</a>' %
+        (page_num, page_num) for page_num in xrange(1, num_pages + 1)])
+    return '<table>\n%s\n</table>\n<div>%s</div>\n' % ('\n'.join(rows),
+        links)
+
+
+def song_page(song):
+    '''
+    Returns the html of the info page for the given SongInfo, laid out the
+    way the site lays it out, so that it can be parsed by
+    scraping.parse_song_page.  The requested and fav block cells use the
+    labels the scraper expects (scraping.requested_label and so on), which
+    haven't been checked against a real song page, so parsing these pages
+    can't show whether those labels are right.
+    '''
+    rating = '-' if song.rating == 0 else '%.2f' % song.rating
+    tags = ''.join(['<a href="tags.php?tag=%s">%s</a>' % (urllib.quote(tag),
+        tag) for tag in song.tags])
+    if song.user_favorite:
+        fav_link = '<a href="myfavs.php?remove=%d">Remove from favorites</a>'
+    else:
+        fav_link = '<a href="myfavs.php?add=%d">Add to favorites</a>'
+    fields = [('Song ID', '%d' % song.id),
+        ('Artist', '<a href="playlist.php?artist=%s">%s</a>' %
+            (urllib.quote(song.artist), song.artist)),
+        ('Title', song.title),
+        ('Album', '<a href="playlist.php?album=%s">%s</a>' %
+            (urllib.quote(song.album), song.album)),
+        ('Year', '' if song.year == 0 else '%d' % song.year),
+        ('Genre(s)', ','.join(song.genres)),
+        ('Rating', '%s/10 (%d votes)' % (rating, song.total_rates)),
+        ('Requested', '%d times' % song.times_requested),
+        ('Duration', '%d:%02d' % (song.duration // 60, song.duration % 60)),
+        ('Favorites', '%d people<br/>%s' % (song.total_favorites,
+            fav_link % song.id)),
+        ('Tags:', '<span class="tags">%s</span>' % tags)]
+    rows = ['<tr><td class="label">%s</td><td class="value">%s</td></tr>' %
+        field for field in fields]
+    return '<table>\n%s\n</table>\n' % '\n'.join(rows)
+
+
+def favorites_page(ids, num_pages=1):
+    '''
+    Returns the html of a page of the favorites list, listing the songs with
+    the given ids, so that it can be parsed by scraping.parse_favorites_page.
+    Arguments:
+        ids - List of ids of the songs on the page.
+        num_pages - Number of pages to link to at the bottom of the page.
+    '''
+    rows = ['<tr><td>Favorite</td>'
+        '<td><a href="songinfo.php?id=%d">Info</a></td></tr>' % id
+        for id in ids]
+    links = ' '.join(['<a href="javascript:goToPage(%d)">%d</a>' %
+        (page_num, page_num) for page_num in xrange(1, num_pages + 1)])
+    return '<table>\n%s\n</table>\n<div>%s</div>\n' % ('\n'.join(rows),
+        links)
+
+
+def queue_page(songs, top_ids=()):
+    '''
+    Returns the html of the queue page, with the given songs queued, so that
+    it can be parsed by scraping.queue_ids.
+    Arguments:
+        songs - List of SongInfo in the queue, soonest to play first.
+        top_ids - Ids of the songs in the list of most requested songs, which
+                  the site shows on the same page.
+    '''
+    queued = ['<div>Song: <a href="songinfo.php?id=%d">%s - %s</a></div>' %
+        (song.id, song.artist, song.title) for song in songs]
+    top = ['<li><a href="songinfo.php?id=%d">Top request</a></li>' % id
+        for id in top_ids]
+    return '<div>\n%s\n</div>\n<ol>\n%s\n</ol>\n' % ('\n'.join(queued),
+        '\n'.join(top))
+
+
+class FakeSiteHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Answers requests with pages from the FakeSite it belongs to.
+    '''
+    # HTTP/1.1, so that connections are kept alive between requests
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one go and without waiting on acknowledgements, as
+    # a real server would, rather than sending every header line on its own
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        '''
+        Sends the page at the requested path.
+        '''
+        self.respond()
+
+    def do_POST(self):
+        '''
+        Sends the page at the requested path, ignoring the data posted (e.g.
+        a username and password).
+        '''
+        self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+        self.respond()
+
+    def respond(self):
+        '''
+        Sends the FakeSite's response to the request, after its latency.
+        '''
+        (code, headers, body) = self.server.respond(self.path)
+        delay = self.server.latency + \
+            random.uniform(-self.server.jitter, self.server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        for (name, value) in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        '''
+        Doesn't print anything, rather than printing every request.
+        '''
+        pass
+
+
+class FakeSite(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    Local web server that serves made up pages.  Runs in a background thread
+    between calls to start and stop.
+    '''
+    daemon_threads = True
+
+    def __init__(self, page_size=50000, body=None, songs=None,
+        songs_per_page=50, favorite_ids=(), queued_ids=(), latency=0,
+        jitter=0, error_rate=0):
+        '''
+        Arguments:
+            page_size - Number of bytes in each page served, if there's no
+                        catalog.
+            body - Body to serve for every page.  If not given, each page is
+                   page_size bytes of filler.
+            songs - List of SongInfo making up the site's catalog.  If given,
+                    the site's pages are served for it, rather than the same
+                    page for every path.
+            songs_per_page - Number of songs on each page of the songlist and
+                             the favorites list.
+            favorite_ids - Ids of the songs in the favorites list.
+            queued_ids - Ids of the songs in the queue.
+            latency - Average number of seconds to wait before each response.
+            jitter - Most number of seconds each wait can be off by, either
+                     way.
+            error_rate - Fraction of requests to answer with 503 Service
+                         Unavailable.
+        '''
+        # Port 0 picks any free port
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+            FakeSiteHandler)
+        self.page_size = page_size
+        self.body = body
+        self.songs = songs
+        self.songs_by_id = dict([(song.id, song) for song in songs or []])
+        self.songs_per_page = songs_per_page
+        self.favorite_ids = list(favorite_ids)
+        self.queued_ids = list(queued_ids)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.url = 'http://127.0.0.1:%d/' % self.server_port
+        # Statistics
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_errors = 0
+
+    def respond(self, path):
+        '''
+        Returns (status code, list of extra (header, value), body) for a
+        request for the given path.
+        '''
+        failed = random.random() < self.error_rate
+        self.lock.acquire()
+        self.num_requests += 1
+        if failed:
+            self.num_errors += 1
+        self.lock.release()
+        if failed:
+            return (503, [], 'Service Unavailable')
+        if self.songs is None:
+            return (200, [], self.page(path))
+        (_, _, page_name, _, query, _) = urlparse.urlparse(path)
+        args = dict(urlparse.parse_qsl(query))
+        page_num = int(args.get('page', 1))
+        if page_name.endswith('playlist.php'):
+            return (200, [], playlist_page(self.page_of(self.songs, page_num),
+                self.num_pages(self.songs)))
+        elif page_name.endswith('myfavs.php'):
+            return (200, [], favorites_page(
+                self.page_of(self.favorite_ids, page_num),
+                self.num_pages(self.favorite_ids)))
+        elif page_name.endswith('songinfo.php'):
+            song = self.songs_by_id.get(int(args.get('id', 0)))
+            if song is None:
+                return (404, [], 'No such song')
+            return (200, [], song_page(song))
+        elif page_name.endswith('queuelist.php'):
+            return (200, [], queue_page([self.songs_by_id[id]
+                for id in self.queued_ids], self.queued_ids[:10]))
+        elif page_name.endswith('login.php'):
+            return (200, [('Set-Cookie', 'session=fake; path=/')],
+                'Logged in')
+        return (404, [], 'Not found')
+
+    def page_of(self, items, page_num):
+        '''
+        Returns the items on the given page of a paged list of them.
+        '''
+        start = (page_num - 1) * self.songs_per_page
+        return items[start:start + self.songs_per_page]
+
+    def num_pages(self, items):
+        '''
+        Returns the number of pages in a paged list of the given items.
+        '''
+        return max((len(items) - 1) // self.songs_per_page + 1, 1)
+
+    def page(self, path):
+        '''
+        Returns the body of the page at the given path, when there's no
+        catalog.
+        '''
+        if self.body is not None:
+            return self.body
+        return 'x' * self.page_size
+
+    def start(self):
+        '''
+        Starts serving pages in a background thread.
+        '''
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        '''
+        Stops serving pages.
+        '''
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,191 @@
+'''
+Contains the Cache class, which keeps pages fetched from the site on disk so
+that fetching the same page again soon afterwards doesn't have to go over the
+network.
+'''
+
+import sqlite3
+import threading
+import time
+import urllib2
+
+# Name of the table the pages are kept in
+table_name = 'pages'
+
+
+class Cache:
+    '''
+    HTTP cache kept in an sqlite database.  Each page is kept for a given
+    number of seconds (its time to live), after which it is stale: the next
+    fetch asks the site whether it has changed (If-None-Match and
+    If-Modified-Since) and only downloads it again if it has.  Once the pages
+    take up more than max_size bytes, the least recently used are thrown out.
+    Can be used from several threads at once.
+    '''
+
+    def __init__(self, location, max_size):
+        '''
+        Arguments:
+            location - File to keep the cache in.  Isn't created until the
+                       cache is first used.
+            max_size - Maximum number of bytes of pages to keep.
+        '''
+        self.location = location
+        self.max_size = max_size
+        self.conn = None
+        self.lock = threading.Lock()
+        # Statistics
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+
+    def connect(self):
+        '''
+        Opens the cache's database, creating it if needed.  Should hold the
+        lock.
+        '''
+        if self.conn is not None:
+            return
+        self.conn = sqlite3.connect(self.location, check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.execute('create table if not exists ' + table_name +
+            ''' (url text primary key, body blob, etag text,
+            last_modified text, fetched real, last_used real,
+            size integer)''')
+        self.conn.execute('create index if not exists ' + table_name +
+            '_last_used on ' + table_name + ' (last_used)')
+        self.conn.commit()
+
+    def fetch(self, session, url, ttl):
+        '''
+        Returns (body, downloaded) for the page at the given url, where the
+        body comes from the cache if it was fetched less than ttl seconds ago,
+        and otherwise from the site.  downloaded is whether the body had to be
+        downloaded, rather than being the same as the cached copy.
+        Arguments:
+            session - httpsession.Session to fetch pages with.
+            url - Address of the page.
+            ttl - Number of seconds the page can be kept before asking the
+                  site whether it has changed.
+        '''
+        entry = self.lookup(url)
+        if entry is not None:
+            (body, etag, last_modified, fetched) = entry
+            if time.time() - fetched < ttl:
+                self.count('hits')
+                return (body, False)
+        headers = {}
+        if entry is not None:
+            if etag is not None:
+                headers['If-None-Match'] = etag
+            if last_modified is not None:
+                headers['If-Modified-Since'] = last_modified
+        response = session.open(url, headers=headers)
+        new_body = response.read()
+        if response.code == 304:
+            # Not Modified: what we have is still good
+            if entry is not None:
+                self.count('revalidations')
+                self.store(url, body, etag, last_modified)
+                return (body, False)
+            # There's nothing cached to keep using, so the (empty) body isn't
+            # the page: ask for the whole page instead
+            response = session.open(url, headers={'Cache-Control': 'no-cache'})
+            new_body = response.read()
+            if response.code == 304:
+                raise urllib2.HTTPError(url, response.code,
+                    'Not Modified, but the page isn\'t cached',
+                    response.info(), None)
+        self.count('misses')
+        info = response.info()
+        self.store(url, new_body, info.getheader('ETag'),
+            info.getheader('Last-Modified'))
+        return (new_body, True)
+
+    def lookup(self, url):
+        '''
+        Returns (body, ETag, Last-Modified, time fetched) for the cached copy
+        of a page, marking it as just used, or None if it isn't cached.
+        '''
+        self.lock.acquire()
+        try:
+            self.connect()
+            entry = self.conn.execute('select body, etag, last_modified, ' +
+                'fetched from ' + table_name + ' where url=?',
+                (url,)).fetchone()
+            if entry is None:
+                return None
+            self.conn.execute('update ' + table_name +
+                ' set last_used=? where url=?', (time.time(), url))
+            self.conn.commit()
+            return (str(entry[0]), entry[1], entry[2], entry[3])
+        finally:
+            self.lock.release()
+
+    def store(self, url, body, etag, last_modified):
+        '''
+        Puts a freshly fetched (or revalidated) page in the cache, throwing
+        out the least recently used pages if the cache gets too big.
+        '''
+        now = time.time()
+        self.lock.acquire()
+        try:
+            self.connect()
+            self.conn.execute('insert or replace into ' + table_name +
+                ' values (?, ?, ?, ?, ?, ?, ?)', (url, buffer(body), etag,
+                last_modified, now, now, len(body)))
+            size = self.conn.execute('select sum(size) from ' +
+                table_name).fetchone()[0]
+            if size > self.max_size:
+                evict = []
+                for (old_url, old_size) in self.conn.execute(
+                    'select url, size from ' + table_name +
+                    ' order by last_used'):
+                    if size <= self.max_size:
+                        break
+                    evict.append((old_url,))
+                    size -= old_size
+                self.conn.executemany('delete from ' + table_name +
+                    ' where url=?', evict)
+            self.conn.commit()
+        finally:
+            self.lock.release()
+
+    def count(self, counter):
+        '''
+        Adds one to one of the statistics counters.
+        '''
+        self.lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        '''
+        Throws out every page in the cache.
+        '''
+        self.lock.acquire()
+        try:
+            self.connect()
+            self.conn.execute('delete from ' + table_name)
+            self.conn.commit()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        '''
+        Returns a dictionary of cache statistics: the number of fetches
+        answered straight from the cache (hits), after the site said the page
+        hadn't changed (revalidations), and by downloading the page (misses),
+        along with the number of pages in the cache and their total size.
+        '''
+        self.lock.acquire()
+        try:
+            self.connect()
+            (pages, size) = self.conn.execute('select count(*), ' +
+                'coalesce(sum(size), 0) from ' + table_name).fetchone()
+            return {'hits': self.hits, 'revalidations': self.revalidations,
+                'misses': self.misses, 'pages': pages, 'size': size}
+        finally:
+            self.lock.release()
@@ -0,0 +1,261 @@
+'''
+Contains the Session class, which fetches pages over persistent (keep-alive)
+connections rather than making a new connection for every request, as
+urllib2 does.
+'''
+
+import cookielib
+import httplib
+import socket
+import StringIO
+import threading
+import urllib2
+import urlparse
+
+# Maximum number of unused connections kept open to each host
+max_idle_connections = 8
+
+# Number of seconds to wait on the network before giving up on a request
+timeout = 60
+
+# Maximum number of redirects followed for a single request
+max_redirects = 5
+
+
+class Response:
+    '''
+    Response to a request made with Session.open.  Can be used the same way
+    as the responses urllib2 gives: read, readlines, info, geturl, getcode.
+    Once the body has been read, the connection goes back to the session to be
+    used again.
+    '''
+
+    def __init__(self, session, key, conn, http_response, url):
+        '''
+        Arguments:
+            session - Session that made the request.
+            key - Key of the connection's host in the session's pool.
+            conn - httplib connection the response arrives on.
+            http_response - httplib.HTTPResponse being wrapped.
+            url - Address the response came from.
+        '''
+        self.session = session
+        self.key = key
+        self.conn = conn
+        self.http_response = http_response
+        self.url = url
+        self.code = http_response.status
+        self.msg = http_response.reason
+        self.headers = http_response.msg
+
+    def read(self, amt=None):
+        '''
+        Reads and returns up to amt bytes of the body, or all of what's left
+        if amt is None.
+        '''
+        if self.conn is None:
+            return ''
+        if amt is None:
+            data = self.http_response.read()
+        else:
+            data = self.http_response.read(amt)
+        if self.http_response.isclosed():
+            self.session.release(self.key, self.conn, self.http_response)
+            self.conn = None
+        return data
+
+    def readlines(self):
+        '''
+        Reads the rest of the body, returning it as a list of lines.
+        '''
+        return self.read().splitlines(True)
+
+    def info(self):
+        '''
+        Returns the headers of the response.
+        '''
+        return self.headers
+
+    def geturl(self):
+        '''
+        Returns the address the response came from, after any redirects.
+        '''
+        return self.url
+
+    def getcode(self):
+        '''
+        Returns the HTTP status code of the response.
+        '''
+        return self.code
+
+    def close(self):
+        '''
+        Closes the response.  If the body wasn't read, the connection can't
+        be used again, so it gets closed as well.
+        '''
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class Session:
+    '''
+    Fetches pages, keeping connections open to be reused by later requests,
+    and keeping cookies (e.g. the login cookie) between requests.
+    Can be used from several threads at once.
+    '''
+
+    def __init__(self, cookie_jar=None):
+        '''
+        Arguments:
+            cookie_jar - cookielib.CookieJar to keep cookies in.  A new one is
+                         made if not given.
+        '''
+        if cookie_jar is None:
+            cookie_jar = cookielib.CookieJar()
+        self.cookie_jar = cookie_jar
+        # (scheme, host) -> list of idle connections to that host
+        self.idle = {}
+        self.lock = threading.Lock()
+        # Statistics
+        self.num_requests = 0
+        self.num_connections = 0
+
+    def open(self, url, data=None, headers=None):
+        '''
+        Fetches a page, following redirects, and returns a Response.
+        Raises urllib2.HTTPError if the server gives an error status, and
+        urllib2.URLError if the server can't be reached, like urllib2 does.
+        Arguments:
+            url - Address of the page, or a urllib2.Request.
+            data - Data to POST (already urlencoded), or None to GET.
+            headers - Dictionary of extra headers to send.
+        '''
+        if headers is None:
+            headers = {}
+        if isinstance(url, urllib2.Request):
+            headers = dict(url.header_items())
+            data = url.get_data()
+            url = url.get_full_url()
+        for _ in xrange(max_redirects + 1):
+            request = urllib2.Request(url, data, headers)
+            if data is not None:
+                request.add_unredirected_header('Content-Type',
+                    'application/x-www-form-urlencoded')
+            self.cookie_jar.add_cookie_header(request)
+            response = self.send(request)
+            self.cookie_jar.extract_cookies(response, request)
+            location = response.info().getheader('Location')
+            if response.code in [301, 302, 303, 307] and location is not None:
+                # Done with this response; follow the redirect with a GET
+                response.read()
+                url = urlparse.urljoin(url, location)
+                data = None
+                continue
+            if response.code >= 400:
+                body = StringIO.StringIO(response.read())
+                raise urllib2.HTTPError(url, response.code, response.msg,
+                    response.info(), body)
+            return response
+        raise urllib2.HTTPError(url, response.code,
+            'Too many redirects', response.info(), None)
+
+    def send(self, request):
+        '''
+        Sends a single request, returning the Response.  Uses an idle
+        connection to the host if there is one.
+        Arguments:
+            request - urllib2.Request to send.
+        '''
+        key = (request.get_type(), request.get_host())
+        method = 'GET' if request.get_data() is None else 'POST'
+        for attempt in xrange(2):
+            (conn, reused) = self.get_connection(key)
+            try:
+                conn.request(method, request.get_selector(),
+                    request.get_data(), dict(request.header_items()))
+                http_response = conn.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                # The server may have closed a connection that was sitting
+                # idle, so try once more on a new one
+                if reused and attempt == 0:
+                    continue
+                raise urllib2.URLError(e)
+            break
+        self.lock.acquire()
+        self.num_requests += 1
+        self.lock.release()
+        return Response(self, key, conn, http_response,
+            request.get_full_url())
+
+    def get_connection(self, key):
+        '''
+        Returns (connection, whether it's being reused) for the given host,
+        taking an idle connection if there is one, or making a new one.
+        Arguments:
+            key - (scheme, host) to connect to.
+        '''
+        self.lock.acquire()
+        try:
+            idle = self.idle.get(key)
+            if idle:
+                return (idle.pop(), True)
+            self.num_connections += 1
+        finally:
+            self.lock.release()
+        (scheme, host) = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(host, timeout=timeout)
+        return (conn, False)
+
+    def release(self, key, conn, http_response):
+        '''
+        Called once a response has been read.  Puts its connection back in
+        the pool, unless the server is closing it.
+        '''
+        if http_response.will_close:
+            conn.close()
+            return
+        self.lock.acquire()
+        try:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < max_idle_connections:
+                idle.append(conn)
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def close(self):
+        '''
+        Closes all of the idle connections.
+        '''
+        self.lock.acquire()
+        try:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        '''
+        Returns a dictionary of connection statistics: the number of
+        requests made, the number of connections made (one handshake each),
+        and the fraction of requests that reused an open connection.
+        '''
+        self.lock.acquire()
+        try:
+            requests = self.num_requests
+            connections = self.num_connections
+        finally:
+            self.lock.release()
+        reuse_ratio = 0.0
+        if requests != 0:
+            reuse_ratio = max(requests - connections, 0) / float(requests)
+        return {'requests': requests, 'connections': connections,
+            'reuse_ratio': reuse_ratio}
@@ -0,0 +1,127 @@
+'''
+Contains the Archive class, which keeps a compressed copy of every page
+fetched from the site, so that the database can be rebuilt from them (e.g.
+after fixing the parsers) without scraping the site again.
+'''
+
+import mmap
+import os
+import threading
+import zlib
+
+
+class Archive:
+    '''
+    Append-only store of pages.  Pages are compressed and added to the end of
+    a data file, and each one gets a line in an index file giving where it
+    is: "(offset) (length) (url)".  A page fetched again is added again, and
+    the latest copy is the one used.  Nothing is ever rewritten, so a crash
+    can at worst lose the page being added.
+    Can be added to from several threads at once.
+    '''
+
+    def __init__(self, location):
+        '''
+        Arguments:
+            location - Name of the data file.  The index is kept next to it,
+                       with .idx on the end.  Neither is created until the
+                       first page is added.
+        '''
+        self.location = location
+        self.index_location = location + '.idx'
+        self.data_file = None
+        self.index_file = None
+        self.lock = threading.Lock()
+
+    def add(self, url, html):
+        '''
+        Adds a page to the end of the archive.
+        '''
+        data = zlib.compress(html)
+        self.lock.acquire()
+        try:
+            if self.data_file is None:
+                self.data_file = open(self.location, 'ab')
+                self.index_file = open(self.index_location, 'ab')
+            # Append mode doesn't move the position to the end until written
+            self.data_file.seek(0, os.SEEK_END)
+            offset = self.data_file.tell()
+            self.data_file.write(data)
+            # Only index the page once all of it is on disk
+            self.data_file.flush()
+            self.index_file.write('%d %d %s\n' % (offset, len(data), url))
+            self.index_file.flush()
+        finally:
+            self.lock.release()
+
+    def index(self):
+        '''
+        Returns a dictionary mapping the url of each page in the archive to
+        the (offset, length) of its latest copy.
+        '''
+        entries = {}
+        if not os.path.exists(self.index_location):
+            return entries
+        for line in open(self.index_location, 'rb'):
+            # The last line may have been cut off by a crash
+            parts = line.rstrip('\n').split(' ', 2)
+            if len(parts) != 3 or not line.endswith('\n'):
+                continue
+            entries[parts[2]] = (int(parts[0]), int(parts[1]))
+        return entries
+
+    def reader(self):
+        '''
+        Returns an ArchiveReader for getting pages back out of the archive.
+        '''
+        return ArchiveReader(self.location)
+
+    def close(self):
+        '''
+        Closes the archive's files.  They're opened again if another page is
+        added.
+        '''
+        self.lock.acquire()
+        try:
+            if self.data_file is not None:
+                self.data_file.close()
+                self.index_file.close()
+                self.data_file = None
+                self.index_file = None
+        finally:
+            self.lock.release()
+
+
+class ArchiveReader:
+    '''
+    Reads pages out of an archive's data file, which is memory-mapped so that
+    reading a page doesn't need a seek and read of its own.
+    '''
+
+    def __init__(self, location):
+        '''
+        Arguments:
+            location - Name of the archive's data file.
+        '''
+        self.file = open(location, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        # An empty file can't be mapped, but then there's nothing to read
+        self.map = None
+        if size > 0:
+            self.map = mmap.mmap(self.file.fileno(), size,
+                access=mmap.ACCESS_READ)
+
+    def read(self, offset, length):
+        '''
+        Returns the html of the page at the given offset and length, as given
+        by Archive.index.
+        '''
+        return zlib.decompress(self.map[offset:offset + length])
+
+    def close(self):
+        '''
+        Closes the data file.
+        '''
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
@@ -5,6 +5,7 @@ enough to deserve its own module.
 
 import commands
 import random
+import resultset
 import sqlite3
 import stats
 
@@ -39,11 +40,20 @@ help_str = (
 )
 
 
+def close(songs):
+    '''
+    Closes the songs being viewed, if they're a ResultSet.
+    '''
+    if isinstance(songs, resultset.ResultSet):
+        songs.close()
+
+
 def pageviewer(songs, db):
     '''
     Launches the pageviewer, printing out the given songs.
     Arguments:
-        songs - List of SongInfo to view in the pageviewer.
+        songs - List or ResultSet of SongInfo to view in the pageviewer.  A
+                ResultSet is closed once done with.
         db - Database object
     '''
     num_songs = len(songs)
@@ -67,8 +77,11 @@ def pageviewer(songs, db):
             print '%6s %30s %20s %4s %2s %5s' % ('ID', 'Title', 'Artist',
                 'Dur.', 'U.', 'Rati.')
             # Printing the song
-            for song in songs[(page - 1) * songs_per_page : 
-                                    page * songs_per_page]:
+            page_songs = songs[(page - 1) * songs_per_page :
+                                    page * songs_per_page]
+            # These are the songs being looked at, so fetch their details next
+            commands.prioritize_details(page_songs)
+            for song in page_songs:
                 # Print each song, replace unprintable characters
                 print ('%6d %30s %20s %4d %2d %5.2f' % (song.id,
                     song.title[:30], song.artist[:20], song.duration,
@@ -87,6 +100,7 @@ def pageviewer(songs, db):
                 print
                 print help_str
             elif command in ['exit', 'quit', 'q']:
+                close(songs)
                 return # Go back to main prompt
             # Page-moving commands
             elif command == 'p':
@@ -101,23 +115,25 @@ def pageviewer(songs, db):
                     print 'Invalid page number!'
                     continue
                 page = int(next_page)
-            # Stats commands
+            # Stats commands, which need all of the songs at once
             elif command == 'stats':
                 show_page = False
-                commands.print_stats(songs)
+                commands.print_stats(list(songs))
             elif command == 'global_stats':
                 show_page = False
-                commands.print_global_stats(songs)
+                commands.print_global_stats(list(songs))
             elif command.startswith('all_the_stats'):
                 show_page = False
-                commands.print_all_the_stats(command, songs)
+                commands.print_all_the_stats(command, list(songs))
             elif command == 'queue':
                 show_page = False
                 commands.queue(db)
             elif command == 'queue_songs':
                 # Might get an error, and also need to update certain variables
                 try:
-                    songs = commands.queue_songs(db)
+                    new_songs = commands.queue_songs(db)
+                    close(songs)
+                    songs = new_songs
                     num_songs = len(songs)
                     num_pages = max(num_songs - 1, 0) / songs_per_page + 1
                     page = 1
@@ -127,7 +143,9 @@ def pageviewer(songs, db):
             elif command.startswith('query'):
                 # Might get an error, and also need to update certain variables
                 try:
-                    songs = commands.query(command[5:], db)
+                    new_songs = commands.query(command[5:], db)
+                    close(songs)
+                    songs = new_songs
                     num_songs = len(songs)
                     num_pages = max(num_songs - 1, 0) / songs_per_page + 1
                     page = 1
@@ -136,12 +154,20 @@ def pageviewer(songs, db):
                     print e
             elif command.startswith('rate'):
                 (id, rating) = commands.rate_song(command[4:], db)
-                # Also apply the rating to the current songs
-                for song in songs:
-                    if song.id == id:
-                        song.user_rating = rating 
-                        break
+                # Also apply the rating to the current songs.  A ResultSet
+                # gets its pages again from the database, which has it.
+                if isinstance(songs, resultset.ResultSet):
+                    songs.forget_pages()
+                else:
+                    for song in songs:
+                        if song.id == id:
+                            song.user_rating = rating
+                            break
             elif command == 'shuffle':
+                # Shuffling needs all of the songs at once
+                shuffled = list(songs)
+                close(songs)
+                songs = shuffled
                 random.shuffle(songs)
             elif command.startswith('update'):
                 commands.update_song(command[6:], db)
@@ -0,0 +1,137 @@
+'''
+Contains the QueueWatcher class, which keeps an eye on the queue in the
+background so that looking at it doesn't have to wait on the site.
+'''
+
+import database
+import scraping
+import threading
+import time
+
+# Shortest and longest number of seconds to wait between checks of the queue.
+# The shortest is no less than how long the queue page is cached for (see
+# scraping.cache_ttls), since checking any sooner would just hit the cache.
+min_poll_interval = 30
+max_poll_interval = 300
+
+# Number of seconds after the playing song is expected to end to check the
+# queue, giving the site time to move the next song up
+song_end_margin = 5
+
+# Number of seconds a snapshot of the queue can be used for, if checking the
+# queue keeps failing
+max_snapshot_age = 2 * max_poll_interval
+
+
+class QueueWatcher(threading.Thread):
+    '''
+    Background thread that checks the queue every so often, keeping a
+    snapshot of the ids in it.  Songs that turn up in the queue and aren't in
+    the database yet are added to it straight away, so that the snapshot can
+    be shown without going to the site.
+    The queue only moves up when the playing song ends, so the next check is
+    made just after then: when the song at the front of the queue goes, it
+    has started playing, and its duration gives its remaining time.  Until
+    that's known, or once the song is overdue, the queue is checked less and
+    less often.
+    '''
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        # Ids in the queue when it was last checked, and when that was
+        self.ids = None
+        self.snapshot_time = None
+        # Error from the last check, if it failed
+        self.error = None
+        # Seconds until the next check
+        self.interval = min_poll_interval
+        # Duration of the song at the front of the queue when it was last
+        # checked, and the time the song playing is expected to end
+        self.head_duration = None
+        self.song_end_time = None
+
+    def run(self):
+        '''
+        Checks the queue until stopped.
+        '''
+        # sqlite connections can't be shared between threads
+        db = database.Database()
+        while not self.stop_event.isSet():
+            # Keep watching whatever goes wrong, e.g. the site being down, an
+            # odd page, or the database being locked by remake_all
+            try:
+                self.check(db)
+            except Exception, e:
+                self.error = e
+                self.interval = max_poll_interval
+            self.stop_event.wait(self.interval)
+        db.conn.close()
+
+    def check(self, db):
+        '''
+        Checks the queue once, adding any new songs to the database, and
+        decides how long to wait before the next check.
+        '''
+        ids = scraping.queue_ids()
+        previous_ids = self.ids or []
+        previous_time = self.snapshot_time
+        seen_ids = set(previous_ids)
+        new_ids = [id for id in ids if id not in seen_ids]
+        # Fetching the new songs now means they're ready to be shown
+        songs = db.get_song_infos(ids, fetch_missing=len(new_ids) > 0,
+            quiet=True)
+        now = time.time()
+        self.lock.acquire()
+        try:
+            self.ids = ids
+            self.snapshot_time = now
+            self.error = None
+        finally:
+            self.lock.release()
+
+        if previous_ids and previous_ids[0] not in ids and \
+            self.head_duration is not None:
+            # The song that was at the front has started playing since the
+            # last check.  Assuming it started straight after the last check
+            # means checking too early rather than too late.
+            self.song_end_time = previous_time + self.head_duration
+        self.head_duration = None
+        if songs and songs[0] is not None:
+            self.head_duration = songs[0].duration
+
+        if self.song_end_time is None:
+            # The playing song's end isn't known yet, so wait a bit longer
+            # next time
+            self.interval *= 2
+        elif self.song_end_time > now:
+            # Check again once the playing song has ended
+            self.interval = self.song_end_time - now + song_end_margin
+        else:
+            # The playing song is overdue, so it's further off than thought:
+            # wait as long again as it's been overdue
+            self.interval = now - self.song_end_time
+        self.interval = min(max(self.interval, min_poll_interval),
+            max_poll_interval)
+
+    def snapshot(self):
+        '''
+        Returns the ids in the queue when it was last checked, or None if it
+        hasn't been checked yet or the snapshot is too old to use.
+        '''
+        self.lock.acquire()
+        try:
+            if self.ids is None or \
+                time.time() - self.snapshot_time > max_snapshot_age:
+                return None
+            return self.ids
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        '''
+        Stops checking the queue.
+        '''
+        self.stop_event.set()
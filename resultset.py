@@ -0,0 +1,370 @@
+'''
+Contains the ResultSet class, which gives the songs matching a query a page at
+a time, as they're looked at, rather than reading them all in at once.
+'''
+
+import database
+import re
+import threading
+
+# Number of songs fetched at a time for looking at.  The same as
+# pageviewer.songs_per_page, so that showing a page takes a single fetch.
+page_size = 20
+
+# Number of pages each ResultSet keeps in memory
+max_cached_pages = 4
+
+# Number of songs fetched at a time when going through all of a ResultSet, or
+# skipping over songs to get to a page further on
+batch_size = 1000
+
+# Queries ResultSet can page through by key: the songs table, optionally
+# filtered, and optionally sorted on a single column.  The filter can't have
+# 'order by' in it, so that any other sort (e.g. on two columns, or with a
+# collation) doesn't match at all.
+base_pattern = re.compile(r'^select \* from %s'
+    r'(?: where ((?:(?!\border\s+by\b).)*?))?'
+    r'(?: order by (\w+)(?: (asc|desc))?)?\s*$' % database.table_name,
+    re.IGNORECASE | re.DOTALL)
+# Parts of queries that keep them from being paged through by key
+offset_only_pattern = re.compile(r'\b(limit|offset|group by|union)\b',
+    re.IGNORECASE)
+
+
+class ResultSet:
+    '''
+    The songs matching a query, fetched from the database a page at a time
+    as they're needed, so that neither the time taken to show the first page
+    nor the memory used depends on how many songs match.  Can be used like a
+    list of SongInfo: len, indexing, slicing and iteration all work.  Only the
+    last few pages looked at are kept, and the page after the one last looked
+    at is fetched in the background, ready for it to be looked at next.
+    Pages are found by key (keyset pagination): each page is the songs after
+    the last song on the page before, in the order of the sort column and
+    then the rowid, which an index on the sort column can find straight away.
+    Queries that can't be paged through by key (e.g. ones sorting on more
+    than one column, or with a limit) are paged through with offsets
+    instead.
+    The songs aren't a snapshot: changes to the database show up on pages
+    fetched afterwards.
+    '''
+
+    def __init__(self, query):
+        '''
+        Runs the query, fetching the first page of songs.  Raises
+        sqlite3.Error if the query is bad.
+        Arguments:
+            query - SQL selecting songs, as given by commands.clean_query.
+        '''
+        # Queries are made from the main thread and the prefetching thread,
+        # one at a time
+        self.conn = database.connect(check_same_thread=False)
+        # Rows come back as tuples, which make_song turns into SongInfo
+        self.conn.row_factory = None
+        self.make_song = None
+        self.lock = threading.Lock()
+        self.closed = False
+        self.prefetcher = None
+        self.count = None
+        # Page number -> list of SongInfo, for the pages kept, and their page
+        # numbers, least recently used first
+        self.pages = {}
+        self.page_order = []
+        # Page number -> key of the song before the page (see key), for the
+        # pages whose start is known
+        self.page_keys = {0: None}
+        self.query = query
+        self.column = None
+        match = base_pattern.match(query)
+        if match is not None and offset_only_pattern.search(query) is None:
+            (where, column, direction) = match.groups()
+            self.where = where or '1'
+            if column is None:
+                # Keep the order the songs would come in anyway
+                self.column = 'rowid'
+                self.descending = False
+            elif column.lower() in [name for (name, column_type) in
+                database.column_types]:
+                self.column = column.lower()
+                self.descending = (direction or '').lower() == 'desc'
+        try:
+            self.get_page(0)
+        except:
+            self.close()
+            raise
+
+    def __len__(self):
+        '''
+        Returns the number of songs matching the query.  Counted the first
+        time it's needed.
+        '''
+        self.lock.acquire()
+        try:
+            if self.count is None:
+                if self.column is None:
+                    sql = 'select count(*) from (%s)' % self.query
+                else:
+                    sql = 'select count(*) from %s where %s' % (
+                        database.table_name, self.where)
+                self.count = self.conn.execute(sql).fetchone()[0]
+            return self.count
+        finally:
+            self.lock.release()
+
+    def __getitem__(self, index):
+        '''
+        Returns the song at the given index, or a list of the songs in the
+        given slice.
+        '''
+        if isinstance(index, slice):
+            (start, stop, step) = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in xrange(start, stop, step)]
+            songs = []
+            for page in xrange(start // page_size,
+                (stop - 1) // page_size + 1):
+                page_start = page * page_size
+                songs.extend(self.get_page(page)[max(start - page_start, 0):
+                    stop - page_start])
+            return songs
+        if index < 0:
+            index += len(self)
+        page = self.get_page(index // page_size)
+        if not 0 <= index % page_size < len(page):
+            raise IndexError('ResultSet index out of range')
+        return page[index % page_size]
+
+    def __iter__(self):
+        '''
+        Goes through all of the songs, batch_size at a time, without keeping
+        them.
+        '''
+        # Where the next batch starts: an offset, or the key of the song
+        # before it
+        start = 0 if self.column is None else None
+        while True:
+            # The page being fetched in the background uses the same
+            # connection
+            self.lock.acquire()
+            try:
+                if self.column is None:
+                    rows = self.fetch_rows_at(start, batch_size)
+                else:
+                    rows = self.fetch_rows_after(start, batch_size)
+                songs = self.songs(rows)
+            finally:
+                self.lock.release()
+            for song in songs:
+                yield song
+            if len(rows) < batch_size:
+                return
+            if self.column is None:
+                start += len(rows)
+            else:
+                start = self.key(rows[-1])
+
+    def get_page(self, page):
+        '''
+        Returns the list of SongInfo on the given page (counting from 0),
+        fetching it if it isn't kept, and starts fetching the page after it
+        in the background.
+        '''
+        songs = self.fetch_page(page)
+        if page + 1 not in self.pages and len(songs) == page_size and \
+            (self.prefetcher is None or not self.prefetcher.isAlive()):
+            self.prefetcher = threading.Thread(target=self.fetch_page,
+                args=(page + 1,))
+            self.prefetcher.setDaemon(True)
+            self.prefetcher.start()
+        return songs
+
+    def fetch_page(self, page):
+        '''
+        Returns the list of SongInfo on the given page, fetching it if it
+        isn't kept.
+        '''
+        self.lock.acquire()
+        try:
+            if self.closed:
+                # Only the prefetching thread can get here
+                return []
+            if page in self.pages:
+                # Now the most recently used
+                self.page_order.remove(page)
+                self.page_order.append(page)
+                return self.pages[page]
+            if self.column is None:
+                rows = self.fetch_rows_at(page * page_size, page_size)
+            else:
+                rows = self.fetch_rows_after(self.page_key(page), page_size)
+                if len(rows) == page_size:
+                    self.page_keys[page + 1] = self.key(rows[-1])
+            songs = self.songs(rows)
+            self.pages[page] = songs
+            self.page_order.append(page)
+            while len(self.page_order) > max_cached_pages:
+                del self.pages[self.page_order.pop(0)]
+            return songs
+        finally:
+            self.lock.release()
+
+    def forget_pages(self):
+        '''
+        Throws away the pages kept, so that they're fetched again when next
+        looked at, e.g. once songs on them have been changed.
+        '''
+        self.lock.acquire()
+        try:
+            self.pages = {}
+            self.page_order = []
+        finally:
+            self.lock.release()
+
+    def page_key(self, page):
+        '''
+        Returns the key of the song before the given page, skipping over the
+        songs after the last page with a known start to find it.  Should hold
+        the lock.
+        '''
+        known = max([known_page for known_page in self.page_keys
+            if known_page <= page])
+        key = self.page_keys[known]
+        skip = (page - known) * page_size
+        while skip > 0:
+            rows = self.fetch_rows_after(key, min(skip, batch_size),
+                only_keys=True)
+            if not rows:
+                break
+            key = self.key(rows[-1])
+            skip -= len(rows)
+        self.page_keys[page] = key
+        return key
+
+    def key(self, row):
+        '''
+        Returns the key of a song fetched by fetch_rows_after: its value of
+        the sort column and its rowid.
+        '''
+        return (row[0], row[1])
+
+    def songs(self, rows):
+        '''
+        Returns a list of SongInfo for rows fetched by fetch_rows_after or
+        fetch_rows_at.
+        '''
+        return [self.make_song(None, row) for row in rows]
+
+    def execute(self, sql, parameters, only_keys=False):
+        '''
+        Runs a query, returning all of the rows.  Should hold the lock,
+        unless nothing else is using the ResultSet.
+        Arguments:
+            sql - Query to run.
+            parameters - List of values for the query's parameters.
+            only_keys - Whether the query only gives the keys of the songs
+                        (see key), rather than all of their columns.
+        '''
+        cursor = self.conn.execute(sql, parameters)
+        if self.make_song is None and not only_keys:
+            self.make_song = database.song_row_factory(cursor.description)
+        return cursor.fetchall()
+
+    def fetch_rows_after(self, key, limit, only_keys=False):
+        '''
+        Returns up to limit rows for the songs after the one with the given
+        key, in order.  Should hold the lock, unless nothing else is using the
+        ResultSet.
+        Songs with a null sort value can't be found by comparing keys, so
+        they're fetched separately: they come first when sorting up, and last
+        when sorting down, as sqlite sorts them.
+        Arguments:
+            key - Key of the song to fetch the songs after (see key), or None
+                  to start from the first.
+            limit - Most rows to fetch.
+            only_keys - Whether to fetch only the keys of the songs, e.g. to
+                        skip over them.
+        '''
+        if only_keys:
+            selected = '%s, rowid' % self.column
+        else:
+            selected = '%s, rowid, *' % self.column
+        rows = []
+        for (condition, parameters, order) in self.parts_after(key):
+            if len(rows) == limit:
+                break
+            sql = 'select %s from %s where (%s) and %s order by %s limit ?' % (
+                selected, database.table_name, self.where, condition, order)
+            rows.extend(self.execute(sql, parameters + [limit - len(rows)],
+                only_keys))
+        return rows
+
+    def parts_after(self, key):
+        '''
+        Returns (condition, parameters, order) for each of the parts of the
+        results to fetch from, in order, to get the songs after the one with
+        the given key: the songs with a sort value, and those without.
+        Queries on the sort column's index can only skip ahead by the column
+        and then by the rowid, not by both at once (with a key comparison such
+        as (column, rowid) > (?, ?)), so ties are fetched separately too.
+        '''
+        if self.descending:
+            (direction, comparison) = ('desc', '<')
+        else:
+            (direction, comparison) = ('asc', '>')
+        column = self.column
+        null_order = 'rowid ' + direction
+        value_order = '%s %s, rowid %s' % (column, direction, direction)
+        if key is None:
+            values = ('%s is not null' % column, [], value_order)
+            nulls = ('%s is null' % column, [], null_order)
+        elif key[0] is None:
+            # Already past the songs with a sort value, when sorting down
+            values = ('%s is not null' % column, [], value_order)
+            if self.descending:
+                values = None
+            nulls = ('%s is null and rowid %s ?' % (column, comparison),
+                [key[1]], null_order)
+        else:
+            # The rest of the songs with the same sort value, then the songs
+            # after them.  Each can be found straight away by an index on the
+            # sort column, which sorts on the rowid after the column.
+            ties = ('%s=? and rowid %s ?' % (column, comparison), list(key),
+                null_order)
+            values = ('%s %s ?' % (column, comparison), [key[0]],
+                value_order)
+            # Already past the songs without one, when sorting up
+            nulls = ('%s is null' % column, [], null_order)
+            if not self.descending:
+                nulls = None
+            if column == 'rowid':
+                ties = None
+            return [part for part in [ties, values, nulls]
+                if part is not None]
+        if column == 'rowid':
+            # rowids are never null
+            nulls = None
+        parts = [nulls, values]
+        if self.descending:
+            parts.reverse()
+        return [part for part in parts if part is not None]
+
+    def fetch_rows_at(self, offset, limit):
+        '''
+        Returns up to limit rows for the songs starting at the given offset,
+        for queries that can't be paged through by key.  Should hold the lock,
+        unless nothing else is using the ResultSet.
+        '''
+        sql = 'select * from (%s) limit ? offset ?' % self.query
+        return self.execute(sql, [limit, offset])
+
+    def close(self):
+        '''
+        Closes the ResultSet's connection to the database, once any page
+        being fetched in the background has arrived.
+        '''
+        self.lock.acquire()
+        try:
+            self.closed = True
+            self.conn.close()
+        finally:
+            self.lock.release()
@@ -3,35 +3,139 @@ This module handles all functions used to scrape data from the web.
 
 If something breaks when the site changes, it'll probably be in here.
 '''
+import collections
 import cookielib
 import getpass
+import hashlib
+import httpcache
+import httpsession
+import multiprocessing
+import os
+import pagearchive
 import Queue
 import re
+import signal
 import songinfo
+import sys
 import threading
+import throttle
+import time
 import urllib
 import urllib2
 
 debug = False
 
-# Number of threads to use when performing a fresh scrape of everything.
+# Number of requests made to the site at once when scraping many pages, to
+# begin with.  The scraper adjusts this as it goes, depending on how quickly
+# and reliably the site responds, up to max_threads.
 num_threads = 3
+max_threads = 12
 
-# Helper function
-def first_true_index(alist, pred):
+# Average number of requests per second made to the site when scraping many
+# pages, to keep from overloading it, however many are made at once.
+requests_per_second = 4.0
+
+# Maximum number of scraped pages waiting to be used (e.g. written to the
+# database).  The scraping threads wait once this many are pending.
+max_pending_pages = 2 * num_threads
+
+# Number of processes to parse songlist pages in, so that parsing can use
+# every core rather than holding up the scraping threads.  If 0, each page is
+# parsed by the thread that fetched it.  Set here, like the other scraping
+# settings above; it's worth raising on a machine with several cores.
+parse_processes = 0
+
+# Number of times to retry fetching a songlist page before giving up, and the
+# number of seconds to wait before the first retry.  The wait doubles with
+# every retry after that.
+max_retries = 4
+retry_delay = 2
+
+# Address that the site's pages are under.  The addresses of the pages that
+# get scraped (login_url, playlist_url, favorites_url, song_url and queue_url)
+# are made from it by set_site_url, below.
+site_url = 'https://www.animenfo.com/radio/'
+
+# Number of bytes to read from a response at once
+read_chunk_size = 64 * 1024
+
+# String that songs on the songlist pages are split up by
+chunk_separator = 'playlist.php'
+# Matches the text between two tags, including the > and <
+text_pattern = re.compile('>.*?<')
+# Matches a whole number
+number_pattern = re.compile('[0-9]+')
+
+# Labels of the song page cells giving the requested info and the fav block,
+# and the text of the fav block's link when the song is one of your favorites.
+# These haven't been checked against a real song page, so a warning is printed
+# (once per label) if a page turns up without them.
+requested_label = 'Requested'
+favorites_label = 'Favorites'
+remove_favorite_str = 'Remove from favorites'
+# Labels above that song pages have turned up without so far
+missing_labels = set()
+
+# File the login cookie is kept in between runs, so that you only have to log
+# in again once it expires
+cookie_location = './cookies'
+# Text that only turns up on a page when you aren't logged in (the password
+# box of the login form), which means the saved login has expired
+login_form_str = 'name="password"'
+
+# Session shared by everything that fetches pages, so that connections to the
+# site and the login cookie get reused
+session = httpsession.Session(cookielib.LWPCookieJar(cookie_location))
+# Whether the saved login cookie has been loaded into the session yet
+cookies_loaded = False
+
+# Pages kept in the local HTTP cache, and the number of seconds each is used
+# for before asking the site whether it has changed.  The queue changes every
+# few minutes, but song pages hardly ever do.  Other pages aren't cached.
+# Song pages fetched one at a time (e.g. by update) always ask the site,
+# since they also show your own rating and favorite, which you might have
+# just changed; only songs fetched in bulk use the cached copies.
+cache_ttls = [('queuelist.php', 30), ('songinfo.php', 24 * 60 * 60)]
+# File the cache is kept in, and the most bytes of pages it keeps
+cache_location = './http_cache'
+cache_max_size = 50 * 1024 * 1024
+cache = httpcache.Cache(cache_location, cache_max_size)
+
+# File every page scraped is archived in, so that the database can be rebuilt
+# from them without scraping the site again (see reparse_playlist)
+archive_location = './page_archive'
+archive = pagearchive.Archive(archive_location)
+
+# Number of processes to parse archived pages in when reparsing
+reparse_processes = multiprocessing.cpu_count()
+
+class ScrapingError(Exception):
+    '''
+    Error raised when a page can't be scraped, even after retrying.
+    '''
+    pass
+
+
+def set_site_url(url):
     '''
-    Returns the index of the first element to satisfy the given predicate
-    function.  If no element in the list satisfies the given predicate, None is
-    returned.
+    Sets the addresses of the pages that get scraped from the address they're
+    under.  Called once when the module is loaded, and again to point the
+    scraper at another copy of the site, e.g. a fakesite.FakeSite.
     Arguments:
-        alist - List of elements to be searched.
-        pred - Predicate function, taking in a value from the list and returning
-               a boolean.
+        url - Address that the site's pages are under, ending in a /.
     '''
-    for i, e in enumerate(alist):
-        if pred(e):
-            return i
-    return None
+    global site_url, login_url, playlist_url, favorites_url, song_url, \
+        queue_url
+    site_url = url
+    # Those with a %d take a page number or a song id
+    login_url = site_url + 'login.php'
+    playlist_url = site_url + 'playlist.php?ajax=true&page=%d'
+    favorites_url = site_url + 'myfavs.php?ajax=true&page=%d'
+    song_url = site_url + 'songinfo.php?id=%d'
+    queue_url = site_url + 'queuelist.php'
+
+set_site_url(site_url)
+
 
 def debug_print(str):
     '''
@@ -43,189 +147,600 @@ def debug_print(str):
         print str
 
 
+def iter_response(response):
+    '''
+    Reads the body of a response, yielding it in chunks of up to
+    read_chunk_size bytes as they arrive.
+    '''
+    while True:
+        chunk = response.read(read_chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
 def response_to_html(response):
     '''
     Converts a response to html
     '''
-    text = ''
-    for line in response.readlines():
-        text += line + '\n'
-    return text
+    # Put the page together once at the end, rather than adding to it as it
+    # arrives, which would copy everything read so far every time
+    return ''.join(iter_response(response))
 
 
-def get_song(id):
+def fetch_page(url, fingerprint=None):
+    '''
+    Fetches a page, returning (html, fingerprint), where the fingerprint is a
+    tuple (content hash, ETag, Last-Modified) that can be given back to this
+    function later to check whether the page has changed since.  The ETag and
+    Last-Modified parts are None if the server didn't send them.
+    If a fingerprint is given, the request is conditional and html is None
+    when the page hasn't changed, either according to the server or because
+    its contents hash the same as before.
+    Arguments:
+        url - Address of the page.
+        fingerprint - Fingerprint from an earlier fetch of the page, or None.
+    '''
+    request = urllib2.Request(url)
+    if fingerprint is not None:
+        (digest, etag, last_modified) = fingerprint
+        if etag is not None:
+            request.add_header('If-None-Match', etag)
+        if last_modified is not None:
+            request.add_header('If-Modified-Since', last_modified)
+    response = session.open(request)
+    html = response_to_html(response)
+    # 304 Not Modified
+    if response.code == 304:
+        return (None, fingerprint)
+    headers = response.info()
+    new_fingerprint = (hashlib.md5(html).hexdigest(), headers.getheader('ETag'),
+        headers.getheader('Last-Modified'))
+    if fingerprint is not None and new_fingerprint[0] == fingerprint[0]:
+        return (None, new_fingerprint)
+    archive.add(url, html)
+    return (html, new_fingerprint)
+
+
+def fetch_archived(url):
+    '''
+    Fetches a page, returning its html, and adds it to the archive.
+    '''
+    html = response_to_html(session.open(url))
+    archive.add(url, html)
+    return html
+
+
+def fetch_cached(url, revalidate=False):
+    '''
+    Fetches a page, returning its html.  Pages listed in cache_ttls come from
+    the local cache while they're fresh enough.
+    Arguments:
+        url - Address of the page.
+        revalidate - Whether to ask the site whether a cached page has
+                     changed, however fresh it is.
+    '''
+    for (endpoint, ttl) in cache_ttls:
+        if endpoint in url:
+            if revalidate:
+                ttl = 0
+            (html, downloaded) = cache.fetch(session, url, ttl)
+            # Archive the page unless it's the same as the cached copy, which
+            # was archived when it was downloaded
+            if downloaded:
+                archive.add(url, html)
+            return html
+    return fetch_archived(url)
+
+
+def login(expired=False):
+    '''
+    Makes sure the session is logged in to the site.  The login cookie is
+    saved in cookie_location, so a username and password are only asked for
+    if there's no saved login, or it has expired.
+    Arguments:
+        expired - Whether the site has said that the saved login has expired,
+                  so that it has to be replaced.
+    '''
+    global cookies_loaded
+    cookie_jar = session.cookie_jar
+    if not cookies_loaded:
+        if os.path.exists(cookie_location):
+            try:
+                cookie_jar.load(ignore_discard=True)
+            except cookielib.LoadError, e:
+                print 'Couldn\'t load your saved login: %s' % e
+        cookies_loaded = True
+    cookie_jar.clear_expired_cookies()
+    if expired:
+        print 'You aren\'t logged in to the site; your saved login may have ' \
+            'expired.'
+        cookie_jar.clear()
+    elif len(cookie_jar) > 0:
+        # Whether these cookies are really a login is only known once a page
+        # is fetched with them (see fetch_logged_in)
+        return
+
+    # Query user for username and password
+    username = raw_input('Username: ')
+    password = getpass.getpass('Password: ')
+
+    # Save the login cookie
+    print 'Logging in...'
+    login_data = urllib.urlencode({'username' : username, 'password' : password})
+    response_to_html(session.open(login_url, login_data))
+    save_cookies()
+
+
+def save_cookies():
+    '''
+    Saves the session's cookies in cookie_location, where only you can read
+    them.
+    '''
+    # Make the file readable by its owner only before anything goes in it
+    if not os.path.exists(cookie_location):
+        os.close(os.open(cookie_location, os.O_WRONLY | os.O_CREAT, 0600))
+    os.chmod(cookie_location, 0600)
+    session.cookie_jar.save(ignore_discard=True)
+
+
+def fetch_logged_in(url):
+    '''
+    Fetches a page that needs you to be logged in (e.g. the first page of a
+    list, which is fetched before the rest), returning its html.  If the site
+    says you aren't logged in after all, logs in again and fetches the page
+    again.  Raises ScrapingError if it still says you aren't logged in.
+    '''
+    html = response_to_html(session.open(url))
+    if login_form_str in html:
+        login(expired=True)
+        html = response_to_html(session.open(url))
+        if login_form_str in html:
+            raise ScrapingError('Couldn\'t log in to the site; check your '
+                'username and password.')
+    return html
+
+
+def get_song(id, use_cache=False):
     '''
     Scrapes the page for a specific song and returns a SongInfo object giving
     the song.
+    Arguments:
+        id - Id of the song.
+        use_cache - Whether a cached copy of the page can be used while it's
+                    fresh.  Otherwise the site is always asked whether the
+                    page has changed.
     '''
     # Get the html of the song page
-    opener = urllib2.build_opener()
-    response = opener.open(
-        'https://www.animenfo.com/radio/songinfo.php?id=%d' % id)
-    html = response_to_html(response)
+    html = fetch_cached(song_url % id, revalidate=not use_cache)
     # Parse it and return the song
     song = parse_song_page(html)
     return song
 
 
+def get_songs(ids, message='Fetching song %d', failures=None):
+    '''
+    Scrapes the pages of many songs at once, yielding (id, SongInfo) for each
+    song as soon as it's ready, in any order.
+    Arguments:
+        ids - List of ids (integers) of the songs to scrape.
+        message - Status message to print for each song, as for crawl.
+        failures - List to add the errors of songs that couldn't be scraped
+                   to, as for crawl.
+    '''
+    return crawl(ids, lambda id: get_song(id, use_cache=True), message,
+        failures)
+
+
+def song_page_cells(html):
+    '''
+    Splits up a song page, returning a dictionary mapping the label of each
+    cell to the html of the cell after it (the cell the label is for).  If a
+    label comes up more than once, the first one is kept.
+    '''
+    cells = {}
+    page = html.split('<td class=')
+    for i in xrange(len(page) - 1):
+        # The label is the text at the end of the cell, e.g. Song ID</td>
+        end_index = page[i].find('</td>')
+        if end_index == -1:
+            continue
+        label = page[i][page[i].rfind('>', 0, end_index) + 1:end_index]
+        if label not in cells:
+            cells[label] = page[i + 1]
+    return cells
+
+
+def cell_text(cell):
+    '''
+    Returns the text at the start of a cell from song_page_cells, e.g. 1234
+    for "value">1234</td>.
+    '''
+    return cell.split('>')[1].split('<')[0]
+
+
+def cell_number(cell):
+    '''
+    Returns the first whole number in a cell from song_page_cells, or 0 if it
+    doesn't have one.
+    '''
+    match = number_pattern.search(cell)
+    return 0 if match is None else int(match.group())
+
+
+def optional_cell(cells, label):
+    '''
+    Returns the cell with the given label from song_page_cells, or None if
+    there isn't one, in which case a warning is printed the first time, so
+    that a label that doesn't match the site doesn't quietly leave the values
+    from its cell at 0.
+    '''
+    if label in cells:
+        return cells[label]
+    if label not in missing_labels:
+        missing_labels.add(label)
+        print 'Warning: song pages have no "%s" cell, so the values from ' \
+            'it are left at 0.  The site may have changed.' % label
+    return None
+
+
 def parse_song_page(html):
     '''
     Parses the html of a song page and returns a SongInfo object.
     Doesn't grab the user rating.
     '''
-    # TODO: This is a horrible way to do it that'll break easily.
-    page = html.split('<td class=')
-    # Adding in some asserts for sanity checks
+    # Everything on the page is in label/value pairs of cells, so map each
+    # label to its value in one go and pick out the fields from there.
+    cells = song_page_cells(html)
     # id
-    id_index = first_true_index(page, lambda x: 'Song ID</td>' in x)
-    id = int(page[id_index + 1].split('>')[1].split('<')[0])
+    id = int(cell_text(cells['Song ID']))
     # Artist
-    artist_index = first_true_index(page, lambda x: 'Artist</td>' in x)
-    artist = page[artist_index + 1].split('</a>')[0].split('">')[-1]
+    artist = cells['Artist'].split('</a>')[0].split('">')[-1]
     # Title
-    title_index = first_true_index(page, lambda x: 'Title</td>' in x)
-    title = page[title_index + 1].split('>')[1].split('<')[0]        
+    title = cell_text(cells['Title'])
     # Album
-    album_index = first_true_index(page, lambda x: 'Album</td>' in x)
-    album = page[album_index + 1].split('</a>')[0].split('">')[-1]
+    album = cells['Album'].split('</a>')[0].split('">')[-1]
     # Year
-    year_index = first_true_index(page, lambda x: 'Year</td>' in x)
-    year_str = page[year_index + 1].split('>')[1].split('<')[0]
+    year_str = cell_text(cells['Year'])
     # Sometimes the year isn't given, so just make it 0
     year = 0 if year_str == '' else int(year_str)
     # Genre
-    genre_index = first_true_index(page, lambda x: 'Genre(s)</td>' in x)
-    genre_str = page[genre_index + 1].split('>')[1].split('<')[0]
-    genre_str = genre_str.strip()
+    genre_str = cell_text(cells['Genre(s)']).strip()
     # Convert from comma-delimited to list of strings, as required by SongInfo
     # constructor.
     genres = genre_str.split(',')
     # Rating
-    rating_index = first_true_index(page, lambda x: 'Rating</td>' in x)
-    rating_str = page[rating_index + 1].split('>')[1].split('<')[0]
+    rating_str = cell_text(cells['Rating'])
     rating = rating_str.split('/')[0]
     rating = 0 if rating == '-' else float(rating)
     # Total rates
     rating_str = rating_str.split('(')[1]
     rating_str = rating_str.split(' ')[0]
     total_rates = 0 if rating_str == '' else int(rating_str)
-    # TODO: Requested info
+    # Requested info: the number of times the song has been requested
+    times_requested = 0
+    requested_cell = optional_cell(cells, requested_label)
+    if requested_cell is not None:
+        times_requested = cell_number(requested_cell)
     # Duration, in seconds
-    duration_index = first_true_index(page, lambda x: 'Duration</td>' in x)
-    duration_str = page[duration_index + 1].split('>')[1].split('<')[0]
+    duration_str = cell_text(cells['Duration'])
     [min, sec] = duration_str.split(':')
     duration = 60 * int(min) + int(sec)
-    # TODO: Fav block
+    # Fav block: the number of people who have the song as a favorite, and
+    # whether you're one of them (if so, it offers to remove it instead)
+    total_favorites = 0
+    user_favorite = False
+    fav_block = optional_cell(cells, favorites_label)
+    if fav_block is not None:
+        fav_block = fav_block[:fav_block.find('</td>')]
+        total_favorites = cell_number(fav_block)
+        user_favorite = remove_favorite_str in fav_block
     # Tags
-    tag_index = first_true_index(page, lambda x: 'Tags:</td>' in x)
-    tag_str = page[tag_index + 1]
+    tag_str = cells['Tags:']
     tag_begin_str = '<span'
     tag_end_str = '</td>'
     tag_str = tag_str[tag_str.index(tag_begin_str):
         tag_str.index(tag_end_str)]
-    matches = re.findall('>.*?<', tag_str)
+    matches = text_pattern.findall(tag_str)
     # Store tags as a list of strings
     tags = []
     for match in matches:
         if match != '><':
             match = match[1:-1]
             tags.append(match)
-    # TODO user rating, user favorite
+    # TODO user rating
     user_rating = 0
-    user_favorite = False
     song = songinfo.SongInfo(id, artist, title, album, year, genres, rating,
-        total_rates, duration, tags, user_rating, user_favorite)
+        total_rates, duration, tags, user_rating, user_favorite,
+        times_requested, total_favorites)
     return song
 
 
 class ScrapingThread(threading.Thread):
     '''
-    Scrapes a page of the songlist.
+    Scrapes items (e.g. pages of the songlist) for crawl, handing each result
+    on to whoever is consuming them.
     '''
-    def __init__(self, queue, opener, song_list, song_list_lock, total_pages):
+    def __init__(self, queue, result_queue, scrape, message, bucket,
+        controller, stop):
         '''
         Stores all of the given parameters for future use.
         Args:
-            queue: Queue containing songlist page numbers to fetch.
-            opener: OpenDirector containing the cookie.
-            song_list: List of songs to append the parsed songs to.
-            song_list_lock: Lock on the list of songs, to prevent multiple
-                ScrapingThreads from trampling on each other.
-            total_pages: Total number of pages being scraped.  Useful only for
-                printing status information.
+            queue: Queue containing (item, number of failed attempts) for the
+                items to scrape.  None tells the thread to finish.
+            result_queue: Bounded Queue that (item, result) is put on for each
+                item scraped, or a ScrapingError for an item that failed too
+                many times.  Blocks when the consumer falls behind, so only a
+                handful of results are ever held in memory.
+            scrape: Function taking an item and returning its result.
+            message: Status message to print for each item, with a format
+                specifier for the item.
+            bucket: throttle.TokenBucket to take a token from before each item.
+            controller: throttle.ConcurrencyController deciding how many
+                threads can be scraping at once.
+            stop: threading.Event, set when the results are no longer wanted.
         '''
         threading.Thread.__init__(self)
         self.queue = queue
-        self.opener = opener
-        self.song_list = song_list
-        self.song_list_lock = song_list_lock
-        self.total_pages = total_pages
+        self.result_queue = result_queue
+        self.scrape = scrape
+        self.message = message
+        self.bucket = bucket
+        self.controller = controller
+        self.stop = stop
 
     def run(self):
         '''
-        Scrapes the page, adding the parsed songs to the song list.
+        Scrapes items, passing the result of each one on.
+        Items that fail are put back on the queue to be tried again later.
         '''
         while True:
-            # Get the page number from the queue, scrape the relevent page, then
-            # tell the queue that we're done and ready for more.
-            page_num = self.queue.get()
-            print 'Fetching page %d of %d' % (page_num, self.total_pages)
-            response = self.opener.open(
-                'https://www.animenfo.com/radio/playlist.php?ajax=true&page='+str(page_num))
-            html = response_to_html(response)
-            page_songs = parse_playlist_page(html)
-            self.song_list_lock.acquire()
-            self.song_list.extend(page_songs)
-            self.song_list_lock.release()
+            # Get an item from the queue, scrape it, then tell the queue that
+            # we're done and ready for more.
+            try:
+                work = self.queue.get(timeout=1)
+            except Queue.Empty:
+                if self.stop.is_set():
+                    return
+                continue
+            if work is None or self.stop.is_set():
+                return
+            (item, failures) = work
+            self.controller.acquire()
+            self.bucket.acquire()
+            if self.message is not None:
+                print self.message % item
+            start_time = time.time()
+            try:
+                result = self.scrape(item)
+            except Exception, e:
+                self.controller.release(time.time() - start_time, False)
+                failures += 1
+                if failures > max_retries:
+                    self.put_result(ScrapingError(
+                        'Failed to scrape %s after %d tries: %s' %
+                        (item, failures, e)))
+                else:
+                    delay = retry_delay * 2 ** (failures - 1)
+                    if self.message is not None:
+                        print 'Error scraping %s (%s), retrying in %g ' \
+                            'seconds' % (item, e, delay)
+                    time.sleep(delay)
+                    self.queue.put((item, failures))
+            else:
+                self.controller.release(time.time() - start_time, True)
+                self.put_result((item, result))
             self.queue.task_done()
-        
 
-def scrape_all():
+    def put_result(self, result):
+        '''
+        Puts a result on the result queue, waiting for room, unless the results
+        stop being wanted in the meantime.
+        '''
+        while not self.stop.is_set():
+            try:
+                self.result_queue.put(result, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+
+def crawl(items, scrape, message, failures=None):
     '''
-    Scrapes the website and returns a list of SongInfo, giving all songs on the
-    entire site.
+    Scrapes each of the given items on a pool of ScrapingThreads, yielding
+    (item, result) pairs as soon as they're ready, in any order.
+    The number of requests made at once starts at num_threads and adapts to
+    the site (see throttle.ConcurrencyController), and on average no more
+    than requests_per_second are made.  Items that fail are retried a few
+    times (see max_retries), after which ScrapingError is raised, unless
+    failures is given.
+    Arguments:
+        items - List of things to scrape, e.g. page numbers.
+        scrape - Function taking an item, which fetches and parses it and
+                 returns the result.
+        message - Status message to print as each item is fetched, with a
+                  format specifier for the item, or None to scrape quietly.
+        failures - List to add the ScrapingError of each item that fails too
+                   many times to, so that the other items carry on, or None
+                   to stop at the first one.
     '''
-    cjar = cookielib.CookieJar()
-    opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cjar))
+    queue = Queue.Queue()
+    result_queue = Queue.Queue(max_pending_pages)
+    stop = threading.Event()
+    bucket = throttle.TokenBucket(requests_per_second, num_threads)
+    controller = throttle.ConcurrencyController(num_threads,
+        maximum=max_threads, verbose=message is not None)
+    for item in items:
+        queue.put((item, 0))
+    threads = []
+    for _ in range(min(max_threads, len(items))):
+        scraper_thread = ScrapingThread(queue, result_queue, scrape, message,
+                                        bucket, controller, stop)
+        scraper_thread.setDaemon(True)
+        scraper_thread.start()
+        threads.append(scraper_thread)
+    try:
+        for _ in xrange(len(items)):
+            # Waiting with a timeout lets Ctrl-C through
+            while True:
+                try:
+                    result = result_queue.get(timeout=1)
+                    break
+                except Queue.Empty:
+                    pass
+            if isinstance(result, ScrapingError):
+                if failures is None:
+                    raise result
+                failures.append(result)
+                continue
+            yield result
+        if message is not None:
+            print 'Scraped %d pages at %.2f pages/sec, ending with %d at ' \
+                'once.' % (len(items), controller.rate(), controller.limit)
+    finally:
+        # Let the threads finish, even if we stopped early
+        stop.set()
+        for _ in threads:
+            queue.put(None)
 
-    print 'About to scrape all songs.'
 
-    # Query user for username and password
-    username = raw_input('Username: ')
-    password = getpass.getpass('Password: ')
+def scrape_playlist_page(page_num, fingerprints):
+    '''
+    Scrapes a page of the songlist, returning (fingerprint, songs) where
+    songs is a list of SongInfo, or None if the page hasn't changed.
+    Arguments:
+        page_num - Number of the page to scrape.
+        fingerprints - Dictionary mapping page urls to the fingerprints they
+                       had when last scraped (see fetch_page).
+    '''
+    url = playlist_url % page_num
+    (html, fingerprint) = fetch_page(url, fingerprints.get(url))
+    # Nothing to parse if the page hasn't changed
+    page_songs = None if html is None else parse_playlist_page(html)
+    return (fingerprint, page_songs)
 
-    # Save the login cookie
-    print 'Logging in...'
-    cjar = cookielib.CookieJar()
-    opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cjar))
-    login_data = urllib.urlencode({'username' : username, 'password' : password})
-    opener.open('http://www.animenfo.com/radio/login.php', login_data)
+
+def scrape_all(fingerprints=None, skip_urls=()):
+    '''
+    Scrapes the website, yielding (page number, fingerprint, songs) for each
+    page of the songlist as soon as it has been parsed, where songs is a list
+    of SongInfo and the fingerprint is as returned by fetch_page.  Pages can
+    arrive in any order.
+    Pages are fetched in the background while the caller consumes them, so
+    writing the songs somewhere overlaps with the scraping.
+    Pages that fail are retried a few times (see max_retries), after which
+    ScrapingError is raised.
+    Arguments:
+        fingerprints - Dictionary mapping page urls to the fingerprints they
+                       had when last scraped.  Pages that haven't changed
+                       since are given with songs as None.
+        skip_urls - Collection of page urls not to scrape at all, e.g. the
+                    ones already scraped by an interrupted scrape.
+    '''
+    if fingerprints is None:
+        fingerprints = {}
+
+    print 'About to scrape all songs.'
+    login()
 
     # Get the number of pages to look at
-    response = opener.open('https://www.animenfo.com/radio/playlist.php?ajax=true&page=1')
-    html = response_to_html(response)
+    html = fetch_logged_in(playlist_url % 1)
+    print 'Getting number of pages...'
+    num_pages = count_pages(html)
+    if num_pages == 0:
+        raise ScrapingError('Couldn\'t find how many pages the songlist ' +
+            'has on its first page.')
+
+    # Parse all of the pages, handing each one back as soon as it's ready
+    page_nums = [page_num for page_num in xrange(1, num_pages + 1)
+        if playlist_url % page_num not in skip_urls]
+    for page in scrape_pages(page_nums, fingerprints,
+        'Fetching page %%d of %d' % num_pages):
+        yield page
+
+
+def scrape_pages(page_nums, fingerprints, message):
+    '''
+    Scrapes the given pages of the songlist, yielding (page number,
+    fingerprint, songs) for each one as soon as it has been parsed, as
+    scrape_all does.  If parse_processes isn't 0, the pages are parsed in a
+    pool of that many processes while the scraping threads get on with
+    fetching.
+    Arguments:
+        page_nums - List of the numbers of the pages to scrape.
+        fingerprints - Dictionary mapping page urls to the fingerprints they
+                       had when last scraped.
+        message - Status message to print as each page is fetched, with a
+                  format specifier for the page number.
+    '''
+    if parse_processes == 0:
+        pages = crawl(page_nums,
+            lambda page_num: scrape_playlist_page(page_num, fingerprints),
+            message)
+        for (page_num, (fingerprint, page_songs)) in pages:
+            yield (page_num, fingerprint, page_songs)
+        return
+
+    # Start the processes before any threads, so that they don't get copies
+    # of them
+    pool = multiprocessing.Pool(parse_processes, ignore_interrupts)
+    try:
+        pages = crawl(page_nums,
+            lambda page_num: fetch_page(playlist_url % page_num,
+                fingerprints.get(playlist_url % page_num)),
+            message)
+        # (page number, fingerprint, AsyncResult) for the pages being parsed,
+        # oldest first.  Enough are kept going to keep every process busy.
+        parsing = collections.deque()
+        max_parsing = max(max_pending_pages, 2 * parse_processes)
+        for (page_num, (html, fingerprint)) in pages:
+            # Nothing to parse if the page hasn't changed
+            if html is None:
+                yield (page_num, fingerprint, None)
+                continue
+            parsing.append((page_num, fingerprint,
+                pool.apply_async(parse_playlist_page, (html,))))
+            while parsing and (parsing[0][2].ready() or
+                len(parsing) >= max_parsing):
+                yield parsed_page(*parsing.popleft())
+        while parsing:
+            yield parsed_page(*parsing.popleft())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def parsed_page(page_num, fingerprint, result):
+    '''
+    Waits for a page being parsed by scrape_pages, returning (page number,
+    fingerprint, songs).
+    '''
+    # Waiting without a timeout can't be interrupted with Ctrl-C, so give one
+    # that will never run out
+    return (page_num, fingerprint, result.get(sys.maxint))
+
+
+def ignore_interrupts():
+    '''
+    Makes the current process ignore Ctrl-C.  Used by the parsing processes,
+    which get stopped by scrape_pages instead.
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def count_pages(html):
+    '''
+    Returns the number of pages in a paged list (e.g. the songlist), given the
+    html of its first page.
+    '''
     # List of 'goToPage(number)'
     # Number we want is max of these numbers
     matches = re.findall('goToPage\(\d+\)', html)
     num_pages = 0
-    print 'Getting number of pages...'
     for match in matches:
         num_pages = max(num_pages, int(match.split('(')[1][:-1]))
-
-    # Parse all of the pages
-    songs = []
-    songs_lock = threading.Lock()
-    queue = Queue.Queue()
-    for page_num in xrange(1, num_pages + 1):
-        queue.put(page_num)
-    for _ in range(num_threads):
-        scraper_thread = ScrapingThread(queue, opener, songs, songs_lock,
-                                        num_pages)
-        scraper_thread.setDaemon(True)
-        scraper_thread.start()
-    queue.join()
-
-    return songs
+    return num_pages
 
 
 def parse_playlist_page(html):
@@ -235,18 +750,24 @@ def parse_playlist_page(html):
     '''
     songs = []
     # Pretty hacky -- hope nothing changes in the format of these pages!
-    chunks = html.split('playlist.php')
-    chunks.pop(0)
-    # These chunks come in pairs (since instances of playlist.php come in
-    # pairs).  With the first element of each pair we can get the artist and
-    # song name.  The second pair gives us everything else
-    for i in range(0, len(chunks), 2):
+    # Each song comes as a pair of chunks, starting after each pair of
+    # instances of playlist.php.  With the first chunk of each pair we can get
+    # the artist and song name.  The second gives us everything else.
+    # Rather than splitting the page up, keep track of where each chunk starts
+    # and ends, and search within those bounds, so the page is only read
+    # through once.
+    bounds = []
+    index = html.find(chunk_separator)
+    while index != -1:
+        bounds.append(index + len(chunk_separator))
+        index = html.find(chunk_separator, bounds[-1])
+    for i in xrange(0, len(bounds), 2):
         # Unlike individual song info pages, it's hard to parse these entries
         # because there are no labels - you just have to rely on everything
         # being in the right location.
         # Get the artist and song title from the first chunk
-        chunk1 = chunks[i]
-        [artist, title] = re.findall('>.*?<', chunk1)
+        [artist, title] = text_pattern.findall(html, bounds[i],
+            bounds[i + 1] - len(chunk_separator))
         artist = artist[1:-1]
 
         # Skip everything that doesn't have an artist, since there are some
@@ -254,90 +775,58 @@ def parse_playlist_page(html):
         if artist == '':
             continue
 
-        debug_print('Artist: %s' % artist)
-
         title = title[4:-1] # Get rid of '> - ' and '<'
-        debug_print('Title: %s' % title)
-        # Get everything else from the second chunk
+        # Get everything else from the second chunk, which ends where the next
+        # song starts.
         # Still need id, album, year, genres, rating, total rates,
         # duration (in seconds), tags, user rating, and user favorite
-        chunk2 = chunks[i + 1]
+        start = bounds[i + 1]
+        if i + 2 < len(bounds):
+            end = bounds[i + 2] - len(chunk_separator)
+        else:
+            end = len(html)
         # Album
-        cutoff_str = '>'
-        cutoff_index = chunk2.index(cutoff_str)
-        chunk2 = chunk2[cutoff_index + len(cutoff_str):]
-        album = chunk2.split('<')[0]
-        debug_print('Album: %s' % album)
+        index = html.index('>', start, end) + 1
+        album_end = html.find('<', index, end)
+        album = html[index:album_end if album_end != -1 else end]
         # Duration
-        cutoff_str = '<br/>' # Cut this off twice
-        cutoff_index = chunk2.index(cutoff_str)
-        chunk2 = chunk2[cutoff_index + len(cutoff_str):]
-        cutoff_index = chunk2.index(cutoff_str)
-        chunk2 = chunk2[cutoff_index + len(cutoff_str):]
-        colon_index = chunk2.index(':')
-        duration_str = chunk2[:colon_index + 3]
-        duration_str = duration_str.strip()
+        index = html.index('<br/>', index, end) + len('<br/>')
+        index = html.index('<br/>', index, end) + len('<br/>')
+        colon_index = html.index(':', index, end)
+        duration_str = html[index:min(colon_index + 3, end)].strip()
         [minutes, seconds] = duration_str.split(':')
         duration = 60 * int(minutes) + int(seconds)
-        debug_print('Duration: %s' % duration)
         # User Rating
-        cutoff_str = 'My rating: '
-        cutoff_index = chunk2.index(cutoff_str)
-        chunk2 = chunk2[cutoff_index + len(cutoff_str):]
-        user_rating = chunk2[:2].strip()
+        index = html.index('My rating: ', index, end) + len('My rating: ')
+        user_rating = html[index:min(index + 2, end)].strip()
         # Store rating of - as 0
         user_rating = 0 if user_rating == '-' else int(user_rating)
-        debug_print('User rating: %s' % user_rating)
         # Rating
-        cutoff_str = 'Song rating: '
-        cutoff_index = chunk2.index(cutoff_str)
-        chunk2 = chunk2[cutoff_index + len(cutoff_str):]
+        index = html.index('Song rating: ', index, end) + len('Song rating: ')
         rating = 0
-        if chunk2[0] != '-':
-            space_index = chunk2.index(' ')
-            rating = chunk2[0:space_index]
-            rating = float(rating)
-        debug_print('Rating: %s' % rating)
+        if html[index] != '-':
+            rating = float(html[index:html.index(' ', index, end)])
         # Total rates
-        cutoff_str = '('
-        cutoff_index = chunk2.index(cutoff_str)
-        chunk2 = chunk2[cutoff_index + len(cutoff_str):]
-        space_index = chunk2.index(' ')
-        total_rates_str = chunk2[0:space_index]
+        index = html.index('(', index, end) + 1
+        total_rates_str = html[index:html.index(' ', index, end)]
         total_rates = 0 if total_rates_str == '' else int(total_rates_str)
-        debug_print('Total rates: %s' % total_rates)
         # Genres
         # Store as a list of strings
-        cutoff_str = 'Genre(s): '
-        cutoff_index = chunk2.index(cutoff_str)
-        chunk2 = chunk2[cutoff_index + len(cutoff_str):]
-        end_index = chunk2.index('<br/>')
-        genres = chunk2[:end_index] # Comma-delimited
-        genres = genres.split(',')
-        debug_print('Genres: %s' % genres)
+        index = html.index('Genre(s): ', index, end) + len('Genre(s): ')
+        genres = html[index:html.index('<br/>', index, end)].split(',')
         # Tags
         # Store as a list of strings
-        cutoff_str = 'Tag(s):'
-        cutoff_index = chunk2.index(cutoff_str)
-        chunk2 = chunk2[cutoff_index + len(cutoff_str):]
-        tag_end_str = '</td>'
-        tag_str = chunk2[:chunk2.index(tag_end_str)]
-        matches = re.findall('>.*?<', tag_str)
+        index = html.index('Tag(s):', index, end) + len('Tag(s):')
         tags = []
-        for match in matches:
-            if match != '><':
-                match = match[1:-1]
-                match = match.strip()
-                if match != '' and match != ',':
-                    tags.append(match)
-        debug_print('Tags: %s' % tags)
+        for match in text_pattern.findall(html, index,
+            html.index('</td>', index, end)):
+            match = match[1:-1].strip()
+            if match != '' and match != ',':
+                tags.append(match)
         # Id
-        cutoff_str = 'songinfo.php?id='
-        cutoff_index = chunk2.index(cutoff_str)
-        chunk2 = chunk2[cutoff_index + len(cutoff_str):]
-        id_str = chunk2[:chunk2.index('"')]
-        id = int(id_str)
-        debug_print('Id: %s' % id)
+        index = html.index('songinfo.php?id=', index, end) + \
+            len('songinfo.php?id=')
+        id = int(html[index:html.index('"', index, end)])
         ### TODO: Get the user_favorite and year
         user_favorite = False
         year = 0
@@ -345,15 +834,23 @@ def parse_playlist_page(html):
         # Debug code
         # TODO: Just use the debugger
         if debug:
+            print 'Artist: %s' % artist
+            print 'Title: %s' % title
+            print 'Album: %s' % album
+            print 'Duration: %s' % duration
+            print 'User rating: %s' % user_rating
+            print 'Rating: %s' % rating
+            print 'Total rates: %s' % total_rates
+            print 'Genres: %s' % genres
+            print 'Tags: %s' % tags
+            print 'Id: %s' % id
             print 'Year: ', year
             print 'User favorite: ', user_favorite
             # Pause until user presses enter, just so that the info can be seen
             # easily
             raw_input()
-            
-        
+
         # Put in the song
-        # Convert genres and tags into list of strings
         song = songinfo.SongInfo(id, artist, title, album, year,
             genres, rating, total_rates, duration,
             tags, user_rating, user_favorite)
@@ -368,9 +865,7 @@ def queue_ids():
     '''
     # TODO: Current song
     # Get the html of the queue page.
-    opener = urllib2.build_opener()
-    response = opener.open('https://www.animenfo.com/radio/queuelist.php')
-    html = response_to_html(response)
+    html = fetch_cached(queue_url)
 
     # Get the song ids
     # Make sure to not scrape the top 10 requests
@@ -389,43 +884,32 @@ def scrape_favorites():
     '''
     Scrapes a list of favorites, returning a list of ids (integers).
     '''
-    cjar = cookielib.CookieJar()
-    opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cjar))
-
     print "About to scrape your favorites list."
-
-    # Query user for username and password
-    username = raw_input("Username: ")
-    password = getpass.getpass("Password: ")
-
-    # Save the login cookie
-    cjar = cookielib.CookieJar()
-    opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cjar))
-    login_data = urllib.urlencode({'username' : username, 'password' : password})
-    opener.open('http://www.animenfo.com/radio/login.php', login_data)
+    login()
 
     # Get the number of pages to look at
-    response = opener.open('https://www.animenfo.com/radio/myfavs.php?ajax=true&page=1')
-    html = response_to_html(response)
-    # List of 'goToPage(number)'
-    # Number we want is max of these numbers
-    matches = re.findall('goToPage\(\d+\)', html)
-    num_pages = 0
-    for match in matches:
-        num_pages = max(num_pages, int(match.split('(')[1][:-1]))
+    html = fetch_logged_in(favorites_url % 1)
+    archive.add(favorites_url % 1, html)
+    num_pages = count_pages(html)
 
-    # Parse all of the pages
-    songs = []
-    for page_num in range(1, num_pages + 1):
-        print 'Parsing favorites page %d of %d' % (page_num, num_pages)
-        response = opener.open('https://www.animenfo.com/radio/myfavs.php?ajax=true&page='+str(page_num))
-        html = response_to_html(response)
-        page_songs = parse_favorites_page(html)
+    # Parse all of the pages.  The first one has already been fetched.
+    songs = parse_favorites_page(html)
+    pages = crawl(range(2, num_pages + 1), scrape_favorites_page,
+        'Parsing favorites page %%d of %d' % num_pages)
+    for (page_num, page_songs) in pages:
         songs.extend(page_songs)
 
     return songs
 
 
+def scrape_favorites_page(page_num):
+    '''
+    Scrapes a page of the favorites list, returning a list of ids.
+    '''
+    html = fetch_archived(favorites_url % page_num)
+    return parse_favorites_page(html)
+
+
 def parse_favorites_page(html):
     '''
     Parses the html of a page in the favorites pages.  Returns a list of
@@ -438,3 +922,103 @@ def parse_favorites_page(html):
         id = match.split('=')[1][:-1]
         songs.append(int(id))
     return songs
+
+
+def archived_list(url_pattern, index):
+    '''
+    Returns a list of (url, offset, length) for the archived copies of the
+    pages of a paged list (e.g. the songlist), as far as its first page says
+    the list goes.  Pages missing from the archive are left out.
+    Arguments:
+        url_pattern - Address of the list's pages, with a %d for the page
+                      number.
+        index - Index of the archive, as given by Archive.index.
+    '''
+    if url_pattern % 1 not in index:
+        return []
+    reader = archive.reader()
+    try:
+        num_pages = count_pages(reader.read(*index[url_pattern % 1]))
+    finally:
+        reader.close()
+    entries = []
+    for page_num in xrange(1, max(num_pages, 1) + 1):
+        url = url_pattern % page_num
+        if url in index:
+            entries.append((url,) + index[url])
+        else:
+            print 'Page %d (%s) is missing from the archive.' % (page_num, url)
+    return entries
+
+
+def reparse_playlist():
+    '''
+    Parses the archived songlist pages again, yielding (url, songs) for each
+    page, in any order, where songs is a list of SongInfo.  The pages are
+    parsed in a pool of reparse_processes processes, without going to the
+    site at all.
+    '''
+    entries = archived_list(playlist_url, archive.index())
+    print 'Reparsing %d songlist pages...' % len(entries)
+    if reparse_processes == 0:
+        reader = archive.reader()
+        try:
+            for (url, offset, length) in entries:
+                yield (url, parse_playlist_page(reader.read(offset, length)))
+        finally:
+            reader.close()
+        return
+    pool = multiprocessing.Pool(reparse_processes, init_reparse,
+        (archive_location,))
+    try:
+        pages = pool.imap_unordered(parse_archived_page, entries)
+        for _ in entries:
+            # Waiting without a timeout can't be interrupted with Ctrl-C
+            yield pages.next(sys.maxint)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def reparse_favorites():
+    '''
+    Parses the archived favorites pages again, returning a list of ids, or
+    None if the favorites list hasn't been archived.
+    '''
+    entries = archived_list(favorites_url, archive.index())
+    if not entries:
+        return None
+    reader = archive.reader()
+    try:
+        ids = []
+        for (url, offset, length) in entries:
+            ids.extend(parse_favorites_page(reader.read(offset, length)))
+        return ids
+    finally:
+        reader.close()
+
+
+# ArchiveReader used by parse_archived_page, one for each process
+archive_reader = None
+
+def init_reparse(location):
+    '''
+    Sets up one of reparse_playlist's pool processes to parse archived pages,
+    opening the archive.  Like the parsing processes of scrape_pages, it
+    ignores Ctrl-C, and gets stopped by reparse_playlist instead.  Not to be
+    called in the main process, which would stop Ctrl-C working there too.
+    '''
+    global archive_reader
+    ignore_interrupts()
+    archive_reader = pagearchive.ArchiveReader(location)
+
+
+def parse_archived_page(entry):
+    '''
+    Parses an archived songlist page, given (url, offset, length), and returns
+    (url, songs).  init_reparse must have been called first, in the process
+    doing the parsing.
+    '''
+    (url, offset, length) = entry
+    return (url, parse_playlist_page(archive_reader.read(offset, length)))
@@ -3,14 +3,27 @@ Contains the SongInfo class, which is the common format for all songs when used
 in Python code.
 '''
 
+# Character separating the genres (and the tags) of a song when they're kept
+# as a single string, as they are in the database
+delimiter_char = '@'
 
-class SongInfo:
+
+class SongInfo(object):
     '''
     Contains all information about a particular song.
+    Kept compact, since whole catalogs of them get made at once: there's no
+    per-song attribute dictionary, and songs read from the database (see
+    from_stored) keep their genres and tags as the delimited strings they
+    were stored as until they're first used.
     '''
 
+    __slots__ = ['id', 'artist', 'title', 'album', 'year', '_genres', 'rating',
+        'total_rates', 'duration', '_tags', 'user_rating', 'user_favorite',
+        'times_requested', 'total_favorites']
+
     def __init__(self, id, artist, title, album, year, genres, rating,
-        total_rates, duration, tags, user_rating=0, user_favorite=False):
+        total_rates, duration, tags, user_rating=0, user_favorite=False,
+        times_requested=0, total_favorites=0):
         '''
         Constructor.
         id: integer
@@ -25,6 +38,8 @@ class SongInfo:
         tags: list of strings
         user_rating: integer
         user_favorite: boolean
+        times_requested: integer
+        total_favorites: integer
         '''
 
         # Just store everything
@@ -33,10 +48,69 @@ class SongInfo:
         self.title = title
         self.album = album
         self.year = year
-        self.genres = genres
+        self._genres = genres
         self.rating = rating
         self.total_rates = total_rates
         self.duration = duration
-        self.tags = tags
+        self._tags = tags
         self.user_rating = user_rating
         self.user_favorite = user_favorite
+        self.times_requested = times_requested
+        self.total_favorites = total_favorites
+
+    @classmethod
+    def from_stored(cls, values):
+        '''
+        Makes a SongInfo from values in the same order as the constructor's
+        arguments, except that genres and tags are delimited strings (see
+        delimiter_char), which are only split up once they're used.  Quicker
+        than the constructor, for making songs out of database rows.
+        '''
+        song = cls.__new__(cls)
+        (song.id, song.artist, song.title, song.album, song.year, song._genres,
+            song.rating, song.total_rates, song.duration, song._tags,
+            song.user_rating, song.user_favorite, song.times_requested,
+            song.total_favorites) = values
+        return song
+
+    def get_genres(self):
+        '''
+        Returns the list of genres, splitting them up first if they're still
+        a delimited string.
+        '''
+        if isinstance(self._genres, basestring):
+            self._genres = self._genres.split(delimiter_char)
+        return self._genres
+
+    def set_genres(self, genres):
+        self._genres = genres
+
+    genres = property(get_genres, set_genres)
+
+    def get_tags(self):
+        '''
+        Returns the list of tags, splitting them up first if they're still a
+        delimited string.
+        '''
+        if isinstance(self._tags, basestring):
+            self._tags = self._tags.split(delimiter_char)
+        return self._tags
+
+    def set_tags(self, tags):
+        self._tags = tags
+
+    tags = property(get_tags, set_tags)
+
+    def __getstate__(self):
+        '''
+        Returns the song's values, for pickling (e.g. to send songs between
+        processes), which can't find them by itself without a dictionary.
+        '''
+        return tuple([getattr(self, name) for name in self.__slots__])
+
+    def __setstate__(self, state):
+        '''
+        Restores the values given by __getstate__.
+        '''
+        for (name, value) in zip(self.__slots__, state):
+            setattr(self, name, value)
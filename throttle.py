@@ -0,0 +1,185 @@
+'''
+Contains the classes used to keep the scraper from overloading the site:
+TokenBucket, which limits the rate of requests, and ConcurrencyController,
+which limits how many are made at once.
+'''
+
+import threading
+import time
+
+# Weight given to each new latency measurement in the smoothed latency
+latency_weight = 0.2
+
+# ConcurrencyController backs off once the smoothed latency gets this many
+# times higher than the best it's been
+slowdown_factor = 2.0
+
+
+class TokenBucket:
+    '''
+    Rate limiter.  The bucket fills with tokens at a steady rate, up to its
+    capacity, and every request has to take a token out first.  This allows
+    short bursts of up to 'capacity' requests while keeping the average rate
+    at 'rate' requests per second.
+    Can be shared between threads.
+    '''
+
+    def __init__(self, rate, capacity=1):
+        '''
+        Arguments:
+            rate - Average number of tokens given out per second.
+            capacity - Maximum number of tokens that can build up.
+        '''
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.last_time = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Takes a token out of the bucket, waiting for one if it's empty.
+        '''
+        while True:
+            self.lock.acquire()
+            try:
+                now = time.time()
+                self.tokens = min(self.capacity,
+                    self.tokens + (now - self.last_time) * self.rate)
+                self.last_time = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            finally:
+                self.lock.release()
+            time.sleep(wait)
+
+
+class ConcurrencyController:
+    '''
+    Decides how many requests can be made at once, adjusting to how the site
+    copes.  Uses additive increase, multiplicative decrease (as TCP does):
+    every time 'limit' requests in a row succeed without slowing down, the
+    limit goes up by one, but an error or a jump in latency halves it.  After
+    halving, the limit is left alone for 'limit' requests, so that a burst of
+    failures only counts once, and is only raised again once that many go by
+    with no trouble at all.
+    Each request should be wrapped in a call to acquire and one to release.
+    Can be shared between threads.
+    '''
+
+    def __init__(self, initial, minimum=1, maximum=16, verbose=True):
+        '''
+        Arguments:
+            initial - Number of requests allowed at once to begin with.
+            minimum - Lowest the limit can go.
+            maximum - Highest the limit can go.
+            verbose - Whether to print every change to the limit.
+        '''
+        self.limit = initial
+        self.verbose = verbose
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        # Smoothed latency of recent requests, and the lowest it's been
+        self.latency = None
+        self.best_latency = None
+        # Requests finished since the limit last changed, whether the last
+        # change lowered it, and whether any of those requests failed or
+        # slowed down
+        self.since_change = 0
+        self.decreased = False
+        self.troubled = False
+        # Statistics
+        self.completed = 0
+        self.start_time = time.time()
+
+    def acquire(self):
+        '''
+        Waits until another request can be made, and counts it as started.
+        '''
+        self.condition.acquire()
+        try:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+        finally:
+            self.condition.release()
+
+    def release(self, latency, ok):
+        '''
+        Counts a request as finished, and adjusts the limit based on it.
+        Arguments:
+            latency - Number of seconds the request took.
+            ok - Whether the request succeeded.
+        '''
+        self.condition.acquire()
+        try:
+            self.in_flight -= 1
+            self.completed += 1
+            self.since_change += 1
+            if not ok:
+                self.decrease('error')
+            else:
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += latency_weight * (latency - self.latency)
+                if self.best_latency is None or \
+                    self.latency < self.best_latency:
+                    self.best_latency = self.latency
+                if self.latency > slowdown_factor * self.best_latency:
+                    if self.decrease('slowdown'):
+                        # Judge latency against the new level from now on, in
+                        # case the site has just got slower overall
+                        self.best_latency = self.latency
+                elif self.since_change >= self.limit:
+                    if self.troubled:
+                        # Start counting again rather than raising the limit
+                        self.since_change = 0
+                        self.troubled = False
+                    else:
+                        self.change_limit(min(self.limit + 1, self.maximum),
+                            'ok')
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def decrease(self, reason):
+        '''
+        Halves the limit, unless it was already lowered recently (so that a
+        burst of failures only counts once), in which case the trouble is
+        noted so that the limit isn't raised.  Should hold the condition.
+        Returns whether the limit was lowered.
+        '''
+        if self.decreased and self.since_change < self.limit:
+            self.troubled = True
+            return False
+        self.change_limit(max(self.limit // 2, self.minimum), reason)
+        self.decreased = True
+        return True
+
+    def change_limit(self, limit, reason):
+        '''
+        Sets the limit, printing the decision.  Should hold the condition.
+        '''
+        self.since_change = 0
+        self.decreased = False
+        self.troubled = False
+        if limit == self.limit:
+            return
+        if self.verbose:
+            print 'Concurrency %d -> %d (%s, latency %.2fs, %.2f pages/sec)' \
+                % (self.limit, limit, reason, self.latency or 0, self.rate())
+        self.limit = limit
+
+    def rate(self):
+        '''
+        Returns the average number of requests finished per second so far.
+        '''
+        elapsed = time.time() - self.start_time
+        if elapsed == 0:
+            return 0.0
+        return self.completed / elapsed